@@ -0,0 +1,303 @@
+'''
+用YCSB风格的负载比较MapEngineFactory里的引擎, 结果写成JSON, 方便在版本之间对比
+
+每个(引擎, 模式, 负载)在单独的进程里跑: 装载records个key, 再执行operations次操作
+memory 直接操作引擎; table 通过KVTableOperator, 带日志, 之后关闭再重新打开测恢复时间
+输出每次运行的吞吐, p50/p99/p999延迟, 装载/恢复时间和进程峰值内存(RSS)
+
+python -m bench.runner --engines dict,hashMap,bTreeMap,binarySearchMap --workloads A,B,C,D,E,F \
+    --modes memory,table --records 100000 --operations 100000 --output bench.json
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.workloads import DISTRIBUTIONS, WORKLOADS, Workload
+from internal.KVTable import KVTableOperator
+from mapEngine.factory import EngineType, MapEngineFactory
+
+MODES = ("memory", "table")
+# 需要文件路径的引擎, 路径放在本次运行的临时目录里
+_PATH_ENGINES = {"bitcask": "bitcask", "pagedBTreeMap": "paged.db", "lsm": "lsm"}
+
+
+def make_key(number: int, key_size: int) -> str:
+    return "user{:0{}d}".format(number, max(1, key_size - 4))
+
+
+class _ValueSource:
+    '''
+    从一段预先生成的随机字符串里切value, 不让生成value的开销算进延迟
+    '''
+
+    def __init__(self, value_size: int, rnd):
+        self.size = value_size
+        self.rnd = rnd
+        self.data = "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(value_size + 1024))
+
+    def next(self) -> str:
+        start = self.rnd.randrange(1024)
+        return self.data[start:start + self.size]
+
+
+class _MemoryTarget:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def write(self, key, value):
+        self.engine[key] = value
+
+    def read(self, key):
+        return self.engine.get(key)
+
+    def scan(self, start, length):
+        if isinstance(self.engine, dict):
+            raise Exception("dict engine is not ordered, scan is not supported")
+        return list(self.engine.scan(start, None, length))
+
+
+class _TableTarget:
+    def __init__(self, table):
+        self.table = table
+
+    def write(self, key, value):
+        self.table.set(key, value)
+
+    def read(self, key):
+        try:
+            return self.table.get(key)
+        except KeyError:
+            return None
+
+    def scan(self, start, length):
+        return list(self.table.scan(start, None, length))
+
+
+def _create_engine(name, workdir):
+    if name in _PATH_ENGINES:
+        path = os.path.join(workdir, _PATH_ENGINES[name])
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        return MapEngineFactory.create(name, path=path)
+    return MapEngineFactory.create(name)
+
+
+def _create_engine_for_recovery(name, workdir):
+    # 自己管理文件的引擎换一个新文件, 恢复时间只算回放日志
+    if name in _PATH_ENGINES:
+        workdir = os.path.join(workdir, "recovery")
+        os.makedirs(workdir, exist_ok=True)
+    return _create_engine(name, workdir)
+
+
+def _percentiles(latencies_ns):
+    latencies_ns.sort()
+    n = len(latencies_ns)
+
+    def at(q):
+        return latencies_ns[min(n - 1, int(q * n))] / 1000
+
+    return {"p50": at(0.5), "p99": at(0.99), "p999": at(0.999), "max": latencies_ns[-1] / 1000}
+
+
+def _peak_rss_kb():
+    # Linux上ru_maxrss的单位是KB, macOS上是字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_one(spec: dict) -> dict:
+    '''
+    在子进程里执行一次运行, spec见run()
+    return dict 这次运行的结果
+    '''
+    result = {"engine": spec["engine"], "mode": spec["mode"], "workload": spec["workload"]}
+    workdir = tempfile.mkdtemp(prefix="orchid-bench-")
+    try:
+        workload = Workload(spec["workload"], spec["records"], spec["distribution"],
+                            spec["max_scan_length"], spec["seed"])
+        result["distribution"] = workload.distribution
+        values = _ValueSource(spec["value_size"], random.Random(spec["seed"]))
+        key_size = spec["key_size"]
+        result["base_rss_kb"] = _peak_rss_kb()
+
+        table = None
+        engine = _create_engine(spec["engine"], workdir)
+        if spec["mode"] == "table":
+            source = os.path.join(workdir, "bench.db")
+            table = KVTableOperator(source, engine=engine, durability=spec["durability"],
+                                    log_format=spec["log_format"], compact_min_bytes=None)
+            target = _TableTarget(table)
+        else:
+            target = _MemoryTarget(engine)
+
+        # 装载顺序打乱, 有序引擎不会碰上顺序插入这种最好情况
+        order = list(range(spec["records"]))
+        random.Random(spec["seed"]).shuffle(order)
+        start = time.perf_counter()
+        for number in order:
+            target.write(make_key(number, key_size), values.next())
+        result["load_seconds"] = time.perf_counter() - start
+
+        if "scan" in WORKLOADS[spec["workload"]]:
+            try:
+                target.scan(make_key(0, key_size), 1)
+            except Exception as e:
+                result["skipped"] = str(e)
+                return result
+
+        latencies = []
+        counts = {}
+        clock = time.perf_counter_ns
+        start = time.perf_counter()
+        for _ in range(spec["operations"]):
+            op, number, length = workload.next()
+            key = make_key(number, key_size)
+            begin = clock()
+            if op == "read":
+                target.read(key)
+            elif op == "scan":
+                target.scan(key, length)
+            elif op == "rmw":
+                target.read(key)
+                target.write(key, values.next())
+            else:
+                target.write(key, values.next())
+            latencies.append(clock() - begin)
+            counts[op] = counts.get(op, 0) + 1
+        elapsed = time.perf_counter() - start
+        result["operations"] = counts
+        result["throughput_ops"] = spec["operations"] / elapsed
+        result["latency_us"] = _percentiles(latencies)
+        result["peak_rss_kb"] = _peak_rss_kb()
+
+        if table is not None:
+            table.close()
+            result["log_bytes"] = os.path.getsize(table.source)
+            table = engine = target = None
+            engine = _create_engine_for_recovery(spec["engine"], workdir)
+            start = time.perf_counter()
+            table = KVTableOperator(source, engine=engine, durability=spec["durability"], compact_min_bytes=None)
+            result["recovery_seconds"] = time.perf_counter() - start
+            table.close()
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run(engines, workloads, modes, records=100000, operations=100000, key_size=16, value_size=100,
+        distribution=None, max_scan_length=100, durability="none", log_format="binary", seed=0,
+        progress=None) -> dict:
+    '''
+    engines/workloads/modes 的每个组合跑一次, 每次一个新进程, 峰值内存互不影响
+    distribution 为None时用各负载默认的分布
+    progress 每跑完一次用结果调用一次
+    return dict 可以直接json.dump的结果
+    '''
+    for engine in engines:
+        if engine not in EngineType.__members__:
+            raise Exception("unknown engine: {}".format(engine))
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            raise Exception("unknown workload: {}".format(workload))
+    for mode in modes:
+        if mode not in MODES:
+            raise Exception("unknown mode: {}".format(mode))
+    if distribution is not None and distribution not in DISTRIBUTIONS:
+        raise Exception("unknown distribution: {}".format(distribution))
+    if key_size < 4 + len(str(records + operations)):
+        raise Exception("key_size is too small for {} keys".format(records + operations))
+
+    config = {
+        "records": records, "operations": operations, "key_size": key_size, "value_size": value_size,
+        "distribution": distribution, "max_scan_length": max_scan_length, "durability": durability,
+        "log_format": log_format, "seed": seed,
+    }
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for engine in engines:
+        for mode in modes:
+            for workload in workloads:
+                spec = dict(config, engine=engine, mode=mode, workload=workload)
+                with ctx.Pool(1) as pool:
+                    result = pool.apply(run_one, (spec,))
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+    return {
+        "revision": _git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+
+
+def _print_result(result):
+    if "skipped" in result:
+        line = "skipped: {}".format(result["skipped"])
+    else:
+        latency = result["latency_us"]
+        line = "{:>10.0f} ops/s  p50 {:.1f}us  p99 {:.1f}us  p999 {:.1f}us  load {:.2f}s  rss {}KB".format(
+            result["throughput_ops"], latency["p50"], latency["p99"], latency["p999"],
+            result["load_seconds"], result["peak_rss_kb"])
+        if "recovery_seconds" in result:
+            line += "  recovery {:.2f}s".format(result["recovery_seconds"])
+    print("{:<16} {:<6} {} {}".format(result["engine"], result["mode"], result["workload"], line), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="orchid_db engine benchmark")
+    parser.add_argument("--engines", default="dict,hashMap,bTreeMap,binarySearchMap")
+    parser.add_argument("--workloads", default="A,B,C,D,E,F")
+    parser.add_argument("--modes", default="memory,table")
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--operations", type=int, default=100000)
+    parser.add_argument("--key-size", type=int, default=16)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default=None,
+                        help="override the workload's default key distribution")
+    parser.add_argument("--max-scan-length", type=int, default=100)
+    parser.add_argument("--durability", default="none")
+    parser.add_argument("--log-format", choices=("text", "binary"), default="binary")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    report = run(args.engines.split(","), args.workloads.upper().split(","), args.modes.split(","),
+                 records=args.records, operations=args.operations, key_size=args.key_size,
+                 value_size=args.value_size, distribution=args.distribution,
+                 max_scan_length=args.max_scan_length, durability=args.durability,
+                 log_format=args.log_format, seed=args.seed, progress=_print_result)
+    if args.output:
+        with open(args.output, "w") as e:
+            json.dump(report, e, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+'''
+YCSB风格的负载定义和key分布
+
+负载(Cooper et al., Benchmarking Cloud Serving Systems with YCSB):
+A 50%读 50%更新          zipfian
+B 95%读 5%更新           zipfian
+C 100%读                 zipfian
+D 95%读 5%插入           latest, 读最近插入的
+E 95%短扫描 5%插入       zipfian, 扫描长度在1..max_scan_length均匀分布
+F 50%读 50%读-改-写      zipfian
+'''
+
+import random
+
+WORKLOADS = {
+    "A": {"read": 0.5, "update": 0.5, "distribution": "zipfian"},
+    "B": {"read": 0.95, "update": 0.05, "distribution": "zipfian"},
+    "C": {"read": 1.0, "distribution": "zipfian"},
+    "D": {"read": 0.95, "insert": 0.05, "distribution": "latest"},
+    "E": {"scan": 0.95, "insert": 0.05, "distribution": "zipfian"},
+    "F": {"read": 0.5, "rmw": 0.5, "distribution": "zipfian"},
+}
+OPERATIONS = ("read", "update", "insert", "scan", "rmw")
+DISTRIBUTIONS = ("uniform", "zipfian", "latest")
+
+_FNV_OFFSET = 0xCBF29CE484222325
+_FNV_PRIME = 0x100000001B3
+_MASK64 = (1 << 64) - 1
+
+
+def fnv64(value: int) -> int:
+    '''
+    FNV-1a, 和YCSB一样用来把zipfian的热点打散到整个key空间
+    '''
+    h = _FNV_OFFSET
+    for _ in range(8):
+        h = ((h ^ (value & 0xFF)) * _FNV_PRIME) & _MASK64
+        value >>= 8
+    return h
+
+
+class ZipfianGenerator:
+    '''
+    [0, items)上的zipfian分布, 0最热(Gray et al., Quickly Generating Billion-Record Synthetic Databases)
+    items增长时zeta增量计算, 插入不用从头重算
+    '''
+
+    def __init__(self, items: int, theta: float = 0.99, rnd=None):
+        self.theta = theta
+        self.rnd = rnd or random.Random()
+        self.items = 0
+        self.zetan = 0.0
+        self.zeta2 = 1 + 0.5 ** theta
+        self.alpha = 1 / (1 - theta)
+        self._grow(items)
+
+    def _grow(self, items):
+        theta = self.theta
+        self.zetan += sum(1 / (i + 1) ** theta for i in range(self.items, items))
+        self.items = items
+        self.eta = (1 - (2 / items) ** (1 - theta)) / (1 - self.zeta2 / self.zetan)
+
+    def next(self, items: int = None) -> int:
+        if items is not None and items > self.items:
+            self._grow(items)
+        u = self.rnd.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < self.zeta2:
+            return 1
+        return int(self.items * (self.eta * u - self.eta + 1) ** self.alpha)
+
+
+class KeyChooser:
+    '''
+    按分布选一个已存在的key编号, inserted是当前已插入的key数(编号0..inserted-1)
+    uniform 均匀; zipfian 热点打散后的zipfian; latest 越新插入的越热
+    '''
+
+    def __init__(self, distribution: str, records: int, rnd):
+        if distribution not in DISTRIBUTIONS:
+            raise Exception("unknown distribution: {}".format(distribution))
+        self.distribution = distribution
+        self.rnd = rnd
+        if distribution != "uniform":
+            self.zipf = ZipfianGenerator(records, rnd=rnd)
+
+    def next(self, inserted: int) -> int:
+        if self.distribution == "uniform":
+            return self.rnd.randrange(inserted)
+        if self.distribution == "latest":
+            return max(0, inserted - 1 - self.zipf.next(inserted))
+        # zipfian的热点是固定的那几个编号, 打散到整个编号空间
+        return fnv64(self.zipf.next()) % inserted
+
+
+class Workload:
+    '''
+    生成一个负载的操作序列: (操作, key编号, 扫描长度)
+    '''
+
+    def __init__(self, name: str, records: int, distribution: str = None, max_scan_length: int = 100,
+                 seed: int = 0):
+        if name not in WORKLOADS:
+            raise Exception("unknown workload: {}".format(name))
+        spec = WORKLOADS[name]
+        self.name = name
+        self.distribution = distribution or spec["distribution"]
+        self.rnd = random.Random(seed)
+        self.records = records
+        self.inserted = records
+        self.max_scan_length = max_scan_length
+        self.chooser = KeyChooser(self.distribution, records, self.rnd)
+        # 累计概率, 按随机数落在哪一段选操作
+        self._ops = []
+        total = 0.0
+        for op in OPERATIONS:
+            if spec.get(op):
+                total += spec[op]
+                self._ops.append((total, op))
+
+    def next(self):
+        u = self.rnd.random()
+        for bound, op in self._ops:
+            if u < bound:
+                break
+        if op == "insert":
+            self.inserted += 1
+            return op, self.inserted - 1, 0
+        length = self.rnd.randint(1, self.max_scan_length) if op == "scan" else 0
+        return op, self.chooser.next(self.inserted), length
@@ -1,7 +1,23 @@
+import itertools
 import json
 import logging
+import mmap
 import os
 import sys
+import threading
+import time
+from bisect import bisect_left
+
+from internal.batch import WriteBatch
+from internal.logWriter import LogWriter
+from internal.metrics import MeteredWrapper, Metrics, prometheus_text
+from internal.record import BinaryCodec, TextCodec, detect_codec
+from internal.recovery import parallel_recover
+from internal.segment import SegmentStore
+from internal.snapshot import Snapshot
+from internal.timerWheel import TimerWheel
+from mapEngine.bloom import BloomWrapper, CountingBloomFilter
+from mapEngine.cache import CachedWrapper
 
 
 class KVTable:
@@ -72,27 +88,231 @@ class KVTableOperator():
     Available Commands: SET set a key to db GET get a key from db UPDATE update key DELETE delete key
     '''
 
-    def __init__(self, source: str = "",engine=None):
+    def __init__(self, source: str = "",engine=None, compact_min_bytes=4 * 1024 * 1024,
+                 compact_garbage_ratio=0.5, durability="flush-every-10-ms", log_format="text",
+                 segment_bytes=None, recovery_workers=1, cache_bytes=None, cache_policy="lru",
+                 expire_interval_ms=100, bloom_error_rate=None, bloom_capacity=None, metrics=False,
+                 slow_op_ms=10, repair=False):
         '''
-        source 本地持久化文件路径
+        source 本地持久化文件路径, 分段存储时是目录
+        log_format 新建日志文件的格式 text / binary, 已有的文件按文件头自动识别
+        segment_bytes 不为None时按这个大小分段存储, 见SegmentStore, 段文件总是二进制格式
+        recovery_workers 大于1时用这么多个进程并行回放二进制日志, 见recovery.py
+        durability 日志持久化级别, 见LogWriter: none / flush-every-N-ms / fsync-per-batch
+        compact_min_bytes 日志超过这个大小才考虑自动压缩, None表示不自动压缩
+        compact_garbage_ratio 日志中失效记录占比超过这个值就触发自动压缩
+        cache_bytes 不为None时在引擎前面加一层这么多字节的读缓存, 磁盘上的引擎(pagedBTreeMap/bitcask)用
+        cache_policy 缓存淘汰策略 lru / arc, 见mapEngine/cache.py
+        expire_interval_ms 后台过期线程推进时间轮的间隔, 到期的key最多晚这么久被回收, get时总是会检查
+        bloom_error_rate 不为None时在引擎前面加一个这个误判率的计数布隆过滤器, 不存在的key不再查引擎,
+            见mapEngine/bloom.py; 关闭时存到source.bloom, 压缩时重建
+        bloom_capacity 布隆过滤器预计的key数, 默认是当前key数的两倍
+        metrics 为True时统计每种操作的次数和延迟分布, 以及引擎读写和日志追加/落盘各自的耗时, 见stats(), metrics_text()
+        slow_op_ms 启用metrics时超过这么多毫秒的操作记进慢操作日志
+        repair 日志中间有校验失败的记录(后面还有完整的记录)时, 默认拒绝打开;
+            为True时从坏记录处截断, 丢掉它后面的所有记录
         '''
         if source == "":
             raise Exception("source can not empty")
         self.source = source
-        if not os.path.exists(self.source):
+        if segment_bytes is None and not os.path.exists(self.source):
             with open(self.source, "w"):
                 pass
-        if not engine:
+        if engine is None:
             raise Exception("engine can not None")
         self.internal_db = engine
-        self._load_source_file()
+        self.compact_min_bytes = compact_min_bytes
+        self.compact_garbage_ratio = compact_garbage_ratio
+        self.recovery_workers = recovery_workers
+        self.repair = repair
+        if log_format == "binary":
+            self._codec = BinaryCodec()
+        elif log_format == "text":
+            self._codec = TextCodec()
+        else:
+            raise Exception("unknown log format: {}".format(log_format))
+        # 日志追加串行化; 引擎没有lock_for时写引擎也用这把锁, get不加锁
+        # 分片引擎先拿分片锁再拿self._lock, 反过来会死锁
+        self._lock = threading.RLock()
+        # 压缩进行中时, 期间追加的记录同时暂存在这里, 换文件前补写到新文件
+        self._compacting = None
+        self._compact_thread = None
+        self._log_records = 0
+        self._log_bytes = 0
+        # 累计写进日志的字节数, 压缩不会让它变小
+        self._log_bytes_written = 0
+        self._writer = None
+        self._segments = None
+        # MVCC, 见snapshot.py: 写序号, 活跃快照的{序号: 个数}, 快照需要的旧值
+        self._seq = itertools.count(1)
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_count = 0
+        self._snapshots = {}
+        self._history = {}
+        # 历史里的key按第一次记进去的顺序, 快照遍历时从这里找到之后新记的key, 不用每次扫整个历史
+        self._history_keys = []
+        # TTL: 带过期时间的key -> 到期时间(毫秒); 时间轮负责主动过期, get时再惰性检查
+        self.expire_interval_ms = expire_interval_ms
+        self._expires = {}
+        self._wheel = TimerWheel(self._now_ms())
+        self._wheel_lock = threading.Lock()
+        self._expirer = None
+        self._expirer_stop = threading.Event()
+        # 为False时引擎里已经是回放的结果, 回放只恢复过期时间和记录数, 见_check_engine_checkpoint
+        self._replay_engine = True
+        # _bulk_load把回放暂存在临时dict里时为True
+        self._staging = False
+        start = time.perf_counter()
+        if segment_bytes is not None:
+            self._segments = SegmentStore(self.source, segment_bytes, durability, repair)
+            self._check_engine_checkpoint()
+            self._bulk_load(lambda: self._segments.load(self._replay))
+            self._log_bytes = self._segments.size()
+        else:
+            self._check_engine_checkpoint()
+            self._bulk_load(self._load_source_file)
+            self._writer = LogWriter(self.source, durability)
+        if not self._replay_engine:
+            now = self._now_ms()
+            for key in [key for key, expire_ms in self._expires.items() if expire_ms <= now]:
+                self._replay_expire(key, self._expires[key])
+            self._replay_engine = True
+        self._replay_seconds = time.perf_counter() - start
+        self._metrics = None
+        if metrics:
+            # 计时层在最里面, 只算真正落到引擎上的读写
+            self._metrics = Metrics(slow_op_ms)
+            self.internal_db = MeteredWrapper(self.internal_db, self._metrics)
+        self._bloom = None
+        self._bloom_capacity = bloom_capacity
+        if bloom_error_rate is not None:
+            self._bloom = BloomWrapper(self.internal_db, bloom_capacity, bloom_error_rate, self._load_bloom(),
+                                       self._engine_lock_all)
+            self.internal_db = self._bloom
+        if cache_bytes is not None:
+            # 回放完再加缓存, 回放的写不用逐个失效
+            self.internal_db = CachedWrapper(self.internal_db, cache_bytes, cache_policy)
+        # 回放时已经到期的key已经删掉了, 剩下的交给时间轮
+        for key, expire_ms in self._expires.items():
+            self._wheel.add(key, expire_ms)
+        if self._expires:
+            self._start_expirer()
+        if self._metrics is not None:
+            self._instrument()
+
+    def _instrument(self):
+        # 在实例上换成计时的版本, 不启用metrics时这些方法不经过任何包装
+        for name in ("get", "set", "update", "delete", "expire"):
+            setattr(self, name, self._metrics.timed(name, getattr(self, name)))
+        for name in ("mget", "mset", "apply_writes"):
+            setattr(self, name, self._metrics.timed(name, getattr(self, name), batch=True))
+        for name, method in (("log_append", "_update_source"), ("log_append", "_update_source_batch"),
+                             ("log_sync", "_sync")):
+            setattr(self, method, self._metrics.timed(name, getattr(self, method), slow_log=False))
+
+    def stats(self) -> dict:
+        '''
+        表的状态: key数, 日志大小/累计写入字节/记录数, 启动时回放用的时间, 引擎自己的统计(树高, 装载因子等);
+        启用metrics时还有每种操作的延迟分布(operations)和最近的慢操作(slow_ops)
+        '''
+        engine = self.internal_db
+        stats = {
+            "keys": len(engine),
+            "log": {
+                "bytes": self._log_bytes,
+                "bytes_written": self._log_bytes_written,
+                "records": self._log_records,
+                "replay_seconds": self._replay_seconds,
+                "compacting": self._compacting is not None,
+            },
+            "expiring_keys": len(self._expires),
+            "snapshots": self._snapshot_count,
+        }
+        if hasattr(engine, "stats"):
+            stats["engine"] = engine.stats()
+        if self._metrics is not None:
+            stats.update(self._metrics.stats())
+        return stats
+
+    def metrics_text(self) -> str:
+        '''
+        Prometheus文本格式的stats(), 延迟是summary, 其余数值是gauge
+        '''
+        gauges = self.stats()
+        gauges.pop("operations", None)
+        gauges.pop("slow_ops", None)
+        return prometheus_text(self._metrics, gauges)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        '''
+        把缓冲区里的日志写完并关闭文件, 会等后台压缩结束
+        '''
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+        self._expirer_stop.set()
+        if self._expirer is not None:
+            self._expirer.join()
+        if self._segments is not None:
+            self._segments.close()
+        else:
+            self._writer.close()
+        if self._bloom is not None:
+            # 日志已经关闭, 记下此时日志的样子, 下次打开时日志没变才能直接用
+            self._bloom.bloom.save(self._bloom_path(), self._log_stamp())
+        if hasattr(self.internal_db, "set_checkpoint"):
+            self.internal_db.set_checkpoint(list(self._log_stamp()))
+        # 自己管理文件的引擎(bitcask, pagedBTreeMap)一起关闭
+        if hasattr(self.internal_db, "close"):
+            self.internal_db.close()
+
+    def _bloom_path(self):
+        return self.source + ".bloom"
+
+    def _log_stamp(self):
+        # (日志总大小, 最后一个日志文件的修改时间), 关闭后有过任何追加或截断都会变; 还没有段文件时返回None
+        if self._segments is not None:
+            segments = self._segments.segments()
+            if not segments:
+                return None
+            path = self._segments._path(segments[-1])
+            return self._segments.size(), os.stat(path).st_mtime_ns
+        return os.path.getsize(self.source), os.stat(self.source).st_mtime_ns
+
+    def _check_engine_checkpoint(self):
+        '''
+        自己持久化的引擎(lsm, bitcask)关闭时记下了日志的样子(set_checkpoint), 之后引擎和日志都没变过时,
+        引擎里已经是回放的结果, 不用再把整个日志写一遍; 否则清空引擎, 整个回放
+        '''
+        engine = self.internal_db
+        if not hasattr(engine, "checkpoint"):
+            return
+        stamp = self._log_stamp()
+        if stamp is not None and engine.checkpoint() == list(stamp):
+            self._replay_engine = False
+        else:
+            engine.clear()
+
+    def _load_bloom(self):
+        '''
+        读回上次关闭时存的布隆过滤器; 之后日志变过(崩溃, 别的进程写过)或key数对不上就返回None, 从引擎重建
+        '''
+        bloom, stamp = CountingBloomFilter.load(self._bloom_path())
+        if bloom is None or stamp != self._log_stamp() or bloom.count != len(self.internal_db):
+            return None
+        return bloom
 
     def __call__(self,key):
         return self.get(key)
 
     def __str__(self):
-        self._load_source_file()
-        return str(self.internal_db)
+        with self.snapshot() as snap:
+            return str(dict(snap.items()))
 
     def help(self):
         return self.__doc__
@@ -102,56 +322,447 @@ class KVTableOperator():
         将source读入internal_db
         '''
         # try:
-        with open(self.source, "r", encoding="utf-8") as e:
-            for i in e:
-                # 去掉两边空白符
-                i = i.strip()
-                # 用空格分隔读出来的字符串返回列表, 0索引为键,1索引为值
-
-                # 方法一
-                methed = i.split()[0]
-                key = i.split()[1]
-                value = i.split()[2]
-                #-------------------------------------------
-                #if methed == "set" or methed == "update":
-                    #self.internal_db[key] = value
-                #elif methed == "delete":
-                    #self.internal_db.pop(key)
-                # ------------------------------------------
-                #todo
-                # 方法二: 基于反射的写法
-                getattr(self, methed)(key, value, False)
+        size = os.path.getsize(self.source)
+        if size == 0:
+            # 新文件, 按log_format写文件头
+            with open(self.source, "wb") as e:
+                e.write(self._codec.header)
+            self._log_bytes = len(self._codec.header)
+            return
+
+        with open(self.source, "rb") as e:
+            with mmap.mmap(e.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                self._codec = detect_codec(buf)
+                if self.recovery_workers <= 1 or self._codec.name != "binary":
+                    for methed, key, value, _ in self._codec.records(buf):
+                        self._replay(methed, key, value)
+                    end = self._codec.end
+
+        if self.recovery_workers > 1 and self._codec.name == "binary":
+            # 并行解码出来的已经是每个key的最终值, 直接装进引擎
+            live, expires, records, end = parallel_recover(self.source, self.recovery_workers)
+            if self._staging:
+                # _bulk_load正在暂存, 并行解码的结果直接当作暂存的dict, 不用再逐个复制一遍
+                self.internal_db = live
+            elif self._replay_engine:
+                for key, value in live.items():
+                    self.internal_db[key] = value
+            self._expires.update(expires)
+            self._log_records = records
+
+        if end < size:
+            with open(self.source, "rb") as e:
+                with mmap.mmap(e.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    torn = self._codec.tail_is_torn(buf, end)
+            if not torn and not self.repair:
+                raise Exception("{}: log is corrupted at byte {} and records after it would be lost, "
+                                "open with repair=True to truncate it there".format(self.source, end))
+            # 崩溃时没写完的最后一条记录, 截掉以免后面的追加接在残缺记录后面
+            logging.warning("%s: drop %d bytes %s", self.source, size - end,
+                            "of torn record" if torn else "after a corrupted record")
+            os.truncate(self.source, end)
+        elif self._codec.name == "text" and self._codec.unterminated:
+            # 最后一行没有换行但是完整, 补上换行, 后面的追加才不会接在这一行上
+            with open(self.source, "ab") as e:
+                e.write(b"\n")
+            end += 1
+        self._log_bytes = end
 
     # except Exception as e:
     # logging.error(str(e))
 
+    def _bulk_load(self, loader):
+        '''
+        引擎支持bulk_load并且是空的时候, 先把回放结果放进一个临时dict解决覆盖和删除,
+        再按key排好序一次装进引擎, 避免逐条插入的分裂和移动
+        排序只排key, 取出value之后先释放临时dict再建引擎, 引擎边读zip边建, 不会同时存在dict和(key, value)元组的列表
+        (分片引擎例外, 它要先按分片分成几个列表)
+        '''
+        engine = self.internal_db
+        if not hasattr(engine, "bulk_load") or len(engine) or not self._replay_engine:
+            loader()
+            return
+        self.internal_db = {}
+        self._staging = True
+        try:
+            loader()
+        finally:
+            staged, self.internal_db = self.internal_db, engine
+            self._staging = False
+        keys = sorted(staged)
+        values = [staged[key] for key in keys]
+        del staged
+        engine.bulk_load(zip(keys, values))
+
+    def bulk_import(self, items):
+        '''
+        导入一批(key, value), 写日志之后按key排序装进引擎
+        '''
+        items = sorted(dict(items).items())
+        with self._engine_lock_all(), self._lock:
+            ticket = None
+            for key, value in items:
+                self._remember(key)
+                self._clear_expiry(key)
+                ticket = self._update_source(key, value, "set")
+            if hasattr(self.internal_db, "bulk_load"):
+                self.internal_db.bulk_load(items)
+            else:
+                for key, value in items:
+                    self.internal_db[key] = value
+        if ticket:
+            self._sync(ticket)
+
+    def _replay(self, methed, key, value):
+        #-------------------------------------------
+        #if methed == "set" or methed == "update":
+            #self.internal_db[key] = value
+        #elif methed == "delete":
+            #self.internal_db.pop(key)
+        # ------------------------------------------
+        #todo
+        # 基于反射的写法
+        if not self._replay_engine:
+            # 引擎里已经是回放的结果, 只恢复过期时间
+            if methed == "expire":
+                self._expires[key] = int(value)
+            else:
+                self._expires.pop(key, None)
+        elif methed == "expire":
+            self._replay_expire(key, int(value))
+        # 分片引擎压缩时快照晚于开始记录_compacting, 日志里可能有删除不存在的key的记录, 跳过
+        elif methed != "delete" or self.internal_db.get(key) is not None:
+            getattr(self, methed)(key, value, callback=False)
+        self._log_records += 1
+
+    def _replay_expire(self, key, expire_ms):
+        # 回放时已经到期的key直接丢掉, 不放进引擎
+        if expire_ms <= self._now_ms():
+            self._expires.pop(key, None)
+            if self.internal_db.get(key) is not None:
+                self.internal_db.pop(key)
+        else:
+            self._expires[key] = expire_ms
+
+    @staticmethod
+    def _now_ms():
+        return int(time.time() * 1000)
+
+    def _set_expiry(self, key, expire_ms):
+        # 调用方持有key的引擎锁
+        self._expires[key] = expire_ms
+        with self._wheel_lock:
+            self._wheel.add(key, expire_ms)
+        self._start_expirer()
+
+    def _clear_expiry(self, key):
+        # 调用方持有key的引擎锁; 时间轮里的定时器不删, 到期时核对发现无效就跳过
+        if self._expires:
+            self._expires.pop(key, None)
+
+    def _is_expired(self, key):
+        expire_ms = self._expires.get(key)
+        return expire_ms is not None and expire_ms <= self._now_ms()
+
+    def _expire_key(self, key, expire_ms):
+        '''
+        删除到期的key, 不写日志: 日志里已经有expire记录, 回放时会丢掉它
+        过期时间在这之间被改过(重新set或expire)就什么都不做
+        '''
+        with self._engine_lock(key):
+            if expire_ms is None or self._expires.get(key) != expire_ms:
+                return
+            self._remember(key)
+            del self._expires[key]
+            if self.internal_db.get(key) is not None:
+                self.internal_db.pop(key)
+
+    def _start_expirer(self):
+        with self._wheel_lock:
+            if self._expirer is None and not self._expirer_stop.is_set():
+                self._expirer = threading.Thread(target=self._expire_loop, daemon=True)
+                self._expirer.start()
+
+    def _expire_loop(self):
+        # 每个到期的key只处理一次, 代价和key总数无关
+        while not self._expirer_stop.wait(self.expire_interval_ms / 1000):
+            with self._wheel_lock:
+                due = self._wheel.advance(self._now_ms())
+            for key, expire_ms in due:
+                self._expire_key(key, expire_ms)
+
+    def expire(self, key: str, ttl: float) -> bool:
+        '''
+        让已存在的key在ttl秒后过期
+        return bool key不存在返回False
+        '''
+        if ttl <= 0:
+            raise Exception("ttl must be positive")
+        with self._engine_lock(key):
+            if self.internal_db.get(key) is None or self._is_expired(key):
+                return False
+            expire_ms = self._now_ms() + int(ttl * 1000)
+            self._set_expiry(key, expire_ms)
+            ticket = self._update_source(key, str(expire_ms), "expire")
+        self._sync(ticket)
+        return True
+
+    def ttl(self, key: str):
+        '''
+        return float 剩余的秒数, key不存在或没有过期时间时返回None
+        '''
+        expire_ms = self._expires.get(key)
+        if expire_ms is None:
+            return None
+        remaining = expire_ms - self._now_ms()
+        return remaining / 1000 if remaining > 0 else None
+
+    def _engine_lock(self, key):
+        '''
+        写key时保护引擎的锁: 分片引擎是key所在分片的锁, 其他引擎是self._lock
+        '''
+        lock_for = getattr(self.internal_db, "lock_for", None)
+        return self._lock if lock_for is None else lock_for(key)
+
+    def _engine_items(self):
+        '''
+        引擎当前内容的列表, 分片引擎逐个分片加锁, 其他引擎在self._lock下复制
+        '''
+        if hasattr(self.internal_db, "lock_for"):
+            return list(self.internal_db.items())
+        with self._lock:
+            return list(self.internal_db.items())
+
+    def _engine_chunk(self, start, limit):
+        '''
+        有序引擎里key不小于start的前limit个(key, value), 只在复制这一段时拿引擎的写锁
+        '''
+        with self._engine_lock_all():
+            return list(self.internal_db.scan(start, None, limit))
+
+    def _remember(self, key, seq=None):
+        '''
+        写key之前调用, 调用方持有key的引擎锁: 拿一个写序号, 有活跃快照时记下旧值
+        必须先拿序号再检查快照数, 和snapshot()里的顺序相反, 见snapshot.py
+        seq 写批次里所有key共用一个序号, 快照要么看到整批要么都看不到
+        '''
+        if seq is None:
+            seq = next(self._seq)
+        if self._snapshot_count:
+            entries = self._history.get(key)
+            if entries is None:
+                entries = self._history[key] = []
+                self._history_keys.append(key)
+            entries.append((seq, self.internal_db.get(key)))
+
+    def snapshot(self) -> Snapshot:
+        '''
+        时间点一致的只读视图, 支持get和items, 不阻塞写
+        用with或release()释放, 没有快照引用的旧值随之回收
+        '''
+        with self._snapshot_lock:
+            # 先登记再拿序号: 序号比快照大的写一定能看到有活跃快照
+            self._snapshot_count += 1
+            seq = next(self._seq)
+            self._snapshots[seq] = self._snapshots.get(seq, 0) + 1
+        return Snapshot(self, seq)
+
+    def _release_snapshot(self, seq):
+        with self._snapshot_lock:
+            self._snapshots[seq] -= 1
+            if not self._snapshots[seq]:
+                del self._snapshots[seq]
+            self._snapshot_count -= 1
+            if not self._snapshots:
+                self._history = {}
+                self._history_keys = []
+                return
+            # 序号不超过最老快照的写对所有快照都可见, 它们的旧值不再需要.
+            # 不拿引擎锁: 写者只在列表末尾追加更大的序号, 这里只原地删掉开头, 读者先复制列表再查
+            oldest = min(self._snapshots)
+            empty = 0
+            for entries in list(self._history.values()):
+                i = bisect_left(entries, (oldest + 1,))
+                if i:
+                    del entries[:i]
+                if not entries:
+                    empty += 1
+            if empty * 2 > len(self._history):
+                # 空列表多了才一次性拿写锁清掉, 摊下来每个key不到一次
+                with self._engine_lock_all():
+                    self._history = {key: entries for key, entries in self._history.items() if entries}
+                    self._history_keys = list(self._history)
+
+    def _engine_lock_all(self):
+        lock_all = getattr(self.internal_db, "lock_all", None)
+        return self._lock if lock_all is None else lock_all()
+
     def _update_source(self, key, value, count):
         '''
-        更新source本地文件
+        更新source本地文件, 只进写缓冲区, 落盘由LogWriter负责
+        调用方持有key的引擎锁, 日志追加在self._lock下串行进行, 所以同一个key的日志顺序和引擎一致
+        return (writer, ticket) 释放锁之后交给self._sync等待
         '''
         # try:
-        with open(self.source, "a", encoding="utf-8") as e:
-            #todo
-            # 不用判断直接拼接就行
-            data = count + " " + key + " " + value + "\n"
-            e.write(data)
+        with self._lock:
+            if self._segments is not None:
+                ticket = self._segments.append(count, key, value)
+                self._log_bytes_written += self._segments.bytes - self._log_bytes
+                self._log_bytes = self._segments.bytes
+            else:
+                data = self._codec.encode(count, key, value)
+                ticket = self._writer, self._writer.append(data)
+                if self._compacting is not None:
+                    self._compacting.append(data)
+                self._log_bytes += len(data)
+                self._log_bytes_written += len(data)
+            self._log_records += 1
+            self._maybe_compact()
+        return ticket
+
+    def _update_source_batch(self, ops):
+        '''
+        把一批写作为一组日志记录(批次头+记录)追加, 见record.py
+        return (writer, ticket)
+        '''
+        with self._lock:
+            if self._segments is not None:
+                ticket = self._segments.append_batch(ops)
+                self._log_bytes_written += self._segments.bytes - self._log_bytes
+                self._log_bytes = self._segments.bytes
+            else:
+                data = self._codec.batch_header(len(ops)) + b"".join(
+                    self._codec.encode(method, key, value) for method, key, value in ops)
+                ticket = self._writer, self._writer.append(data)
+                if self._compacting is not None:
+                    self._compacting.append(data)
+                self._log_bytes += len(data)
+                self._log_bytes_written += len(data)
+            self._log_records += len(ops)
+            self._maybe_compact()
+        return ticket
+
+    @staticmethod
+    def _sync(ticket):
+        writer, n = ticket
+        writer.sync(n)
+
+    def _maybe_compact(self):
+        '''
+        日志足够大且失效记录足够多时, 在后台线程里压缩
+        '''
+        if self.compact_min_bytes is None or self._compacting is not None:
+            return
+        if self._compact_thread is not None and self._compact_thread.is_alive():
+            return
+        if self._log_bytes < self.compact_min_bytes or not self._log_records:
+            return
+        garbage = 1 - len(self.internal_db) / self._log_records
+        if garbage >= self.compact_garbage_ratio:
+            self._compact_thread = threading.Thread(target=self.compact, daemon=True)
+            self._compact_thread.start()
+
+    def compact(self) -> bool:
+        '''
+        把日志重写成只包含当前存活key的set记录, 然后原子替换source
+        重写期间set/get照常进行, 期间的新记录会补写到新文件末尾
+        return bool 已经有压缩在进行时返回False
+        '''
+        sharded = hasattr(self.internal_db, "lock_for")
+        with self._lock:
+            if self._compacting is not None:
+                return False
+            self._compacting = []
+            if not sharded:
+                live = list(self.internal_db.items())
+                expires = dict(self._expires)
+            records = self._log_records
+            if self._segments is not None:
+                sealed = self._segments.seal()
+        if sharded:
+            # 持有self._lock时不能再拿分片锁; 开始记录_compacting之后才取快照,
+            # 快照之后的写都在_compacting或更新的段里, 重复的记录回放结果不变
+            live = list(self.internal_db.items())
+            expires = dict(self._expires)
+        # 只保留快照里还在的key的过期时间
+        expires = {key: expires[key] for key, _ in live if key in expires}
+
+        if self._segments is not None:
+            try:
+                self._segments.compact(live, sealed, expires)
+                with self._lock:
+                    self._segments.bytes = self._segments.size()
+                    self._log_bytes = self._segments.bytes
+                    self._log_records = len(live) + self._log_records - records
+            finally:
+                with self._lock:
+                    self._compacting = None
+            if self._bloom is not None:
+                self._bloom.rebuild(self._bloom_capacity)
+            return True
+
+        tmp = self.source + ".compact"
+        try:
+            with open(tmp, "wb") as e:
+                e.write(self._codec.header)
+                for key, value in live:
+                    e.write(self._codec.encode("set", key, value))
+                for key, expire_ms in expires.items():
+                    e.write(self._codec.encode("expire", key, str(expire_ms)))
+                e.flush()
+                os.fsync(e.fileno())
+
+            with self._lock:
+                self._writer.flush()
+                with open(tmp, "ab") as e:
+                    e.writelines(self._compacting)
+                    e.flush()
+                    os.fsync(e.fileno())
+                os.replace(tmp, self.source)
+                self._writer.reopen()
+                self._log_records = len(live) + len(self._compacting)
+                self._log_bytes = os.path.getsize(self.source)
+        finally:
+            with self._lock:
+                # 失败时清理临时文件, 必须在释放_compacting之前, 以免删掉下一次压缩的文件
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                self._compacting = None
+        if self._bloom is not None:
+            # 清掉删除留下的计数和饱和的计数器, 按现在的key数重新定大小
+            self._bloom.rebuild(self._bloom_capacity)
+        return True
 
     # except Exception:
     # 	raise Exception("update error")
 
-    def set(self, key: str, value: str,callback=True) -> bool:
+    def set(self, key: str, value: str,callback=True, ttl: float = None) -> bool:
         '''
         将k-v写入字典并更新本地文件source
+        ttl 不为None时key在ttl秒后过期, set记录和expire记录作为一个批次写进日志; 不带ttl的set清掉原来的过期时间
         return bool 成功就返回True，失败就返回False
         '''
 
         # try:
-        self.internal_db[key] = value
-        #todo
-        # 教你一个比较装逼的写法，避免代码hardcode
-        # sys._getframe().f_code.co_name可以获取当前的方法名，也就是"set"
-        if callback:
-            self._update_source(key, value, sys._getframe().f_code.co_name)
+        if ttl is not None and ttl <= 0:
+            raise Exception("ttl must be positive")
+        ticket = None
+        with self._engine_lock(key):
+            self._remember(key)
+            self.internal_db[key] = value
+            self._clear_expiry(key)
+            if ttl is not None:
+                expire_ms = self._now_ms() + int(ttl * 1000)
+                self._set_expiry(key, expire_ms)
+            #todo
+            # 教你一个比较装逼的写法，避免代码hardcode
+            # sys._getframe().f_code.co_name可以获取当前的方法名，也就是"set"
+            if callback and ttl is not None:
+                ticket = self._update_source_batch([("set", key, value), ("expire", key, str(expire_ms))])
+            elif callback:
+                ticket = self._update_source(key, value, sys._getframe().f_code.co_name)
+        if ticket:
+            self._sync(ticket)
 
 
     def get(self, key: str) -> str:
@@ -159,8 +770,28 @@ class KVTableOperator():
         获取key
         return str 返回获取到的value，没有就抛出异常
         '''
+        if self._expires and self._is_expired(key):
+            # 惰性过期: 时间轮还没处理到的也不会被读到
+            self._expire_key(key, self._expires.get(key))
+            raise KeyError(key)
         return self.internal_db[key]
 
+    def scan(self, start: str = None, end: str = None, limit: int = None, reverse: bool = False):
+        '''
+        按key顺序惰性遍历[start, end)里的(key, value), 需要有序引擎(bTreeMap/binarySearchMap等)
+        '''
+        if isinstance(self.internal_db, dict):
+            raise Exception("dict engine is not ordered, scan is not supported")
+        return self.internal_db.scan(start, end, limit, reverse)
+
+    def prefix_scan(self, prefix: str, limit: int = None, reverse: bool = False):
+        '''
+        按key顺序惰性遍历以prefix开头的(key, value)
+        '''
+        if isinstance(self.internal_db, dict):
+            raise Exception("dict engine is not ordered, scan is not supported")
+        return self.internal_db.prefix_scan(prefix, limit, reverse)
+
     def update(self, key: str, value: str,callback=True) -> bool:
         '''
         更新key的value，并更新source文件
@@ -168,9 +799,15 @@ class KVTableOperator():
         '''
 
         try:
-            self.internal_db[key] = value
-            if callback:
-                self._update_source(key, value, sys._getframe().f_code.co_name)
+            ticket = None
+            with self._engine_lock(key):
+                self._remember(key)
+                self.internal_db[key] = value
+                self._clear_expiry(key)
+                if callback:
+                    ticket = self._update_source(key, value, sys._getframe().f_code.co_name)
+            if ticket:
+                self._sync(ticket)
         except:
             return False
         return True
@@ -181,12 +818,119 @@ class KVTableOperator():
         return bool 成功就返回True，失败就返回False
         '''
         # try:
+        ticket = None
+        with self._engine_lock(key):
+            value = self.internal_db[key]
+            self._remember(key)
+            if value:
+                self.internal_db.pop(key)
+            self._clear_expiry(key)
+            if callback:
+                ticket = self._update_source(key, value, sys._getframe().f_code.co_name)
+        if ticket:
+            self._sync(ticket)
+
+    def write_batch(self) -> WriteBatch:
+        '''
+        原子写批次, 见batch.py
+        '''
+        return WriteBatch(self)
 
-        value = self.internal_db[key]
-        if value:
-            self.internal_db.pop(key)
-        if callback:
-            self._update_source(key, value, sys._getframe().f_code.co_name)
+    def _commit_batch(self, ops) -> list:
+        '''
+        WriteBatch.commit调用: 拿到所有相关的引擎锁, 先写一组日志记录, 再改引擎
+        '''
+        for method, _, _ in ops:
+            if method not in ("set", "update", "delete"):
+                raise Exception("unknown write method: {}".format(method))
+        results = []
+        ticket = None
+        with self._engine_lock_all():
+            # 按顺序推演出每个删除是否生效, 日志里的删除记录带着被删的值, 和delete()一致
+            # 已经到期的key和get/mget一样算不存在, 留给时间轮(或下一次读)删掉
+            effective = []
+            pending = {}
+            for method, key, value in ops:
+                if method == "delete":
+                    if key in pending:
+                        value = pending[key]
+                    elif self._expires and self._is_expired(key):
+                        value = None
+                    else:
+                        value = self.internal_db.get(key)
+                    if value is None:
+                        results.append(False)
+                        continue
+                    pending[key] = None
+                else:
+                    pending[key] = value
+                effective.append((method, key, value))
+                results.append(True)
+            if not effective:
+                return results
+            ticket = self._update_source_batch(effective)
+
+            seq = next(self._seq)
+            for key in pending:
+                self._remember(key, seq)
+                self._clear_expiry(key)
+            engine = self.internal_db
+            run = []
+            for method, key, value in effective:
+                if method != "delete":
+                    run.append((key, value))
+                    continue
+                self._apply_sets(run)
+                run = []
+                engine.pop(key)
+            self._apply_sets(run)
+        self._sync(ticket)
+        return results
+
+    def _apply_sets(self, items):
+        # 连续的一段set交给引擎的mset, 引擎可以按排好序的批量合并
+        if not items:
+            return
+        engine = self.internal_db
+        if hasattr(engine, "mset"):
+            engine.mset(items)
+        else:
+            for key, value in items:
+                engine[key] = value
+
+    def mget(self, keys) -> list:
+        '''
+        一次取多个key, 返回和keys一一对应的value列表, 不存在的是None
+        引擎实现了mget时用引擎的, 比如有序引擎按排好序的key一趟查完
+        '''
+        engine = self.internal_db
+        if hasattr(engine, "mget"):
+            values = engine.mget(keys)
+        else:
+            values = [engine.get(key) for key in keys]
+        if self._expires:
+            for j, key in enumerate(keys):
+                if values[j] is not None and self._is_expired(key):
+                    self._expire_key(key, self._expires.get(key))
+                    values[j] = None
+        return values
+
+    def mset(self, items):
+        '''
+        一次写多个(key, value), 整体是一个原子写批次
+        '''
+        with self.write_batch() as batch:
+            for key, value in items:
+                batch.set(key, value)
+
+    def apply_writes(self, ops) -> list:
+        '''
+        执行一批写[(method, key, value)], method是set/update/delete(delete的value忽略)
+        整批作为一组日志记录追加, 只等一次落盘, 网络服务端用它处理管道(pipeline)里连续的写;
+        和写批次一样是原子的
+        return list 每个写是否生效, 删除不存在的key为False
+        '''
+        return self._commit_batch(ops)
 
     def valid_cammand(self, cammand: str):
         try:
@@ -0,0 +1,51 @@
+class WriteBatch:
+    '''
+    KVTableOperator.write_batch()返回的写批次, 先攒写, 提交时整批一起生效
+
+    with table.write_batch() as batch:
+        batch.set("a", "1")
+        batch.delete("b")
+
+    正常退出with时提交, with里抛了异常整批丢弃; 也可以不用with直接调用commit()
+    提交时整批写成一组日志记录(批次头+记录), 回放时要么全部生效要么都不生效,
+    对快照也是原子的: 快照要么看到整批, 要么一条都看不到
+    '''
+
+    def __init__(self, table):
+        self._table = table
+        self.ops = []
+        self._committed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and not self._committed:
+            self.commit()
+
+    def __len__(self):
+        return len(self.ops)
+
+    def set(self, key: str, value: str):
+        self.ops.append(("set", key, value))
+        return self
+
+    def update(self, key: str, value: str):
+        self.ops.append(("update", key, value))
+        return self
+
+    def delete(self, key: str):
+        '''
+        删除不存在的key不报错, 提交时跳过
+        '''
+        self.ops.append(("delete", key, None))
+        return self
+
+    def commit(self) -> list:
+        '''
+        return list 每个写是否生效, 删除不存在的key为False
+        '''
+        if self._committed:
+            raise Exception("write batch is already committed")
+        self._committed = True
+        return self._table._commit_batch(self.ops)
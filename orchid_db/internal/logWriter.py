@@ -0,0 +1,149 @@
+import atexit
+import os
+import re
+import threading
+
+DURABILITY_NONE = "none"
+DURABILITY_FSYNC = "fsync-per-batch"
+_FLUSH_EVERY = re.compile(r"^flush-every-(\d+)-ms$")
+
+
+class LogWriter:
+    '''
+    长期持有日志文件句柄的写入器, 写入先进内存缓冲区, 由后台线程组提交(group commit)
+
+    durability 决定一次append返回时数据落到了哪里, 吞吐和安全性此消彼长:
+    none              只写进进程内缓冲区, 缓冲区满或close时才写文件, 吞吐最高,
+                      进程崩溃会丢掉缓冲区里所有的写
+    flush-every-N-ms  后台线程每N毫秒把缓冲区write+flush给操作系统, 进程崩溃最多丢N毫秒的写,
+                      机器掉电还会丢页缓存里没落盘的数据
+    fsync-per-batch   sync(ticket)阻塞到所在批次fsync完成, 掉电也不丢;
+                      同一时刻等待的写者共享一次fsync, 并发越高摊得越薄
+    '''
+
+    def __init__(self, path: str, durability: str = "flush-every-10-ms", buffer_size: int = 64 * 1024):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.interval = None
+        if durability == DURABILITY_NONE or durability == DURABILITY_FSYNC:
+            pass
+        elif _FLUSH_EVERY.match(durability):
+            self.interval = int(_FLUSH_EVERY.match(durability).group(1)) / 1000
+        else:
+            raise Exception("unknown durability: {}".format(durability))
+        self.durability = durability
+
+        self._file = open(self.path, "ab")
+        # _io_lock保证批次按顺序写进文件, 先拿_io_lock再拿_cond
+        self._io_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._buf = []
+        self._buf_bytes = 0
+        # 已经append的序号, 和已经写出(fsync模式下是已经fsync)的序号
+        self._appended = 0
+        self._written = 0
+        self._closed = False
+        self._flusher = None
+        if durability != DURABILITY_NONE:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+        atexit.register(self.close)
+
+    def append(self, data: bytes) -> int:
+        '''
+        把data放进缓冲区, 不阻塞
+        return int 这次写入的序号, 交给sync等待落盘
+        '''
+        with self._cond:
+            if self._closed:
+                raise Exception("log writer is closed")
+            self._buf.append(data)
+            self._buf_bytes += len(data)
+            self._appended += 1
+            ticket = self._appended
+            if self._flusher is None:
+                if self._buf_bytes >= self.buffer_size:
+                    self._write_out(fsync=False)
+            elif self.durability == DURABILITY_FSYNC or self._buf_bytes >= self.buffer_size:
+                self._cond.notify_all()
+        return ticket
+
+    def sync(self, ticket: int):
+        '''
+        fsync-per-batch模式下阻塞到ticket所在批次fsync完成, 其他模式直接返回
+        调用方不要在持有自己的锁时调用, 否则并发写者凑不成一批
+        '''
+        if self.durability != DURABILITY_FSYNC:
+            return
+        with self._cond:
+            while self._written < ticket and not self._closed:
+                self._cond.wait()
+
+    def flush(self, fsync: bool = False):
+        '''
+        立即把缓冲区写给操作系统, 压缩换文件和close之前调用
+        '''
+        with self._io_lock, self._cond:
+            self._write_out(fsync)
+            self._cond.notify_all()
+
+    def reopen(self):
+        '''
+        source被原子替换之后重新打开文件句柄
+        '''
+        with self._io_lock, self._cond:
+            self._write_out(fsync=False)
+            self._file.close()
+            self._file = open(self.path, "ab")
+
+    def close(self):
+        with self._io_lock, self._cond:
+            if self._closed:
+                return
+            self._write_out(fsync=self.durability == DURABILITY_FSYNC)
+            self._closed = True
+            self._cond.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+        self._file.close()
+        atexit.unregister(self.close)
+
+    def _write_out(self, fsync: bool):
+        # 调用方持有self._cond
+        if self._buf:
+            self._file.write(b"".join(self._buf))
+            self._buf = []
+            self._buf_bytes = 0
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        if fsync or self.durability != DURABILITY_FSYNC:
+            self._written = self._appended
+
+    def _pending(self):
+        return self._buf or self._written < self._appended
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                if not self._pending() and not self._closed:
+                    self._cond.wait(self.interval)
+                if self._closed:
+                    return
+                if not self._pending():
+                    continue
+            with self._io_lock:
+                with self._cond:
+                    data = b"".join(self._buf)
+                    ticket = self._appended
+                    self._buf = []
+                    self._buf_bytes = 0
+                # 在_cond外做IO, 这段时间新来的写攒成下一批
+                if data:
+                    self._file.write(data)
+                    self._file.flush()
+                if self.durability == DURABILITY_FSYNC:
+                    os.fsync(self._file.fileno())
+            with self._cond:
+                self._written = max(self._written, ticket)
+                self._cond.notify_all()
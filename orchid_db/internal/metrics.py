@@ -0,0 +1,301 @@
+'''
+KVTableOperator的可选指标: 每种操作的计数和延迟直方图, 慢操作日志, 以及Prometheus文本格式的导出
+
+KVTableOperator(metrics=True)时才启用: 被统计的方法在实例上换成计时的版本, 引擎外面包一层计时的MeteredWrapper;
+不启用时什么都不换, 没有额外开销
+'''
+
+import logging
+import threading
+import time
+from collections import deque
+
+from mapEngine.base import BaseMapWrapper
+
+# 每个2的幂区间分成2**(_SUB_BITS-1)个子桶, 相对误差不超过1/64
+_SUB_BITS = 7
+_SUB_COUNT = 1 << _SUB_BITS
+_SUB_HALF = _SUB_COUNT >> 1
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class LatencyHistogram:
+    '''
+    HDR风格的对数-线性直方图, 值是纳秒整数
+    小于128的值每个值一个桶; 再往上每个2的幂区间64个桶, 所以分位数的相对误差在2%以内,
+    桶数和记录次数无关, 记录一次是常数时间
+    '''
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def _index(value):
+        if value < _SUB_COUNT:
+            return value
+        shift = value.bit_length() - _SUB_BITS
+        return _SUB_COUNT + (shift - 1) * _SUB_HALF + (value >> shift) - _SUB_HALF
+
+    @staticmethod
+    def _upper(index):
+        # 桶里的最大值
+        if index < _SUB_COUNT:
+            return index
+        shift, sub = divmod(index - _SUB_COUNT, _SUB_HALF)
+        shift += 1
+        return ((sub + _SUB_HALF + 1) << shift) - 1
+
+    def record(self, value: int):
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> int:
+        '''
+        return int 不小于q比例的记录的最小值(按桶的上界, 不超过记录过的最大值)
+        '''
+        if not self.count:
+            return 0
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        '''
+        return dict 次数, 平均, 各分位数和最大值, 单位微秒
+        '''
+        out = {"count": self.count, "mean_us": self.total / self.count / 1000 if self.count else 0.0}
+        for q in QUANTILES:
+            out["p{}_us".format(_quantile_name(q))] = self.percentile(q) / 1000
+        out["max_us"] = self.max / 1000
+        return out
+
+
+def _quantile_name(q):
+    # 0.5 -> 50, 0.999 -> 999
+    return "{:g}".format(q * 100).replace(".", "")
+
+
+class Metrics:
+    '''
+    按名字分组的延迟直方图, 未命中(KeyError)和错误计数, 以及超过slow_op_ms的慢操作(最近slow_log_size条)
+    '''
+
+    def __init__(self, slow_op_ms: float = 10, slow_log_size: int = 128):
+        self.slow_op_ns = int(slow_op_ms * 1000000)
+        self.histograms = {}
+        self.errors = {}
+        self.misses = {}
+        self.slow_ops = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, elapsed_ns: int, key=None, outcome=None, batch=None):
+        '''
+        outcome 为"miss"或"error"时计入对应的计数, 耗时照常记录
+        batch 批量操作的条数, 慢操作日志里记它而不是key
+        '''
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(elapsed_ns)
+            if outcome is not None:
+                counter = self.misses if outcome == "miss" else self.errors
+                counter[name] = counter.get(name, 0) + 1
+        if elapsed_ns < self.slow_op_ns:
+            return
+        if batch is not None:
+            entry = {"op": name, "batch": batch, "ms": elapsed_ns / 1000000, "time": time.time()}
+            self.slow_ops.append(entry)
+            logging.warning("slow %s of %d items took %.3f ms", name, batch, entry["ms"])
+        elif key is not None:
+            entry = {"op": name, "key": key, "ms": elapsed_ns / 1000000, "time": time.time()}
+            self.slow_ops.append(entry)
+            logging.warning("slow %s %r took %.3f ms", name, key, entry["ms"])
+
+    def timed(self, name: str, func, slow_log=True, batch=False):
+        '''
+        返回计时版本的func, slow_log为True时第一个参数当作key记进慢操作日志
+        batch为True时第一个参数是一批key或写(mget/mset/apply_writes), 慢操作日志只记条数;
+        不知道长度的(生成器)不记
+        抛出KeyError算作未命中, 其他异常算作错误, 都照常抛出
+        '''
+        clock = time.perf_counter_ns
+
+        def wrapper(*args, **kwargs):
+            key = size = None
+            if slow_log and args:
+                if not batch:
+                    key = args[0]
+                elif hasattr(args[0], "__len__"):
+                    size = len(args[0])
+            start = clock()
+            try:
+                result = func(*args, **kwargs)
+            except KeyError:
+                self.observe(name, clock() - start, key, "miss", size)
+                raise
+            except BaseException:
+                self.observe(name, clock() - start, key, "error", size)
+                raise
+            self.observe(name, clock() - start, key, batch=size)
+            return result
+
+        wrapper.__wrapped__ = func
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def stats(self) -> dict:
+        with self._lock:
+            operations = {}
+            for name, histogram in sorted(self.histograms.items()):
+                summary = histogram.summary()
+                summary["misses"] = self.misses.get(name, 0)
+                summary["errors"] = self.errors.get(name, 0)
+                operations[name] = summary
+        return {"operations": operations, "slow_ops": list(self.slow_ops)}
+
+    def histogram_snapshot(self):
+        # (名字, 分位数列表, 总和ns, 次数, 未命中数, 错误数), 给导出用
+        with self._lock:
+            return [(name, [(q, h.percentile(q)) for q in QUANTILES], h.total, h.count,
+                     self.misses.get(name, 0), self.errors.get(name, 0))
+                    for name, h in sorted(self.histograms.items())]
+
+
+class MeteredWrapper(BaseMapWrapper):
+    '''
+    给引擎的读写计时, 名字是engine_get / engine_set / engine_delete, 和KVTableOperator的总耗时对比,
+    剩下的就是日志编码追加和等落盘的时间; 其他属性透传给引擎
+    '''
+
+    def __init__(self, engine, metrics: Metrics):
+        self.engine = engine
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        # 只在本对象上找不到时调用, 透传给引擎
+        return getattr(self.engine, name)
+
+    def _observe(self, name, start):
+        self.metrics.observe(name, time.perf_counter_ns() - start)
+
+    def __setitem__(self, key, value):
+        start = time.perf_counter_ns()
+        self.engine[key] = value
+        self._observe("engine_set", start)
+
+    def get(self, key):
+        start = time.perf_counter_ns()
+        value = self.engine.get(key)
+        self._observe("engine_get", start)
+        return value
+
+    def mget(self, keys):
+        start = time.perf_counter_ns()
+        engine = self.engine
+        values = engine.mget(keys) if hasattr(engine, "mget") else [engine.get(key) for key in keys]
+        self._observe("engine_mget", start)
+        return values
+
+    def _del(self, key):
+        start = time.perf_counter_ns()
+        try:
+            del self.engine[key]
+        finally:
+            self._observe("engine_delete", start)
+
+    def mset(self, items):
+        start = time.perf_counter_ns()
+        engine = self.engine
+        if hasattr(engine, "mset"):
+            engine.mset(items)
+        else:
+            for key, value in items:
+                engine[key] = value
+        self._observe("engine_mset", start)
+
+    def bulk_load(self, items):
+        if not hasattr(self.engine, "bulk_load"):
+            return self.mset(items)
+        start = time.perf_counter_ns()
+        self.engine.bulk_load(items)
+        self._observe("engine_bulk_load", start)
+
+    def __len__(self):
+        return len(self.engine)
+
+    def items(self):
+        return self.engine.items()
+
+    @property
+    def ordered(self) -> bool:
+        return hasattr(self.engine, "scan") and getattr(self.engine, "ordered", True)
+
+    def _scan(self, start, end, reverse):
+        if not hasattr(self.engine, "scan"):
+            raise Exception("this engine is not ordered, scan is not supported")
+        return self.engine.scan(start, end, None, reverse)
+
+    def stats(self) -> dict:
+        if hasattr(self.engine, "stats"):
+            return self.engine.stats()
+        return {"keys": len(self.engine)}
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _gauges(prefix, stats, out):
+    # 嵌套的dict展开成下划线连接的名字, 只导出数值
+    for name, value in stats.items():
+        name = "{}_{}".format(prefix, name)
+        if isinstance(value, dict):
+            _gauges(name, value, out)
+        elif isinstance(value, bool):
+            out.append((name, int(value)))
+        elif isinstance(value, (int, float)):
+            out.append((name, value))
+
+
+def prometheus_text(metrics, gauges: dict, prefix: str = "orchid") -> str:
+    '''
+    Prometheus文本格式: 每种操作一个summary(秒), 错误数是counter, gauges里的数值(可以嵌套)是gauge
+    metrics 为None时只导出gauges
+    '''
+    lines = []
+    if metrics is not None:
+        name = prefix + "_operation_duration_seconds"
+        lines.append("# HELP {} Latency of table and engine operations.".format(name))
+        lines.append("# TYPE {} summary".format(name))
+        snapshot = metrics.histogram_snapshot()
+        for op, quantiles, total, count, _, _ in snapshot:
+            for q, value in quantiles:
+                lines.append('{}{{op="{}",quantile="{:g}"}} {:.9g}'.format(name, _label(op), q, value / 1e9))
+            lines.append('{}_sum{{op="{}"}} {:.9g}'.format(name, _label(op), total / 1e9))
+            lines.append('{}_count{{op="{}"}} {}'.format(name, _label(op), count))
+        for counter, column, text in (("misses", 4, "Operations that raised KeyError."),
+                                      ("errors", 5, "Operations that raised any other error.")):
+            counter_name = "{}_operation_{}_total".format(prefix, counter)
+            lines.append("# HELP {} {}".format(counter_name, text))
+            lines.append("# TYPE {} counter".format(counter_name))
+            for row in snapshot:
+                lines.append('{}{{op="{}"}} {}'.format(counter_name, _label(row[0]), row[column]))
+    flat = []
+    _gauges(prefix, gauges, flat)
+    for name, value in flat:
+        lines.append("# TYPE {} gauge".format(name))
+        lines.append("{} {:.9g}".format(name, value) if isinstance(value, float) else "{} {}".format(name, value))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,279 @@
+'''
+日志记录格式
+
+文本格式(老格式): 每行 "method key value\n", key和value里不能有空白符;
+没有换行结尾的最后一行能解析就照常回放, 解析不了才当作残缺记录
+
+二进制格式: 文件以MAGIC开头, 后面是一条条记录
+    crc32   4字节小端, 校验后面从op到value结尾的所有字节
+    op      1字节, 见OPS
+    klen    varint
+    vlen    varint
+    key     klen字节, utf-8
+    value   vlen字节, utf-8
+崩溃时写了一半的最后一条记录会因为长度不够或crc不对被识别出来, 回放在那里停下;
+停下的地方后面还有完整的记录时是文件中间坏了, 不是崩溃留下的尾部, 见tail_is_torn
+
+批次(write_batch): 先写一条批次头, 后面紧跟属于这个批次的count条记录
+    二进制: op为OP_BATCH, key为空, value是count的varint
+    文本:   "batch count\n"
+records()只有在整批记录都完整时才把它们交出来, 残缺的批次整个丢掉, 所以回放时一批要么全部生效要么都不生效
+'''
+
+import struct
+import sys
+import zlib
+
+MAGIC = b"ORCHIDB\x01"
+
+OP_SET = 1
+OP_UPDATE = 2
+OP_DELETE = 3
+OP_BATCH = 4
+# 过期时间, value是到期的unix时间戳(毫秒); 之后对这个key的set/update/delete会清掉它
+OP_EXPIRE = 5
+
+OPS = {"set": OP_SET, "update": OP_UPDATE, "delete": OP_DELETE, "expire": OP_EXPIRE}
+OP_NAMES = {v: k for k, v in OPS.items()}
+OP_NAMES[OP_BATCH] = "batch"
+
+_CRC = struct.Struct("<I")
+
+
+def encode_varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_varint(buf, pos: int):
+    '''
+    return (值, 下一个位置), 越界时抛IndexError
+    '''
+    b = buf[pos]
+    if b < 0x80:
+        return b, pos + 1
+    result = b & 0x7F
+    shift = 7
+    while True:
+        pos += 1
+        b = buf[pos]
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos + 1
+        shift += 7
+
+
+def encode_record(op: int, key: bytes, value: bytes) -> bytes:
+    body = bytes((op,)) + encode_varint(len(key)) + encode_varint(len(value)) + key + value
+    return _CRC.pack(zlib.crc32(body)) + body
+
+
+def decode_record(buf, pos: int):
+    '''
+    解码pos处的一条记录
+    return (op, key, value, 下一条的位置), key和value是memoryview切片;
+           记录不完整或者校验失败时返回None
+    '''
+    n = len(buf)
+    try:
+        body = pos + 4
+        op = buf[body]
+        klen, p = decode_varint(buf, body + 1)
+        vlen, p = decode_varint(buf, p)
+    except IndexError:
+        return None
+    end = p + klen + vlen
+    if end > n or op not in OP_NAMES:
+        return None
+    if _CRC.unpack_from(buf, pos)[0] != zlib.crc32(buf[body:end]):
+        return None
+    return op, buf[p:p + klen], buf[p + klen:end], end
+
+
+def find_record(buf, pos: int) -> int:
+    '''
+    从pos开始逐字节找第一条能完整解码并通过校验的记录
+    return 它的位置, 没有返回-1
+    '''
+    for p in range(pos, len(buf)):
+        if decode_record(buf, p) is not None:
+            return p
+    return -1
+
+
+class BinaryCodec:
+    name = "binary"
+    header = MAGIC
+
+    def encode(self, method: str, key: str, value: str) -> bytes:
+        return encode_record(OPS[method], key.encode("utf-8"), value.encode("utf-8"))
+
+    def batch_header(self, count: int) -> bytes:
+        return encode_record(OP_BATCH, b"", encode_varint(count))
+
+    def records(self, buf):
+        '''
+        逐条解码buf(bytes/mmap), 生成(method, key, value, 这条记录的起点), 批次头不生成
+        批次整批完整才生成, 这时self.end已经在批次结尾, 所以每条记录的位置要用生成的起点
+        遍历结束后self.end是最后一条完整记录(或完整批次)的结尾, 小于len(buf)说明尾部有残缺记录
+        '''
+        mv = memoryview(buf)
+        pos = len(MAGIC)
+        self.end = pos
+        while pos < len(mv):
+            start = pos
+            record = decode_record(mv, pos)
+            if record is None:
+                break
+            op, key, value, pos = record
+            if op == OP_BATCH:
+                batch, pos = self._batch(mv, value, pos)
+                if batch is None:
+                    break
+                self.end = pos
+                yield from batch
+                continue
+            self.end = pos
+            yield OP_NAMES[op], str(key, "utf-8"), str(value, "utf-8"), start
+        mv.release()
+
+    @staticmethod
+    def _batch(mv, count, pos):
+        # 解码批次头后面的count条记录, 不完整时返回(None, pos)
+        try:
+            count = decode_varint(count, 0)[0]
+        except IndexError:
+            return None, pos
+        batch = []
+        for _ in range(count):
+            start = pos
+            record = decode_record(mv, pos)
+            if record is None or record[0] == OP_BATCH:
+                return None, pos
+            op, key, value, pos = record
+            batch.append((OP_NAMES[op], str(key, "utf-8"), str(value, "utf-8"), start))
+        return batch, pos
+
+    @staticmethod
+    def tail_is_torn(buf, end) -> bool:
+        '''
+        records()在end处停下之后调用: 后面只是崩溃时没写完的记录返回True,
+        文件中间坏了(坏记录后面还有完整的记录)返回False
+        '''
+        pos = end
+        record = decode_record(buf, pos)
+        if record is not None and record[0] == OP_BATCH:
+            # 批次头是好的, 坏的是批次里的某一条
+            pos = record[3]
+            record = decode_record(buf, pos)
+            while record is not None and record[0] != OP_BATCH:
+                pos = record[3]
+                record = decode_record(buf, pos)
+        return find_record(buf, pos + 1) < 0
+
+
+class TextCodec:
+    name = "text"
+    header = b""
+
+    def encode(self, method: str, key: str, value: str) -> bytes:
+        return (method + " " + key + " " + value + "\n").encode("utf-8")
+
+    def batch_header(self, count: int) -> bytes:
+        return "batch {}\n".format(count).encode("utf-8")
+
+    def records(self, buf):
+        '''
+        同BinaryCodec.records; 没有换行结尾的最后一行能解析就照常生成, 这时self.unterminated为True,
+        追加之前要先补一个换行
+        '''
+        self.end = 0
+        self.unterminated = False
+        data = bytes(buf)
+        lines = self._lines(data)
+        for fields, start, pos in lines:
+            if fields is None:
+                return
+            if fields[0] == "batch":
+                batch = []
+                for _ in range(int(fields[1])):
+                    record = next(lines, None)
+                    if record is None or record[0] is None:
+                        return
+                    fields, start, pos = record
+                    batch.append((fields[0], fields[1], fields[2], start))
+                self.end = pos
+                self.unterminated = data[pos - 1:pos] != b"\n"
+                yield from batch
+                continue
+            self.end = pos
+            self.unterminated = data[pos - 1:pos] != b"\n"
+            yield fields[0], fields[1], fields[2], start
+
+    @staticmethod
+    def tail_is_torn(buf, end) -> bool:
+        # 文本没有校验, records()只会在最后一行或者最后一个批次停下
+        return True
+
+    @staticmethod
+    def _lines(data):
+        # 生成(非空行的字段, 行首, 行尾之后的位置), 空行只推进位置; 最后一行没有换行时解析不了就生成(None, 行首, 结尾)
+        pos = 0
+        while pos < len(data):
+            nl = data.find(b"\n", pos)
+            if nl < 0:
+                try:
+                    fields = data[pos:].decode("utf-8").split()
+                except UnicodeDecodeError:
+                    fields = None
+                if fields and not TextCodec._parses(fields):
+                    fields = None
+                if fields != []:
+                    yield fields, pos, len(data)
+                return
+            fields = data[pos:nl].decode("utf-8").split()
+            start, pos = pos, nl + 1
+            if fields:
+                yield fields, start, pos
+
+    @staticmethod
+    def _parses(fields):
+        if fields[0] == "batch":
+            return len(fields) == 2 and fields[1].isdigit()
+        return len(fields) == 3 and fields[0] in OPS
+
+
+def detect_codec(buf):
+    '''
+    根据文件开头判断格式
+    '''
+    if bytes(buf[:len(MAGIC)]) == MAGIC:
+        return BinaryCodec()
+    return TextCodec()
+
+
+def convert_text_to_binary(src: str, dst: str) -> int:
+    '''
+    把老的文本格式.db文件转换成二进制格式
+    return int 转换的记录条数
+    '''
+    text = TextCodec()
+    binary = BinaryCodec()
+    count = 0
+    with open(src, "rb") as e:
+        data = e.read()
+    with open(dst, "wb") as out:
+        out.write(binary.header)
+        for method, key, value, _ in text.records(data):
+            out.write(binary.encode(method, key, value))
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    # python -m internal.record old.db new.db
+    print(convert_text_to_binary(sys.argv[1], sys.argv[2]))
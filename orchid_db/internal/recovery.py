@@ -0,0 +1,140 @@
+'''
+并行崩溃恢复
+
+把二进制日志按字节切成workers段交给进程池, 每个进程从自己的起点向后找到第一条能通过crc校验,
+并且下一条也能接上的记录作为边界, 解码起点落在[start, end)里的所有记录
+每条记录的序号就是它在文件里的偏移, 合并时每个key取序号最大的那条(last writer wins)
+expire记录单独合并, 只有比这个key最后一条数据记录更新的expire才有效, 已经到期的key直接丢掉
+遇到批次头时先确认整批都完整, 不完整就当作日志在批次头处断了, 保证批次在回放时的原子性
+相邻两段的边界对不上时(极小概率的crc误判), 主进程从前一段的结尾顺序重新解码这一段
+'''
+
+import logging
+import mmap
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from internal.record import MAGIC, OP_BATCH, OP_DELETE, OP_EXPIRE, decode_record, decode_varint
+
+
+def _find_boundary(mv, pos, size):
+    # 从pos开始找第一个真正的记录起点
+    while pos < size:
+        record = decode_record(mv, pos)
+        if record is not None:
+            end = record[3]
+            if end == size or decode_record(mv, end) is not None:
+                return pos
+        pos += 1
+    return size
+
+
+def _batch_complete(mv, count, pos):
+    try:
+        count = decode_varint(count, 0)[0]
+    except IndexError:
+        return False
+    for _ in range(count):
+        record = decode_record(mv, pos)
+        if record is None or record[0] == OP_BATCH:
+            return False
+        pos = record[3]
+    return True
+
+
+def _decode_range(path, start, end, aligned):
+    '''
+    进程池里执行: 解码起点在[start, end)里的记录
+    return (第一条记录的起点, 最后一条记录的结尾, 记录数, {key: (序号, op, value)}, {key: (序号, 到期时间)})
+    '''
+    latest = {}
+    expires = {}
+    count = 0
+    with open(path, "rb") as e, mmap.mmap(e.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        mv = memoryview(buf)
+        size = len(mv)
+        first = pos = start if aligned else _find_boundary(mv, start, size)
+        while pos < end:
+            record = decode_record(mv, pos)
+            if record is None:
+                break
+            op, key, value, next_pos = record
+            if op == OP_BATCH:
+                complete = _batch_complete(mv, value, next_pos)
+                key.release()
+                value.release()
+                if not complete:
+                    break
+                # 批次里的记录照常逐条处理, 超出end的部分由下一段处理
+                pos = next_pos
+                continue
+            if op == OP_EXPIRE:
+                expires[str(key, "utf-8")] = (pos, int(str(value, "utf-8")))
+            else:
+                latest[str(key, "utf-8")] = (pos, op, str(value, "utf-8"))
+            key.release()
+            value.release()
+            count += 1
+            pos = next_pos
+        mv.release()
+    return first, pos, count, latest, expires
+
+
+def parallel_recover(path: str, workers: int):
+    '''
+    并行解码一个二进制日志文件
+    return (存活的{key: value}, 存活key的{key: 到期时间}, 记录总数, 最后一条完整记录的结尾)
+    '''
+    size = os.path.getsize(path)
+    body = size - len(MAGIC)
+    step = max(body // workers, 1)
+    ranges = []
+    start = len(MAGIC)
+    while start < size:
+        end = min(start + step, size)
+        if size - end < step // 2:
+            end = size
+        ranges.append((start, end))
+        start = end
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_decode_range, path, s, e, i == 0) for i, (s, e) in enumerate(ranges)]
+        results = [f.result() for f in futures]
+
+    merged = {}
+    merged_expires = {}
+    records = 0
+    prev_end = len(MAGIC)
+    for (start, end), (first, last, count, latest, expires) in zip(ranges, results):
+        if first != prev_end:
+            if prev_end < start:
+                # 前一段在中途遇到残缺记录停下了, 后面的不能再用
+                logging.warning("%s: log broken at %d, ignore the rest", path, prev_end)
+                break
+            logging.warning("%s: range %d-%d misaligned, decode it sequentially", path, start, end)
+            first, last, count, latest, expires = _decode_range(path, prev_end, end, True)
+        for key, entry in latest.items():
+            current = merged.get(key)
+            if current is None or current[0] < entry[0]:
+                merged[key] = entry
+        for key, entry in expires.items():
+            current = merged_expires.get(key)
+            if current is None or current[0] < entry[0]:
+                merged_expires[key] = entry
+        records += count
+        prev_end = last
+
+    now = int(time.time() * 1000)
+    live = {}
+    live_expires = {}
+    for key, (seq, op, value) in merged.items():
+        if op == OP_DELETE:
+            continue
+        expire = merged_expires.get(key)
+        if expire is not None and expire[0] > seq:
+            if expire[1] <= now:
+                continue
+            live_expires[key] = expire[1]
+        live[key] = value
+    return live, live_expires, records, prev_end
@@ -0,0 +1,390 @@
+import logging
+import mmap
+import os
+
+from internal.logWriter import LogWriter
+from internal.record import (MAGIC, OP_DELETE, OP_EXPIRE, OP_SET, BinaryCodec, decode_record,
+                             decode_varint, encode_record, encode_varint)
+
+SEGMENT_SUFFIX = ".seg"
+HINT_SUFFIX = ".hint"
+COMPACT_SUFFIX = ".compact"
+# 最近一次压缩合并到的段号, 编号更小的段都已经失效
+BASE = "BASE"
+
+
+class _CorruptHint(Exception):
+    def __init__(self, segment):
+        super().__init__(segment)
+        self.segment = segment
+
+
+class SegmentStore:
+    '''
+    把日志拆成多个大小有上限的段文件, 放在source目录下: 000001.seg, 000002.seg ...
+    只有编号最大的段是活跃段, 写满segment_bytes就封存, 同时写一个提示(hint)文件
+
+    hint文件记录封存段里每个key最后一次出现的(key, 记录偏移, 是否删除), 按record.py的二进制格式存:
+    op是OP_SET或OP_DELETE, value是偏移的varint
+    段里最后一次操作是expire的key再多一条OP_EXPIRE, value是到期时间的varint, 排在所有偏移记录后面
+    打开时只读各段的hint和活跃段, 存活的值按偏移到段里直接取, 重启时间和存活key数成正比, 和写入历史无关
+
+    压缩把编号<=upto的段合并成一个新段, 以写BASE文件(原子替换)为提交点: BASE之前崩溃, 新段被丢弃;
+    之后崩溃, 打开时把新段换上并删掉更早的段. 旧段和新段不会同时被读到, 已删除的key不会复活
+    '''
+
+    def __init__(self, directory: str, segment_bytes: int, durability: str = "flush-every-10-ms",
+                 repair: bool = False):
+        '''
+        repair 段文件中间有校验失败的记录(后面还有完整的记录)时, 默认抛异常; 为True时从那里截断
+        '''
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.durability = durability
+        self.repair = repair
+        self.codec = BinaryCodec()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self._writer = None
+        self._active = 0
+        self._active_bytes = 0
+        # 所有段文件的总大小
+        self.bytes = 0
+        # 活跃段里每个key最后一次出现的(偏移, 是否删除), 封存时写成hint
+        self._active_hints = {}
+        # 活跃段里最后一次操作是expire的key -> 到期时间
+        self._active_expires = {}
+
+    def _path(self, segment, suffix=SEGMENT_SUFFIX):
+        return os.path.join(self.directory, "{:06d}{}".format(segment, suffix))
+
+    def segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def size(self) -> int:
+        return sum(os.path.getsize(self._path(segment)) for segment in self.segments())
+
+    def _read_base(self):
+        try:
+            with open(os.path.join(self.directory, BASE)) as e:
+                return int(e.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_base(self, upto):
+        path = os.path.join(self.directory, BASE)
+        with open(path + ".tmp", "w") as e:
+            e.write(str(upto))
+            e.flush()
+            os.fsync(e.fileno())
+        os.replace(path + ".tmp", path)
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _finish_compaction(self):
+        '''
+        打开时收尾上一次压缩: 已提交(段号<=BASE)的新段换上去, 没提交的丢掉, 删掉BASE之前的段
+        '''
+        base = self._read_base()
+        for name in os.listdir(self.directory):
+            if not name.endswith(SEGMENT_SUFFIX + COMPACT_SUFFIX):
+                continue
+            segment = int(name[:-len(SEGMENT_SUFFIX + COMPACT_SUFFIX)])
+            if segment <= base:
+                self._install(segment)
+            else:
+                os.remove(os.path.join(self.directory, name))
+        self._remove_before(base)
+
+    def _install(self, segment):
+        # 先删旧hint再换段文件: 中间崩溃的话这个段没有hint, 打开时会扫描重建
+        hint_path = self._path(segment, HINT_SUFFIX)
+        if os.path.exists(hint_path):
+            os.remove(hint_path)
+        os.replace(self._path(segment) + COMPACT_SUFFIX, self._path(segment))
+
+    def _remove_before(self, base):
+        for segment in self.segments():
+            if segment < base:
+                os.remove(self._path(segment))
+                if os.path.exists(self._path(segment, HINT_SUFFIX)):
+                    os.remove(self._path(segment, HINT_SUFFIX))
+
+    def _locate(self, sealed):
+        '''
+        用hint算出封存段里每个key最终在哪, 以及还有效的过期时间
+        return ({key: (段号, 偏移)}, {key: 到期时间})
+        '''
+        locations = {}
+        expires = {}
+        for segment in sealed:
+            for key, op, number in self._read_hints(segment):
+                if op == OP_EXPIRE:
+                    expires[key] = number
+                    continue
+                expires.pop(key, None)
+                if op == OP_DELETE:
+                    locations.pop(key, None)
+                else:
+                    locations[key] = (segment, number)
+        return locations, expires
+
+    def _apply_locations(self, locations, apply):
+        by_segment = {}
+        for key, (segment, offset) in locations.items():
+            by_segment.setdefault(segment, []).append((offset, key))
+        count = 0
+        for segment, entries in sorted(by_segment.items()):
+            entries.sort()
+            with open(self._path(segment), "rb") as e, \
+                    mmap.mmap(e.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                mv = memoryview(buf)
+                try:
+                    for offset, key in entries:
+                        record = decode_record(mv, offset)
+                        if record is None:
+                            raise _CorruptHint(segment)
+                        _, raw_key, value, _ = record
+                        matches = raw_key == key.encode("utf-8")
+                        raw_key.release()
+                        if not matches:
+                            value.release()
+                            raise _CorruptHint(segment)
+                        apply("set", key, str(value, "utf-8"))
+                        value.release()
+                        count += 1
+                finally:
+                    mv.release()
+        return count
+
+    def load(self, apply) -> int:
+        '''
+        恢复数据, 对每条需要回放的记录调用apply(method, key, value)
+        return int 回放的记录条数
+        '''
+        self._finish_compaction()
+        segments = self.segments()
+        if not segments:
+            segments = [1]
+            with open(self._path(1), "wb") as e:
+                e.write(MAGIC)
+        *sealed, active = segments
+
+        locations, expires = self._locate(sealed)
+        rebuilt = set()
+        while True:
+            try:
+                count = self._apply_locations(locations, apply)
+                break
+            except _CorruptHint as e:
+                if e.segment in rebuilt:
+                    # 扫描段文件重新生成的hint还是对不上, 不再用hint, 按顺序回放所有封存段;
+                    # 之前按hint回放过的key都会被后面的记录覆盖或删掉
+                    logging.warning("%s: rebuilt hint still points at a bad record, replaying sealed segments",
+                                    self._path(e.segment, HINT_SUFFIX))
+                    count = self._replay_sealed(sealed, apply)
+                    locations, expires = {}, {}
+                    break
+                # hint指向的不是这个key的完整记录: 当作hint损坏, 删掉它按扫描段文件重来, 每个段只重来一次;
+                # 已经回放过的key重新回放一遍, 重新计算后不再存活的删掉
+                logging.warning("%s: hint points at a bad record, scanning segment",
+                                self._path(e.segment, HINT_SUFFIX))
+                rebuilt.add(e.segment)
+                os.remove(self._path(e.segment, HINT_SUFFIX))
+                stale = locations
+                locations, expires = self._locate(sealed)
+                for key in stale:
+                    if key not in locations:
+                        apply("delete", key, None)
+        for key, expire_ms in expires.items():
+            if key in locations:
+                apply("expire", key, str(expire_ms))
+
+        # 活跃段完整回放
+        self._active = active
+        self._active_hints = {}
+        self._active_expires = {}
+        for method, key, value, offset in self._scan(active):
+            self._track(method, key, value, offset)
+            apply(method, key, value)
+            count += 1
+        self._active_bytes = os.path.getsize(self._path(active))
+        self._writer = LogWriter(self._path(active), self.durability)
+        self.bytes = self.size()
+        return count
+
+    def _replay_sealed(self, sealed, apply) -> int:
+        # 不用hint, 按顺序回放封存段里的每条记录
+        count = 0
+        for segment in sealed:
+            for method, key, value, _ in self._scan(segment):
+                apply(method, key, value)
+                count += 1
+        return count
+
+    def _scan(self, segment):
+        '''
+        顺序扫描一个段, 生成(method, key, value, 记录偏移), 截掉残缺的尾部
+        '''
+        path = self._path(segment)
+        size = os.path.getsize(path)
+        if size <= len(MAGIC):
+            if size < len(MAGIC):
+                with open(path, "wb") as e:
+                    e.write(MAGIC)
+            return
+        with open(path, "rb") as e, mmap.mmap(e.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield from self.codec.records(buf)
+            end = self.codec.end
+            torn = end == size or self.codec.tail_is_torn(buf, end)
+        if end < size:
+            if not torn and not self.repair:
+                raise Exception("{}: segment is corrupted at byte {} and records after it would be lost, "
+                                "open with repair=True to truncate it there".format(path, end))
+            logging.warning("%s: drop %d bytes %s", path, size - end,
+                            "of torn record" if torn else "after a corrupted record")
+            os.truncate(path, end)
+
+    def _track(self, method, key, value, offset):
+        # 记录活跃段里key的最后一次操作, 封存时写成hint
+        if method == "expire":
+            self._active_expires[key] = int(value)
+        else:
+            self._active_hints[key] = (offset, method == "delete")
+            self._active_expires.pop(key, None)
+
+    def _read_hints(self, segment):
+        '''
+        生成(key, op, 偏移或到期时间), hint缺失或损坏时退回到扫描段文件并补写hint
+        '''
+        path = self._path(segment, HINT_SUFFIX)
+        hints = None
+        if os.path.exists(path):
+            with open(path, "rb") as e:
+                data = e.read()
+            hints = []
+            pos = len(MAGIC)
+            mv = memoryview(data)
+            while pos < len(data):
+                record = decode_record(mv, pos)
+                if record is None:
+                    hints = None
+                    break
+                op, key, value, pos = record
+                hints.append((str(key, "utf-8"), op, decode_varint(value, 0)[0]))
+        if hints is None:
+            logging.warning("%s: hint missing or broken, scanning segment", path)
+            last = {}
+            expires = {}
+            for method, key, value, offset in self._scan(segment):
+                if method == "expire":
+                    expires[key] = int(value)
+                else:
+                    last[key] = (offset, method == "delete")
+                    expires.pop(key, None)
+            self._write_hints(segment, last, expires)
+            hints = [(key, OP_DELETE if tombstone else OP_SET, offset)
+                     for key, (offset, tombstone) in last.items()]
+            hints += [(key, OP_EXPIRE, expire_ms) for key, expire_ms in expires.items()]
+        return hints
+
+    def _write_hints(self, segment, hints, expires):
+        path = self._path(segment, HINT_SUFFIX)
+        with open(path + ".tmp", "wb") as e:
+            e.write(MAGIC)
+            for key, (offset, tombstone) in hints.items():
+                e.write(encode_record(OP_DELETE if tombstone else OP_SET, key.encode("utf-8"),
+                                      encode_varint(offset)))
+            for key, expire_ms in expires.items():
+                e.write(encode_record(OP_EXPIRE, key.encode("utf-8"), encode_varint(expire_ms)))
+            e.flush()
+            os.fsync(e.fileno())
+        os.replace(path + ".tmp", path)
+
+    def append(self, method: str, key: str, value: str):
+        '''
+        追加一条记录, 活跃段写满时先封存再写到新段
+        return (writer, ticket) 交给writer.sync等待落盘
+        '''
+        data = self.codec.encode(method, key, value)
+        if self._active_bytes + len(data) > self.segment_bytes and self._active_bytes > len(MAGIC):
+            self.seal()
+        self._track(method, key, value, self._active_bytes)
+        self._active_bytes += len(data)
+        self.bytes += len(data)
+        return self._writer, self._writer.append(data)
+
+    def append_batch(self, ops):
+        '''
+        把一批[(method, key, value)]作为一个批次(批次头+记录)整体追加到活跃段, 批次不会跨段
+        return (writer, ticket)
+        '''
+        records = [self.codec.encode(method, key, value) for method, key, value in ops]
+        data = self.codec.batch_header(len(records)) + b"".join(records)
+        if self._active_bytes + len(data) > self.segment_bytes and self._active_bytes > len(MAGIC):
+            self.seal()
+        offset = self._active_bytes + len(data) - sum(len(record) for record in records)
+        for (method, key, value), record in zip(ops, records):
+            self._track(method, key, value, offset)
+            offset += len(record)
+        self._active_bytes += len(data)
+        self.bytes += len(data)
+        return self._writer, self._writer.append(data)
+
+    def seal(self) -> int:
+        '''
+        封存活跃段: 写完落盘, 生成hint, 开一个新的活跃段
+        return int 被封存的段号
+        '''
+        sealed = self._active
+        self._writer.close()
+        self._write_hints(sealed, self._active_hints, self._active_expires)
+        self._active += 1
+        self._active_hints = {}
+        self._active_expires = {}
+        with open(self._path(self._active), "wb") as e:
+            e.write(MAGIC)
+        self._active_bytes = len(MAGIC)
+        self.bytes += len(MAGIC)
+        self._writer = LogWriter(self._path(self._active), self.durability)
+        return sealed
+
+    def compact(self, live, upto: int, expires=None) -> int:
+        '''
+        把编号<=upto的封存段合并成一个只含live的段, 放在upto的位置, 然后删掉更早的段
+        expires live里带过期时间的{key: 到期时间}, 写成expire记录
+        更新的段不受影响, 所以压缩期间可以照常写
+        return int 压缩后段文件的大小
+        '''
+        path = self._path(upto)
+        hints = {}
+        with open(path + COMPACT_SUFFIX, "wb") as e:
+            e.write(MAGIC)
+            offset = len(MAGIC)
+            for key, value in live:
+                data = self.codec.encode("set", key, value)
+                e.write(data)
+                hints[key] = (offset, False)
+                offset += len(data)
+            for key, expire_ms in (expires or {}).items():
+                data = self.codec.encode("expire", key, str(expire_ms))
+                e.write(data)
+                offset += len(data)
+            e.flush()
+            os.fsync(e.fileno())
+        # 提交点: 新段里没有被删除的key的删除记录, 不能和更早的段一起被读到
+        self._write_base(upto)
+        self._install(upto)
+        self._write_hints(upto, hints, expires or {})
+        self._remove_before(upto)
+        return offset
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
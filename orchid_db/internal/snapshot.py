@@ -0,0 +1,148 @@
+'''
+MVCC快照
+
+每次写(set/update/delete)都从全局计数器拿一个序号, 有活跃快照时, 写之前把key的旧值记进历史:
+history[key] = [(写的序号, 写之前的值), ...], 旧值为None表示写之前key不存在
+
+快照创建时也拿一个序号seq, 它看到的是所有序号小于seq的写:
+某个key的历史里第一条序号大于seq的记录的旧值, 就是这个key在快照时刻的值; 没有这样的记录就是当前值
+写者从不等读者, 读一个key时只短暂拿这个key的引擎锁
+
+遍历整个快照时有序引擎一段一段地读当前内容, 读完一段再查历史:
+写总是先记历史再改引擎, 所以这一段里读到之后又被改过的key, 以及读之前就被删掉的key, 此时都已经在历史里
+'''
+
+from bisect import bisect_left, insort
+
+
+class Snapshot:
+    '''
+    KVTableOperator.snapshot()返回的只读视图, 用完调用release()或用with, 之后历史才能回收
+    '''
+
+    # 遍历时每次从引擎复制多少个key
+    chunk_size = 1024
+
+    def __init__(self, table, seq):
+        self._table = table
+        self.seq = seq
+        self._released = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def _check(self):
+        if self._released:
+            raise Exception("snapshot is released")
+
+    def _at_seq(self, entries):
+        # entries按序号递增, 返回(是否有序号大于seq的写, 那次写之前的值)
+        # 回收旧值时会原地删掉列表开头, 先复制一份再查
+        entries = entries[:]
+        i = bisect_left(entries, (self.seq + 1,))
+        if i < len(entries):
+            return True, entries[i][1]
+        return False, None
+
+    def get(self, key):
+        '''
+        return 快照时刻key的值, 不存在返回None
+        '''
+        self._check()
+        table = self._table
+        with table._engine_lock(key):
+            entries = table._history.get(key)
+            if entries:
+                changed, value = self._at_seq(entries)
+                if changed:
+                    return value
+            return table.internal_db.get(key)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def items(self):
+        '''
+        快照时刻的全部(key, value), 按key排序
+        有序引擎惰性地分段生成, 每段只在复制时短暂拿写锁; 无序引擎只能整个复制下来排序
+        '''
+        self._check()
+        engine = self._table.internal_db
+        if not hasattr(engine, "scan") or not engine.ordered:
+            # 无序引擎不支持scan
+            return self._sorted_items()
+        return self._iter_chunks(self._table._engine_chunk(None, self.chunk_size + 1))
+
+    def _resolve(self, key, value):
+        # value是某个时刻读到的当前值, 用历史改正到快照时刻
+        entries = self._table._history.get(key)
+        if entries:
+            changed, old = self._at_seq(entries)
+            if changed:
+                return old
+        return value
+
+    def _iter_chunks(self, chunk):
+        table = self._table
+        size = self.chunk_size
+        # 还没输出的历史key, 排好序; 以及table._history_keys读到了哪里
+        pending, pending_set = [], set()
+        history_keys, seen = None, 0
+        start = None
+        while True:
+            end = None
+            if len(chunk) > size:
+                end = chunk[size][0]
+                del chunk[size:]
+            if table._history_keys is not history_keys:
+                # 回收时整个换掉了, 从头再读一遍
+                history_keys, seen = table._history_keys, 0
+            new = history_keys[seen:]
+            seen += len(new)
+            for key in new:
+                if (start is None or key >= start) and key not in pending_set:
+                    insort(pending, key)
+                    pending_set.add(key)
+            # [start, end)里在历史中的key, 读这一段之前被删掉的key只能从这里找到
+            j = len(pending) if end is None else bisect_left(pending, end)
+            deleted = pending[:j]
+            del pending[:j]
+            pending_set.difference_update(deleted)
+            current = dict(chunk)
+            for key in sorted(current.keys() | set(deleted)) if deleted else current:
+                value = self._resolve(key, current.get(key))
+                if value is not None:
+                    yield key, value
+            if end is None:
+                return
+            self._check()
+            start = end
+            chunk = table._engine_chunk(start, size + 1)
+
+    def _sorted_items(self):
+        table = self._table
+        # 先取当前内容, 再用历史改正; 取内容之后发生的写也都在历史里
+        current = dict(table._engine_items())
+        for key, entries in list(table._history.items()):
+            changed, value = self._at_seq(entries)
+            if not changed:
+                continue
+            if value is None:
+                current.pop(key, None)
+            else:
+                current[key] = value
+        return iter(sorted(current.items()))
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._table._release_snapshot(self.seq)
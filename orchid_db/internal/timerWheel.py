@@ -0,0 +1,72 @@
+'''
+分层时间轮(hierarchical timing wheel, Varghese & Lauck)
+
+第0层每格tick毫秒, 第i层每格是第i-1层一整圈, 4层64格、tick 10ms能覆盖约46小时, 更远的放在最高层, 到期时再放一次
+定时器按离现在多远放进对应层的格子, 高层的格子转到时把里面的定时器重新放进更低的层(cascade),
+每个定时器最多被搬动层数次, 所以添加和到期都是O(1)均摊, 和定时器总数无关
+
+取消是惰性的: 格子里不删, 调用方在到期时核对是否仍然有效
+'''
+
+
+class TimerWheel:
+
+    def __init__(self, now_ms: int, tick_ms: int = 10, wheel_size: int = 64, levels: int = 4):
+        self.tick = tick_ms
+        self.size = wheel_size
+        self.levels = levels
+        # 每层一格代表的毫秒数
+        self.spans = [tick_ms * wheel_size ** level for level in range(levels)]
+        self.wheels = [[[] for _ in range(wheel_size)] for _ in range(levels)]
+        # 已经处理到的时间, 总是tick的整数倍
+        self.time = now_ms - now_ms % tick_ms
+        self.count = 0
+
+    def add(self, key, expire_ms: int):
+        '''
+        放一个在expire_ms到期的定时器, 已经过期的会在下一次advance时到期
+        '''
+        self.count += 1
+        self._place(key, expire_ms, max(expire_ms, self.time + self.tick))
+
+    def _place(self, key, expire_ms, target):
+        # 按target选格子, 格子里存原始的expire_ms, 调用方用它核对定时器是否还有效
+        delta = target - self.time
+        for level in range(self.levels):
+            if delta < self.spans[level] * self.size or level == self.levels - 1:
+                span = self.spans[level]
+                # 超出最高层一圈的放在最远的格子, 转到时再放一次
+                target = min(target, self.time + span * (self.size - 1))
+                if level == 0:
+                    # 向上取整到tick, 格子转到时定时器一定已经到期
+                    target = -(-target // span) * span
+                self.wheels[level][(target // span) % self.size].append((key, expire_ms))
+                return
+
+    def advance(self, now_ms: int) -> list:
+        '''
+        把时间推进到now_ms
+        return list 到期的(key, expire_ms)
+        '''
+        due = []
+        while self.time + self.tick <= now_ms:
+            self.time += self.tick
+            # 从高到低把转到的格子搬下来, 到期的进第0层当前格
+            for level in range(self.levels - 1, 0, -1):
+                span = self.spans[level]
+                if self.time % span == 0:
+                    slot = self.wheels[level][(self.time // span) % self.size]
+                    if slot:
+                        self.wheels[level][(self.time // span) % self.size] = []
+                        for key, expire_ms in slot:
+                            self._place(key, expire_ms, max(expire_ms, self.time))
+            slot = self.wheels[0][(self.time // self.tick) % self.size]
+            if slot:
+                self.wheels[0][(self.time // self.tick) % self.size] = []
+                for key, expire_ms in slot:
+                    if expire_ms <= self.time:
+                        due.append((key, expire_ms))
+                        self.count -= 1
+                    else:
+                        self._place(key, expire_ms, expire_ms)
+        return due
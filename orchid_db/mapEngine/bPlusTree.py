@@ -0,0 +1,333 @@
+from bisect import bisect_left, bisect_right
+
+from .base import BaseMapWrapper, split_even
+
+
+class Leaf:
+    __slots__ = ("keys", "values", "prev", "next")
+
+    def __init__(self):
+        self.keys = []
+        self.values = []
+        self.prev = None
+        self.next = None
+
+
+class Internal:
+    __slots__ = ("keys", "children")
+
+    def __init__(self):
+        self.keys = []
+        self.children = []
+
+
+class BPlusTree:
+    """
+    B+tree with all values in the leaves and the leaves linked both ways.
+
+    A node holds at most `order` children (internal) or `order` keys (leaf).
+    The descent is iterative and every node is searched with bisect. Child i
+    of an internal node holds the keys k with keys[i - 1] <= k < keys[i].
+    """
+
+    def __init__(self, order=128):
+        if order < 4:
+            raise Exception("order must be >= 4")
+        self.order = order
+        self.root = Leaf()
+        self.size = 0
+
+    def _find_leaf(self, key, path=None):
+        """
+        Descends from the root to the leaf that may hold 'key'
+        :param path: If a list is given, the (internal node, child index) pairs are appended to it.
+        """
+        x = self.root
+        while type(x) is Internal:
+            i = bisect_right(x.keys, key)
+            if path is not None:
+                path.append((x, i))
+            x = x.children[i]
+        return x
+
+    def search(self, key):
+        """
+        :return: The value of 'key', or None if it is not present.
+        """
+        leaf = self._find_leaf(key)
+        i = bisect_left(leaf.keys, key)
+        if i < len(leaf.keys) and leaf.keys[i] == key:
+            return leaf.values[i]
+        return None
+
+    def search_many(self, keys):
+        """
+        Looks up 'keys' in sorted order, staying in the current leaf while a key
+        falls inside its key range instead of descending from the root again.
+        :return: The values in the order of 'keys', None for the missing ones.
+        """
+        out = [None] * len(keys)
+        leaf = None
+        for j in sorted(range(len(keys)), key=keys.__getitem__):
+            key = keys[j]
+            if leaf is None or not leaf.keys or not leaf.keys[0] <= key <= leaf.keys[-1]:
+                leaf = self._find_leaf(key)
+            i = bisect_left(leaf.keys, key)
+            if i < len(leaf.keys) and leaf.keys[i] == key:
+                out[j] = leaf.values[i]
+        return out
+
+    def insert(self, key, value):
+        """
+        Inserts 'key' or replaces its value in place.
+        :return: True if the key was new.
+        """
+        path = []
+        leaf = self._find_leaf(key, path)
+        i = bisect_left(leaf.keys, key)
+        if i < len(leaf.keys) and leaf.keys[i] == key:
+            leaf.values[i] = value
+            return False
+        leaf.keys.insert(i, key)
+        leaf.values.insert(i, value)
+        self.size += 1
+        if len(leaf.keys) > self.order:
+            self._split(leaf, path)
+        return True
+
+    def _split(self, node, path):
+        # Splits the overflowing 'node' and propagates separators up 'path'
+        while True:
+            mid = len(node.keys) // 2
+            if type(node) is Leaf:
+                right = Leaf()
+                right.keys, node.keys = node.keys[mid:], node.keys[:mid]
+                right.values, node.values = node.values[mid:], node.values[:mid]
+                right.prev, right.next = node, node.next
+                if node.next is not None:
+                    node.next.prev = right
+                node.next = right
+                separator = right.keys[0]
+            else:
+                right = Internal()
+                separator = node.keys[mid]
+                right.keys, node.keys = node.keys[mid + 1:], node.keys[:mid]
+                right.children, node.children = node.children[mid + 1:], node.children[:mid + 1]
+
+            if not path:
+                root = Internal()
+                root.keys = [separator]
+                root.children = [node, right]
+                self.root = root
+                return
+            parent, i = path.pop()
+            parent.keys.insert(i, separator)
+            parent.children.insert(i + 1, right)
+            if len(parent.children) <= self.order:
+                return
+            node = parent
+
+    def delete(self, key):
+        """
+        Deletes 'key', borrowing from or merging with a sibling on underflow.
+        :return: True if the key was present.
+        """
+        path = []
+        leaf = self._find_leaf(key, path)
+        i = bisect_left(leaf.keys, key)
+        if i == len(leaf.keys) or leaf.keys[i] != key:
+            return False
+        del leaf.keys[i]
+        del leaf.values[i]
+        self.size -= 1
+
+        node = leaf
+        while path:
+            # leaves keep at least order // 2 keys, internal nodes (order - 1) // 2,
+            # so that merging two minimal siblings never overflows
+            min_keys = self.order // 2 if type(node) is Leaf else (self.order - 1) // 2
+            if len(node.keys) >= min_keys:
+                break
+            parent, i = path.pop()
+            left = parent.children[i - 1] if i > 0 else None
+            right = parent.children[i + 1] if i + 1 < len(parent.children) else None
+            if type(node) is Leaf:
+                if left is not None and len(left.keys) > min_keys:
+                    node.keys.insert(0, left.keys.pop())
+                    node.values.insert(0, left.values.pop())
+                    parent.keys[i - 1] = node.keys[0]
+                elif right is not None and len(right.keys) > min_keys:
+                    node.keys.append(right.keys.pop(0))
+                    node.values.append(right.values.pop(0))
+                    parent.keys[i] = right.keys[0]
+                else:
+                    if left is None:
+                        left, node, i = node, right, i + 1
+                    left.keys += node.keys
+                    left.values += node.values
+                    left.next = node.next
+                    if node.next is not None:
+                        node.next.prev = left
+                    del parent.keys[i - 1]
+                    del parent.children[i]
+            else:
+                if left is not None and len(left.keys) > min_keys:
+                    node.keys.insert(0, parent.keys[i - 1])
+                    parent.keys[i - 1] = left.keys.pop()
+                    node.children.insert(0, left.children.pop())
+                elif right is not None and len(right.keys) > min_keys:
+                    node.keys.append(parent.keys[i])
+                    parent.keys[i] = right.keys.pop(0)
+                    node.children.append(right.children.pop(0))
+                else:
+                    if left is None:
+                        left, node, i = node, right, i + 1
+                    left.keys += [parent.keys[i - 1]] + node.keys
+                    left.children += node.children
+                    del parent.keys[i - 1]
+                    del parent.children[i]
+            node = parent
+
+        if type(self.root) is Internal and not self.root.keys:
+            self.root = self.root.children[0]
+        return True
+
+    def scan(self, start=None, end=None, reverse=False):
+        """
+        Generates the (key, value) tuples with start <= key < end by walking the leaf chain.
+        """
+        if not reverse:
+            if start is None:
+                leaf = self.root
+                while type(leaf) is Internal:
+                    leaf = leaf.children[0]
+                i = 0
+            else:
+                leaf = self._find_leaf(start)
+                i = bisect_left(leaf.keys, start)
+            while leaf is not None:
+                keys = leaf.keys
+                while i < len(keys):
+                    if end is not None and keys[i] >= end:
+                        return
+                    yield keys[i], leaf.values[i]
+                    i += 1
+                leaf, i = leaf.next, 0
+        else:
+            if end is None:
+                leaf = self.root
+                while type(leaf) is Internal:
+                    leaf = leaf.children[-1]
+                i = len(leaf.keys) - 1
+            else:
+                leaf = self.root
+                while type(leaf) is Internal:
+                    leaf = leaf.children[bisect_left(leaf.keys, end)]
+                i = bisect_left(leaf.keys, end) - 1
+            while leaf is not None:
+                keys = leaf.keys
+                while i >= 0:
+                    if start is not None and keys[i] < start:
+                        return
+                    yield keys[i], leaf.values[i]
+                    i -= 1
+                leaf = leaf.prev
+                if leaf is not None:
+                    i = len(leaf.keys) - 1
+
+    def bulk_load(self, items):
+        """
+        Builds the tree bottom-up from (key, value) tuples sorted by key with unique keys.
+        The tuples are consumed one at a time into leaves filled to capacity; the last two leaves are
+        rebalanced so that neither underflows, and the internal levels are spread evenly.
+        Only an empty tree can be bulk loaded.
+        """
+        if self.size:
+            raise Exception("bulk_load needs an empty tree")
+        order = self.order
+        leaves = []
+        leaf = None
+        count = 0
+        for key, value in items:
+            if leaf is None or len(leaf.keys) == order:
+                prev, leaf = leaf, Leaf()
+                leaf.prev = prev
+                if prev is not None:
+                    prev.next = leaf
+                leaves.append(leaf)
+            leaf.keys.append(key)
+            leaf.values.append(value)
+            count += 1
+        if not leaves:
+            return
+        if len(leaves) > 1 and len(leaf.keys) < order // 2:
+            prev = leaves[-2]
+            keys, values = prev.keys + leaf.keys, prev.values + leaf.values
+            half = len(keys) // 2
+            prev.keys, leaf.keys = keys[:half], keys[half:]
+            prev.values, leaf.values = values[:half], values[half:]
+        # (node, smallest key in its subtree)
+        level = [(leaf, leaf.keys[0]) for leaf in leaves]
+        while len(level) > 1:
+            parents = []
+            for group in split_even(level, -(-len(level) // order)):
+                node = Internal()
+                node.children = [child for child, _ in group]
+                node.keys = [low for _, low in group[1:]]
+                parents.append((node, group[0][1]))
+            level = parents
+        self.root = level[0][0]
+        self.size = count
+
+    def height(self):
+        h, x = 1, self.root
+        while type(x) is Internal:
+            h, x = h + 1, x.children[0]
+        return h
+
+
+class BPlusTreeWrapper(BaseMapWrapper):
+    def __init__(self, order=128):
+        self.bplus_core = BPlusTree(order)
+
+    def __setitem__(self, key, value):
+        assert type(key) == str
+        self.bplus_core.insert(key, value)
+
+    def get(self, key):
+        assert type(key) == str
+        return self.bplus_core.search(key)
+
+    def _del(self, key):
+        assert type(key) == str
+        self.bplus_core.delete(key)
+
+    def mget(self, keys):
+        return self.bplus_core.search_many(keys)
+
+    def __len__(self):
+        return self.bplus_core.size
+
+    def items(self):
+        return self.bplus_core.scan()
+
+    def stats(self):
+        height = 1
+        node = self.bplus_core.root
+        while isinstance(node, Internal):
+            node = node.children[0]
+            height += 1
+        return {"keys": self.bplus_core.size, "height": height, "order": self.bplus_core.order}
+
+    def _scan(self, start, end, reverse):
+        return self.bplus_core.scan(start, end, reverse)
+
+    def bulk_load(self, items):
+        '''
+        items 按key排好序的(key, value), 空树时自底向上直接建满节点, 否则逐个插入
+        '''
+        if len(self):
+            for key, value in items:
+                self[key] = value
+        else:
+            self.bplus_core.bulk_load(items)
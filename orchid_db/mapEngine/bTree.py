@@ -1,7 +1,8 @@
 import threading
+from bisect import bisect_left
 from random import randint, randrange
 
-from mapEngine.base import BaseMapWrapper
+from mapEngine.base import BaseMapWrapper, split_even
 
 
 class Node:
@@ -58,6 +59,107 @@ class BTree:
             # Search the entire tree
             return self.search(k, self.root)
 
+    def items(self, x=None):
+        """
+        Generates all (key, value) tuples of the B-Tree in key order
+        :param x: The node to start from. If not specified, then starts from the root.
+        """
+        if x is None:
+            x = self.root
+        if x.leaf:
+            for k in x.keys:
+                yield k
+            return
+        for i, k in enumerate(x.keys):
+            yield from self.items(x.children[i])
+            yield k
+        yield from self.items(x.children[len(x.keys)])
+
+    def scan(self, start=None, end=None, reverse=False, x=None):
+        """
+        Generates the (key, value) tuples with start <= key < end in key order,
+        only descending into the subtrees that overlap the range
+        :param start: Lower bound, None for unbounded.
+        :param end: Upper bound (exclusive), None for unbounded.
+        :param reverse: Generates in descending order if True.
+        :param x: The node to start from. If not specified, then starts from the root.
+        """
+        if x is None:
+            x = self.root
+        keys = x.keys
+        lo = 0 if start is None else bisect_left(keys, (start,))
+        hi = len(keys) if end is None else bisect_left(keys, (end,))
+        if not reverse:
+            for i in range(lo, hi):
+                if not x.leaf:
+                    yield from self.scan(start, end, reverse, x.children[i])
+                yield keys[i]
+            if not x.leaf:
+                yield from self.scan(start, end, reverse, x.children[hi])
+        else:
+            if not x.leaf:
+                yield from self.scan(start, end, reverse, x.children[hi])
+            for i in range(hi - 1, lo - 1, -1):
+                yield keys[i]
+                if not x.leaf:
+                    yield from self.scan(start, end, reverse, x.children[i])
+
+    def bulk_load(self, items):
+        """
+        Builds a packed B-Tree bottom-up from (key, value) tuples sorted by key with unique keys.
+        The tuples are consumed one at a time: leaves are filled to 2t - 1 keys with one separator taken
+        between them, then the last two leaves are rebalanced so that none has fewer than t - 1.
+        :param items: The sorted tuples, any iterable. The tree must be empty.
+        :return: The number of tuples loaded.
+        """
+        if self.root.keys:
+            raise Exception("bulk_load needs an empty tree")
+        t = self.t
+        nodes, seps = [], []
+        leaf = None
+        count = 0
+        for item in items:
+            count += 1
+            if leaf is None:
+                leaf = self._leaf([item])
+                nodes.append(leaf)
+            elif len(leaf.keys) < 2 * t - 1:
+                leaf.keys.append(item)
+            else:
+                seps.append(item)
+                leaf = None
+        if not nodes:
+            return 0
+        if len(seps) == len(nodes):
+            # The input ended right after a separator: give it an empty leaf, filled by the rebalancing below
+            nodes.append(self._leaf([]))
+        if len(nodes) > 1 and len(nodes[-1].keys) < t - 1:
+            # Spread the last leaf, its separator and the full leaf before it over both
+            merged = nodes[-2].keys + [seps[-1]] + nodes[-1].keys
+            half = (len(merged) - 1) // 2
+            nodes[-2].keys, seps[-1], nodes[-1].keys = merged[:half], merged[half], merged[half + 1:]
+        while len(nodes) > 1:
+            # Same layout one level up: a parent takes 2t children around 2t - 1 separators
+            n_parents = -(-len(nodes) // (2 * t))
+            groups = split_even(list(range(len(nodes))), n_parents)
+            parents, parent_seps = [], []
+            for g, group in enumerate(groups):
+                x = Node()
+                x.children = nodes[group[0]:group[-1] + 1]
+                x.keys = seps[group[0]:group[-1]]
+                parents.append(x)
+                if g + 1 < len(groups):
+                    parent_seps.append(seps[group[-1]])
+            nodes, seps = parents, parent_seps
+        self.root = nodes[0]
+        return count
+
+    @staticmethod
+    def _leaf(keys):
+        x = Node(True)
+        x.keys = keys
+        return x
+
     def insert(self, k):
         """
         Calls the respective helper functions for insertion into B-Tree
@@ -113,7 +215,7 @@ class BTree:
         y.keys = y.keys[0: t - 1]
         if not y.leaf:
             z.children = y.children[t: 2 * t]
-            y.children = y.children[0: t - 1]
+            y.children = y.children[0: t]
 
     def delete(self, x, k):
         """
@@ -332,17 +434,21 @@ class BTreeWrapper(BaseMapWrapper):
                 if not hasattr(cls, '_instance'):
                     BTreeWrapper._instance = super().__new__(cls)
 
-            return BTreeWrapper._instance
+        return BTreeWrapper._instance
 ############################################################################
     def __init__(self):
         self.btree_core = BTree(3)
+        self._size = 0
 
     def __setitem__(self, key, value):
         assert type(key) == str
         node = self.btree_core.search(key)
         if node is not None:
-            self.btree_core.delete(self.btree_core.root, (key,))
-        self.btree_core.insert((key, value))
+            # 已存在的key直接原地替换value
+            node[0].keys[node[1]] = (key, value)
+        else:
+            self._size += 1
+            self.btree_core.insert((key, value))
 
     def __getitem__(self, key):
         assert type(key) == str
@@ -358,12 +464,14 @@ class BTreeWrapper(BaseMapWrapper):
         if node is not None:
             index = node[1]
             keys = node[0].keys
-            return keys[index]
+            return keys[index][1]
         else:
             return None
 
     def _del(self, key):
         assert type(key) == str
+        if self.btree_core.search(key) is not None:
+            self._size -= 1
         self.btree_core.delete(self.btree_core.root, (key,))
 
     def __delitem__(self, key):
@@ -374,6 +482,33 @@ class BTreeWrapper(BaseMapWrapper):
         assert type(key) == str
         return self._del(key)
 
+    def __len__(self):
+        return self._size
+
+    def items(self):
+        return self.btree_core.items()
+
+    def stats(self):
+        height = 1
+        node = self.btree_core.root
+        while not node.leaf:
+            node = node.children[0]
+            height += 1
+        return {"keys": self._size, "height": height, "min_degree": self.btree_core.t}
+
+    def _scan(self, start, end, reverse):
+        return self.btree_core.scan(start, end, reverse)
+
+    def bulk_load(self, items):
+        '''
+        items 按key排好序的(key, value), 空树时自底向上直接建满节点, 否则逐个插入
+        '''
+        if self._size:
+            for key, value in items:
+                self[key] = value
+        else:
+            self._size = self.btree_core.bulk_load(items)
+
 
 # Program starts here
 if __name__ == '__main__':
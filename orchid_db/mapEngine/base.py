@@ -1,3 +1,32 @@
+from itertools import islice
+
+
+def prefix_end(prefix):
+    '''
+    返回比所有以prefix开头的key都大的最小字符串, 用作scan的end; 没有上界时返回None
+    '''
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10FFFF:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+def split_even(seq, parts):
+    '''
+    把seq尽量平均地切成parts段, bulk_load建树时用来让每个节点的大小差不多
+    '''
+    size, extra = divmod(len(seq), parts)
+    out = []
+    pos = 0
+    for i in range(parts):
+        step = size + (1 if i < extra else 0)
+        out.append(seq[pos:pos + step])
+        pos += step
+    return out
+
+
 class BaseMapWrapper:
     def __setitem__(self, key, value):
         raise Exception("please implementation")
@@ -24,5 +53,44 @@ class BaseMapWrapper:
         assert type(key) == str
         return self._del(key)
 
+    def __len__(self):
+        raise Exception("please implementation")
+
+    def items(self):
+        raise Exception("please implementation")
+
+    def mget(self, keys):
+        '''
+        返回和keys一一对应的value列表, 不存在的是None; 有序引擎可以按排好序的key一趟查完
+        '''
+        return [self.get(key) for key in keys]
+
+    def mset(self, items):
+        '''
+        写入一批(key, value), 同一个key以后出现的为准; 引擎可以换成批量合并
+        '''
+        for key, value in items:
+            self[key] = value
+
+    def scan(self, start=None, end=None, limit=None, reverse=False):
+        '''
+        按key顺序惰性遍历[start, end)里的(key, value), None表示不限, reverse为True时从大到小
+        有序引擎实现_scan, 代价是O(log n + k)
+        '''
+        it = self._scan(start, end, reverse)
+        if limit is not None:
+            it = islice(it, limit)
+        return it
+
+    def prefix_scan(self, prefix, limit=None, reverse=False):
+        return self.scan(prefix or None, prefix_end(prefix), limit, reverse)
 
+    def _scan(self, start, end, reverse):
+        raise Exception("this engine is not ordered, scan is not supported")
 
+    @property
+    def ordered(self) -> bool:
+        '''
+        支不支持scan: 实现了_scan的就是有序引擎, 包装别的引擎的子类按被包装的引擎判断
+        '''
+        return type(self)._scan is not BaseMapWrapper._scan
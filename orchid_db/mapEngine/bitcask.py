@@ -0,0 +1,346 @@
+import json
+import mmap
+import os
+import shutil
+import threading
+
+from internal.record import OP_DELETE, OP_SET, decode_record, encode_record
+from .base import BaseMapWrapper
+
+SEGMENT_SUFFIX = ".data"
+CHECKPOINT = "CHECKPOINT"
+# 合并时新段先写在这个子目录里, 写好之后以MERGED文件为提交点换上
+MERGE_DIR = "merge"
+MERGED = "MERGED"
+# 估算一条记录在段文件里的字节数时, 除了key和value之外的固定部分(crc, op, 两个varint)
+_RECORD_OVERHEAD = 7
+
+
+class BitcaskWrapper(BaseMapWrapper):
+    '''
+    Bitcask风格的引擎: 内存里只有keydir, 每个key对应值在哪个段文件的哪个位置,
+    值本身按record.py的二进制格式追加写在段文件里, 读的时候直接从mmap里取
+
+    keydir的位置信息打包成一个int: segment << 64 | offset << 32 | length,
+    比三元组少一半以上的对象开销, 常驻内存大约是key本身加上dict的一个槽位和这个int
+
+    覆盖和删除留下的旧记录是垃圾, 换段时垃圾占比超过merge_garbage_ratio就合并(merge):
+    把封存段里还有效的记录顺序写成新段, 以写MERGED文件为提交点, 再删掉旧段换上新段
+
+    CHECKPOINT文件是上层记下的检查点(set_checkpoint), 打开之后第一次写就删掉,
+    上层据此判断引擎的内容是不是还和它记下检查点时一样
+    '''
+
+    def __init__(self, path: str = "./data/bitcask", max_segment_bytes: int = 64 * 1024 * 1024,
+                 merge_garbage_ratio: float = 0.5):
+        if max_segment_bytes > 0xFFFFFFFF:
+            raise Exception("max_segment_bytes must fit in 32 bits")
+        self.path = path
+        self.max_segment_bytes = max_segment_bytes
+        self.merge_garbage_ratio = merge_garbage_ratio
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.keydir = {}
+        self._lock = threading.Lock()
+        # 段号 -> mmap, 活跃段写入后按需重新映射
+        self._maps = {}
+        # 所有段文件的字节数, 以及其中旧记录(被覆盖或删除的值, 删除标记)的估算字节数
+        self._total_bytes = 0
+        self._garbage_bytes = 0
+        self.merges = 0
+        self._finish_merge()
+        segments = self._segments()
+        for segment in segments:
+            self._load_segment(segment)
+        self._active = segments[-1] if segments else 0
+        self._file = open(self._segment_path(self._active), "ab")
+        self._offset = self._file.tell()
+        self._checkpoint = None
+        checkpoint_path = os.path.join(self.path, CHECKPOINT)
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as e:
+                self._checkpoint = json.load(e)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, "{:06d}{}".format(segment, SEGMENT_SUFFIX))
+
+    def _segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _load_segment(self, segment):
+        '''
+        扫描整个段文件重建keydir, 段尾的残缺记录直接截掉
+        '''
+        path = self._segment_path(segment)
+        size = os.path.getsize(path)
+        if size == 0:
+            return
+        with open(path, "rb") as e, mmap.mmap(e.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            mv = memoryview(buf)
+            pos = 0
+            while pos < size:
+                record = decode_record(mv, pos)
+                if record is None:
+                    break
+                op, key, value, end = record
+                name = str(key, "utf-8")
+                old = self.keydir.get(name)
+                if old is not None:
+                    self._garbage_bytes += self._record_bytes(name, old)
+                if op == OP_DELETE:
+                    self.keydir.pop(name, None)
+                    self._garbage_bytes += end - pos
+                else:
+                    self.keydir[name] = self._pack(segment, end - len(value), len(value))
+                key.release()
+                value.release()
+                pos = end
+            mv.release()
+        if pos < size:
+            os.truncate(path, pos)
+        self._total_bytes += pos
+
+    @staticmethod
+    def _record_bytes(key, loc):
+        # 估算keydir里loc指向的那条记录的大小
+        return len(key.encode("utf-8")) + (loc & 0xFFFFFFFF) + _RECORD_OVERHEAD
+
+    @staticmethod
+    def _pack(segment, offset, length):
+        return segment << 64 | offset << 32 | length
+
+    def _map(self, segment, end):
+        # 活跃段映射过后又有追加时重新映射, 旧的映射可能还被get_view的调用方引用, 交给gc关闭
+        buf = self._maps.get(segment)
+        if buf is None or len(buf) < end:
+            with open(self._segment_path(segment), "rb") as e:
+                buf = mmap.mmap(e.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = buf
+        return buf
+
+    def _append(self, op, key, value):
+        # 调用方持有self._lock
+        if self._checkpoint is not None:
+            # 内容要变了, 先让检查点失效
+            os.remove(os.path.join(self.path, CHECKPOINT))
+            self._checkpoint = None
+        record = encode_record(op, key, value)
+        if self._offset + len(record) > self.max_segment_bytes and self._offset > 0:
+            self._rotate()
+        self._file.write(record)
+        self._file.flush()
+        self._offset += len(record)
+        self._total_bytes += len(record)
+        return self._pack(self._active, self._offset - len(value), len(value))
+
+    def _rotate(self):
+        self._file.close()
+        self._active += 1
+        self._file = open(self._segment_path(self._active), "ab")
+        self._offset = 0
+        if self._garbage_bytes > self._total_bytes * self.merge_garbage_ratio:
+            self._merge()
+
+    def __setitem__(self, key, value):
+        assert type(key) == str
+        with self._lock:
+            loc = self._append(OP_SET, key.encode("utf-8"), value.encode("utf-8"))
+            old = self.keydir.get(key)
+            if old is not None:
+                self._garbage_bytes += self._record_bytes(key, old)
+            self.keydir[key] = loc
+
+    def get_view(self, key):
+        '''
+        零拷贝读: 返回指向mmap的memoryview, 不存在返回None
+        '''
+        while True:
+            loc = self.keydir.get(key)
+            if loc is None:
+                return None
+            segment, offset, length = loc >> 64, (loc >> 32) & 0xFFFFFFFF, loc & 0xFFFFFFFF
+            try:
+                buf = self._map(segment, offset + length)
+            except FileNotFoundError:
+                # 读到位置之后段被合并删掉了, keydir已经指向新段
+                if self.keydir.get(key) == loc:
+                    raise
+                continue
+            return memoryview(buf)[offset:offset + length]
+
+    def get(self, key):
+        assert type(key) == str
+        view = self.get_view(key)
+        if view is None:
+            return None
+        return str(view, "utf-8")
+
+    def _del(self, key):
+        assert type(key) == str
+        with self._lock:
+            if key not in self.keydir:
+                raise KeyError(key)
+            self._append(OP_DELETE, key.encode("utf-8"), b"")
+            # 旧值和删除标记本身都是垃圾
+            self._garbage_bytes += self._record_bytes(key, self.keydir.pop(key)) + self._record_bytes(key, 0)
+
+    def __len__(self):
+        return len(self.keydir)
+
+    def stats(self):
+        return {"keys": len(self.keydir), "active_segment": self._active, "active_bytes": self._offset,
+                "bytes": self._total_bytes, "garbage_bytes": self._garbage_bytes, "merges": self.merges}
+
+    # ---------------------------------------------------------------- 合并
+
+    def merge(self):
+        '''
+        把封存段里还有效的记录写成新段, 丢掉旧值和删除标记; 活跃段不动
+        '''
+        with self._lock:
+            self._merge()
+
+    def _merge(self):
+        # 调用方持有self._lock
+        sealed = [segment for segment in self._segments() if segment < self._active]
+        if not sealed:
+            return
+        upto = sealed[-1]
+        staging = os.path.join(self.path, MERGE_DIR)
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        # 按旧位置排序, 顺序读旧段
+        live = sorted((loc, key) for key, loc in self.keydir.items() if loc >> 64 <= upto)
+        moved = []
+        out, number, offset = None, 0, 0
+        for loc, key in live:
+            kb = key.encode("utf-8")
+            record = encode_record(OP_SET, kb, bytes(self._view(loc)))
+            if out is None or (offset + len(record) > self.max_segment_bytes and offset > 0):
+                if out is not None:
+                    self._close_synced(out)
+                    number += 1
+                out = open(os.path.join(staging, "{:06d}{}".format(number, SEGMENT_SUFFIX)), "wb")
+                offset = 0
+            out.write(record)
+            offset += len(record)
+            moved.append((key, loc, number, offset - (loc & 0xFFFFFFFF)))
+        count = 0
+        if out is not None:
+            self._close_synced(out)
+            count = number + 1
+        self._fsync_dir(staging)
+        # 提交点: 之后崩溃, 打开时_finish_merge把新段换上
+        self._write_file(MERGED, "{} {}".format(upto, count))
+        self._finish_merge()
+        first = upto - count + 1
+        for key, loc, number, offset in moved:
+            self.keydir[key] = self._pack(first + number, offset, loc & 0xFFFFFFFF)
+        for segment in sealed:
+            # 正在读的调用方还持有旧的mmap, 不受影响
+            self._maps.pop(segment, None)
+        self._total_bytes = sum(os.path.getsize(self._segment_path(segment)) for segment in self._segments())
+        self._garbage_bytes = 0
+        self.merges += 1
+
+    def _finish_merge(self):
+        '''
+        MERGED记着(upto, 新段数): 删掉编号<=upto的旧段, 把新段改名成upto-新段数+1 ... upto
+        可以重复执行: 旧段全部删完之后才开始改名, 所以暂存目录里的段少于新段数时说明旧段已经删完
+        '''
+        staging = os.path.join(self.path, MERGE_DIR)
+        marker = os.path.join(self.path, MERGED)
+        if not os.path.exists(marker):
+            # 没有提交的合并, 丢掉写了一半的新段
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        with open(marker) as e:
+            upto, count = (int(field) for field in e.read().split())
+        staged = sorted(name for name in os.listdir(staging) if name.endswith(SEGMENT_SUFFIX)) \
+            if os.path.exists(staging) else []
+        if len(staged) == count:
+            for segment in self._segments():
+                if segment <= upto:
+                    os.remove(self._segment_path(segment))
+        for name in staged:
+            number = upto - count + 1 + int(name[:-len(SEGMENT_SUFFIX)])
+            os.replace(os.path.join(staging, name), self._segment_path(number))
+        self._fsync_dir(self.path)
+        shutil.rmtree(staging, ignore_errors=True)
+        os.remove(marker)
+
+    def _view(self, loc):
+        segment, offset, length = loc >> 64, (loc >> 32) & 0xFFFFFFFF, loc & 0xFFFFFFFF
+        return memoryview(self._map(segment, offset + length))[offset:offset + length]
+
+    @staticmethod
+    def _close_synced(file):
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+
+    @staticmethod
+    def _fsync_dir(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write_file(self, name, text):
+        path = os.path.join(self.path, name)
+        with open(path + ".tmp", "w") as e:
+            e.write(text)
+            e.flush()
+            os.fsync(e.fileno())
+        os.replace(path + ".tmp", path)
+        self._fsync_dir(self.path)
+
+    # ---------------------------------------------------------------- 检查点
+
+    def checkpoint(self):
+        '''
+        return 上次set_checkpoint记下的值, 之后有过写(或从没记过)返回None
+        '''
+        return self._checkpoint
+
+    def set_checkpoint(self, stamp):
+        '''
+        把活跃段落盘, 然后记下stamp(能写成JSON的值)
+        '''
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._write_file(CHECKPOINT, json.dumps(stamp))
+            self._checkpoint = stamp
+
+    def clear(self):
+        '''
+        删掉所有内容和所有段文件
+        '''
+        with self._lock:
+            self._file.close()
+            for segment in self._segments():
+                os.remove(self._segment_path(segment))
+            if self._checkpoint is not None:
+                os.remove(os.path.join(self.path, CHECKPOINT))
+                self._checkpoint = None
+            self.keydir = {}
+            self._maps = {}
+            self._total_bytes = 0
+            self._garbage_bytes = 0
+            self._active = 0
+            self._file = open(self._segment_path(self._active), "ab")
+            self._offset = 0
+
+    def items(self):
+        for key in list(self.keydir):
+            value = self.get(key)
+            if value is not None:
+                yield key, value
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._maps = {}
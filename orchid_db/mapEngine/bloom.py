@@ -0,0 +1,366 @@
+import math
+import os
+import struct
+import threading
+import zlib
+from contextlib import nullcontext
+from itertools import islice
+
+from .base import BaseMapWrapper
+
+BLOOM_MAGIC = b"OBF1"
+# magic, 计数器个数m, hash个数k, 已加入的key数, 以及调用方给的版本戳(日志大小, 日志修改时间)
+_HEADER = struct.Struct("<4sQIQQQ")
+_COUNTER_MAX = 255
+# 第二个hash的crc32初值
+_SEED = 0x9E3779B9
+# BloomFilter.to_bytes的头: 位数m, hash个数k
+_BITS_HEADER = struct.Struct("<QI")
+
+
+def _dimensions(capacity, error_rate):
+    # 按预计key数和误判率算位置数m和hash个数k
+    if capacity <= 0:
+        raise Exception("bloom filter capacity must be positive")
+    if not 0 < error_rate < 1:
+        raise Exception("bloom filter error_rate must be in (0, 1)")
+    m = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    return m, max(1, round(m / capacity * math.log(2)))
+
+
+class CountingBloomFilter:
+    '''
+    计数布隆过滤器: 每个位置是一个8位计数器而不是1位, 所以支持删除
+    查询结果为False时key一定不存在, 为True时可能存在, 误判率按capacity和error_rate设计
+
+    k个位置用双重哈希 h1 + i*h2 算出(Kirsch & Mitzenmacher), h1/h2是两个不同初值的crc32,
+    不用内置hash(), 因为str的hash每个进程不一样, 过滤器要能存盘后再读回来;
+    也不用blake2b之类的密码学hash, 在这里它比一次二分查找还慢
+    计数器加到255就不再变化(饱和), 之后也不会减, 只会让误判多一点, 不会漏掉存在的key
+    '''
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.m, self.k = _dimensions(capacity, error_rate)
+        self.counters = bytearray(self.m)
+        self.count = 0
+
+    def _positions(self, key):
+        data = key.encode("utf-8")
+        h1 = zlib.crc32(data)
+        h2 = zlib.crc32(data, _SEED) | 1
+        m = self.m
+        return [(h1 + i * h2) % m for i in range(self.k)]
+
+    def __contains__(self, key):
+        # 查询是热路径, 不建列表, 第一个为0的计数器就返回
+        data = key.encode("utf-8")
+        h1 = zlib.crc32(data)
+        h2 = zlib.crc32(data, _SEED) | 1
+        m = self.m
+        counters = self.counters
+        for i in range(self.k):
+            if not counters[(h1 + i * h2) % m]:
+                return False
+        return True
+
+    def add(self, key):
+        counters = self.counters
+        for pos in self._positions(key):
+            if counters[pos] < _COUNTER_MAX:
+                counters[pos] += 1
+        self.count += 1
+
+    def remove(self, key):
+        '''
+        只能删除加入过的key, 否则会把别的key的计数器减到0, 造成漏判
+        '''
+        counters = self.counters
+        for pos in self._positions(key):
+            if 0 < counters[pos] < _COUNTER_MAX:
+                counters[pos] -= 1
+        self.count -= 1
+
+    def false_positive_rate(self) -> float:
+        '''
+        按当前key数估算的误判率
+        '''
+        return (1 - math.exp(-self.k * self.count / self.m)) ** self.k
+
+    def save(self, path: str, stamp=(0, 0)):
+        '''
+        写到临时文件再原子替换path, stamp是调用方用来判断文件是否过期的两个整数
+        '''
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as e:
+            e.write(_HEADER.pack(BLOOM_MAGIC, self.m, self.k, self.count, stamp[0], stamp[1]))
+            e.write(self.counters)
+            e.flush()
+            os.fsync(e.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str):
+        '''
+        return (过滤器, stamp), 文件不存在或内容不完整时返回(None, None)
+        '''
+        try:
+            with open(path, "rb") as e:
+                data = e.read()
+        except FileNotFoundError:
+            return None, None
+        if len(data) < _HEADER.size:
+            return None, None
+        magic, m, k, count, stamp0, stamp1 = _HEADER.unpack_from(data)
+        if magic != BLOOM_MAGIC or len(data) != _HEADER.size + m:
+            return None, None
+        bloom = cls.__new__(cls)
+        bloom.m = m
+        bloom.k = k
+        bloom.count = count
+        bloom.capacity = max(1, round(m * math.log(2) / k))
+        bloom.error_rate = math.exp(-k * math.log(2))
+        bloom.counters = bytearray(data[_HEADER.size:])
+        return bloom, (stamp0, stamp1)
+
+
+class BloomFilter:
+    '''
+    普通的布隆过滤器, 每个位置1位, 不支持删除, 给不可变的数据用(LSM的有序文件)
+    hash和CountingBloomFilter一样, key可以是str或者utf-8的bytes, 结果相同
+    '''
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.m, self.k = _dimensions(capacity, error_rate)
+        self.bits = bytearray((self.m + 7) >> 3)
+
+    def add(self, key):
+        data = key.encode("utf-8") if isinstance(key, str) else key
+        h1 = zlib.crc32(data)
+        h2 = zlib.crc32(data, _SEED) | 1
+        m = self.m
+        bits = self.bits
+        for i in range(self.k):
+            pos = (h1 + i * h2) % m
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        data = key.encode("utf-8") if isinstance(key, str) else key
+        h1 = zlib.crc32(data)
+        h2 = zlib.crc32(data, _SEED) | 1
+        m = self.m
+        bits = self.bits
+        for i in range(self.k):
+            pos = (h1 + i * h2) % m
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def to_bytes(self) -> bytes:
+        return _BITS_HEADER.pack(self.m, self.k) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        bloom = cls.__new__(cls)
+        bloom.m, bloom.k = _BITS_HEADER.unpack_from(data)
+        bloom.bits = bytearray(data[_BITS_HEADER.size:])
+        if len(bloom.bits) != (bloom.m + 7) >> 3:
+            raise Exception("bloom filter data is truncated")
+        return bloom
+
+
+class BloomWrapper(BaseMapWrapper):
+    '''
+    在引擎前面加一个计数布隆过滤器, get/mget先查过滤器, 一定不存在的key不再查引擎
+    (inder_db的编码和二分, B树从根到叶子的查找, 磁盘引擎的I/O都省掉)
+
+    每个存在的key在过滤器里只计一次: set时过滤器说可能存在就先查一次引擎确认是不是覆盖,
+    所以覆盖写比原来多一次引擎查找. 新key写完引擎再加进过滤器, 删除成功后才从过滤器里删
+    同一个key的写要由调用方串行化(KVTableOperator的key锁), 过滤器本身有自己的锁
+    其他属性(lock_for, flush等)透传给引擎
+    '''
+
+    def __init__(self, engine, capacity: int = None, error_rate: float = 0.01, bloom=None, lock_all=None):
+        '''
+        capacity 预计的key数, 默认是引擎当前key数的两倍(至少1024)
+        bloom 已经有的过滤器(比如从文件读回来的), 给了就不再从引擎重建
+        lock_all 返回一个挡住所有写的上下文(KVTableOperator的写锁或全部分片锁), 重建时在它下面取key的快照;
+            为None时由调用方保证重建期间没有写
+        '''
+        self.engine = engine
+        self.error_rate = error_rate
+        self._block_writes = lock_all or nullcontext
+        self._lock = threading.Lock()
+        # 重建期间, 取完快照之后的写: [(是否加入, key)], 重建完按顺序补到新过滤器上
+        self._rebuilding = None
+        self._grower = None
+        self.negatives = 0
+        self.bloom = bloom if bloom is not None else self._build(capacity)
+
+    def __getattr__(self, name):
+        # 只在本对象上找不到时调用, 透传给引擎
+        return getattr(self.engine, name)
+
+    def _snapshot_keys(self):
+        # 挡住所有写再复制key: 边写边遍历时, 删除会让inder_db之类的列表移位, 遍历漏掉存在的key
+        with self._block_writes():
+            with self._lock:
+                if self._rebuilding is not None:
+                    # 快照之前的写已经在快照里了, 只补之后的
+                    self._rebuilding = []
+            return [key for key, _ in self.engine.items()]
+
+    def _build(self, capacity):
+        keys = self._snapshot_keys()
+        bloom = CountingBloomFilter(capacity or max(1024, 2 * len(keys)), self.error_rate)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def rebuild(self, capacity: int = None):
+        '''
+        按引擎当前的key重建过滤器: 清掉饱和的计数器和删除留下的误判, 并按key数重新定大小
+        重建期间可以并发写: 快照之后的加入和删除按顺序补到新过滤器上, 再换上新过滤器.
+        已经有重建在进行时直接返回
+        '''
+        with self._lock:
+            if self._rebuilding is not None:
+                return
+            self._rebuilding = []
+        try:
+            bloom = self._build(capacity)
+        except BaseException:
+            with self._lock:
+                self._rebuilding = None
+            raise
+        with self._lock:
+            for added, key in self._rebuilding:
+                if added:
+                    bloom.add(key)
+                else:
+                    bloom.remove(key)
+            self._rebuilding = None
+            self.bloom = bloom
+
+    def _add(self, keys):
+        with self._lock:
+            for key in keys:
+                self.bloom.add(key)
+                if self._rebuilding is not None:
+                    self._rebuilding.append((True, key))
+
+    def _maybe_grow(self):
+        # key数超过设计容量后误判率上升很快, 按两倍重建, 和哈希表扩容一样摊下来是常数;
+        # 重建是O(n)的, 放到后台线程, 不让这次写和它持有的锁等着
+        bloom = self.bloom
+        if bloom.count <= bloom.capacity or self._rebuilding is not None:
+            return
+        with self._lock:
+            if self._rebuilding is not None or (self._grower is not None and self._grower.is_alive()):
+                return
+            self._grower = threading.Thread(target=self.rebuild, args=(2 * bloom.count,), daemon=True)
+            self._grower.start()
+
+    def _maybe_present(self, key):
+        # 读不加锁: 和并发的写交错时, 结果等同于这次读发生在写之前或之后; negatives只是近似的计数
+        present = key in self.bloom
+        if not present:
+            self.negatives += 1
+        return present
+
+    def __setitem__(self, key, value):
+        new = not self._maybe_present(key) or self.engine.get(key) is None
+        self.engine[key] = value
+        if new:
+            self._add((key,))
+            self._maybe_grow()
+
+    def get(self, key):
+        if not self._maybe_present(key):
+            return None
+        return self.engine.get(key)
+
+    def mget(self, keys):
+        out = [None] * len(keys)
+        maybe = [j for j, key in enumerate(keys) if self._maybe_present(key)]
+        if not maybe:
+            return out
+        part = [keys[j] for j in maybe]
+        engine = self.engine
+        values = engine.mget(part) if hasattr(engine, "mget") else [engine.get(key) for key in part]
+        for j, value in zip(maybe, values):
+            out[j] = value
+        return out
+
+    def _new_keys(self, items):
+        # items里在引擎中还不存在的key, 去重
+        keys = list(dict.fromkeys(key for key, _ in items))
+        existing = self.mget(keys)
+        return [key for key, value in zip(keys, existing) if value is None]
+
+    def _del(self, key):
+        del self.engine[key]
+        with self._lock:
+            self.bloom.remove(key)
+            if self._rebuilding is not None:
+                self._rebuilding.append((False, key))
+
+    def mset(self, items):
+        items = list(items)
+        new = self._new_keys(items)
+        engine = self.engine
+        if hasattr(engine, "mset"):
+            engine.mset(items)
+        else:
+            for key, value in items:
+                engine[key] = value
+        self._add(new)
+        self._maybe_grow()
+
+    def bulk_load(self, items):
+        if hasattr(self.engine, "bulk_load"):
+            new = []
+            self.engine.bulk_load(self._checked(iter(items), new))
+            self._add(new)
+            self._maybe_grow()
+        else:
+            self.mset(items)
+
+    def _checked(self, items, new, chunk=1024):
+        # 边交给引擎边按块查出还不存在的key放进new; 引擎装载时才读到这一块, 查的是装载之前的内容
+        for part in iter(lambda: list(islice(items, chunk)), []):
+            new += self._new_keys(part)
+            yield from part
+
+    def __len__(self):
+        return len(self.engine)
+
+    def items(self):
+        return self.engine.items()
+
+    @property
+    def ordered(self) -> bool:
+        return hasattr(self.engine, "scan") and getattr(self.engine, "ordered", True)
+
+    def _scan(self, start, end, reverse):
+        if not hasattr(self.engine, "scan"):
+            raise Exception("this engine is not ordered, scan is not supported")
+        return self.engine.scan(start, end, None, reverse)
+
+    def stats(self) -> dict:
+        '''
+        过滤器的大小和估算误判率, 以及被过滤器直接挡掉的查找次数; 引擎有stats时放在"engine"里
+        '''
+        with self._lock:
+            bloom = self.bloom
+            stats = {
+                "bloom_counters": bloom.m,
+                "bloom_hashes": bloom.k,
+                "bloom_keys": bloom.count,
+                "bloom_false_positive_rate": bloom.false_positive_rate(),
+                "bloom_negatives": self.negatives,
+            }
+        if hasattr(self.engine, "stats"):
+            stats["engine"] = self.engine.stats()
+        return stats
@@ -0,0 +1,315 @@
+import sys
+import threading
+from collections import OrderedDict
+
+from .base import BaseMapWrapper
+
+
+def entry_size(key, value):
+    # 按对象实际占用估算, 和dict槽位等固定开销相比key和value是大头
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+class Cache:
+    '''
+    按字节预算缓存value的策略的公共部分: 命中/未命中/淘汰计数
+    子类实现 get(key) -> value或None, put(key, value, size), discard(key), clear()
+    '''
+
+    def __init__(self, capacity_bytes: int):
+        self.capacity = capacity_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "policy": self.policy,
+            "capacity_bytes": self.capacity,
+            "bytes": self.size_bytes(),
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+class LRUCache(Cache):
+    policy = "lru"
+
+    def __init__(self, capacity_bytes: int):
+        super().__init__(capacity_bytes)
+        # key -> (value, size), 末尾是最近用过的
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size_bytes(self):
+        return self._bytes
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        self.discard(key)
+        if size > self.capacity:
+            return
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while self._bytes > self.capacity:
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self._bytes -= old_size
+            self.evictions += 1
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+
+class ARCCache(Cache):
+    '''
+    Adaptive Replacement Cache (Megiddo & Modha), 按字节而不是条数计量
+
+    T1: 只访问过一次的, T2: 访问过至少两次的, B1/B2: 最近从T1/T2淘汰的key(只记key和大小, 不存value)
+    命中B1说明T1给小了, 把T1的目标大小p调大; 命中B2反之. 一次性的大范围扫描只会冲掉T1, 热点留在T2
+    '''
+    policy = "arc"
+
+    def __init__(self, capacity_bytes: int):
+        super().__init__(capacity_bytes)
+        self.p = 0
+        self._t1 = OrderedDict()
+        self._t2 = OrderedDict()
+        self._b1 = OrderedDict()
+        self._b2 = OrderedDict()
+        # 四个列表各自的字节数
+        self._t1_bytes = self._t2_bytes = self._b1_bytes = self._b2_bytes = 0
+
+    def __len__(self):
+        return len(self._t1) + len(self._t2)
+
+    def size_bytes(self):
+        return self._t1_bytes + self._t2_bytes
+
+    def get(self, key):
+        entry = self._t1.pop(key, None)
+        if entry is not None:
+            # 第二次访问, 升到T2
+            self._t1_bytes -= entry[1]
+            self._t2[key] = entry
+            self._t2_bytes += entry[1]
+        else:
+            entry = self._t2.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._t2.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size):
+        self.discard(key)
+        if size > self.capacity:
+            return
+        if key in self._b1:
+            ghost = self._b1.pop(key)
+            self._b1_bytes -= ghost
+            delta = max(self._b2_bytes / max(self._b1_bytes + ghost, 1), 1) * size
+            self.p = min(self.capacity, self.p + delta)
+            self._insert(self._t2, key, value, size, False)
+        elif key in self._b2:
+            ghost = self._b2.pop(key)
+            self._b2_bytes -= ghost
+            delta = max(self._b1_bytes / max(self._b2_bytes + ghost, 1), 1) * size
+            self.p = max(0, self.p - delta)
+            self._insert(self._t2, key, value, size, True)
+        else:
+            self._insert(self._t1, key, value, size, False)
+        self._trim_ghosts()
+
+    def _insert(self, target, key, value, size, in_b2):
+        while self._t1_bytes + self._t2_bytes + size > self.capacity:
+            self._replace(in_b2)
+        target[key] = (value, size)
+        if target is self._t1:
+            self._t1_bytes += size
+        else:
+            self._t2_bytes += size
+
+    def _replace(self, in_b2):
+        # 按p决定从T1还是T2淘汰最久没用的, 被淘汰的key进对应的ghost列表
+        if self._t1 and (self._t1_bytes > self.p or (in_b2 and self._t1_bytes >= self.p) or not self._t2):
+            key, (_, size) = self._t1.popitem(last=False)
+            self._t1_bytes -= size
+            self._b1[key] = size
+            self._b1_bytes += size
+        else:
+            key, (_, size) = self._t2.popitem(last=False)
+            self._t2_bytes -= size
+            self._b2[key] = size
+            self._b2_bytes += size
+        self.evictions += 1
+
+    def _trim_ghosts(self):
+        # |T1| + |B1| <= c, 四个列表合计 <= 2c
+        while self._b1 and self._t1_bytes + self._b1_bytes > self.capacity:
+            _, size = self._b1.popitem(last=False)
+            self._b1_bytes -= size
+        while self._b2 and self.size_bytes() + self._b1_bytes + self._b2_bytes > 2 * self.capacity:
+            _, size = self._b2.popitem(last=False)
+            self._b2_bytes -= size
+
+    def discard(self, key):
+        entry = self._t1.pop(key, None)
+        if entry is not None:
+            self._t1_bytes -= entry[1]
+            return
+        entry = self._t2.pop(key, None)
+        if entry is not None:
+            self._t2_bytes -= entry[1]
+
+    def clear(self):
+        for lst in (self._t1, self._t2, self._b1, self._b2):
+            lst.clear()
+        self._t1_bytes = self._t2_bytes = self._b1_bytes = self._b2_bytes = 0
+        self.p = 0
+
+
+POLICIES = {"lru": LRUCache, "arc": ARCCache}
+
+
+class CachedWrapper(BaseMapWrapper):
+    '''
+    在引擎前面加一层读缓存(read-through): get先查缓存, 未命中时读引擎并放进缓存
+    写(set/delete/mset/bulk_load)先写引擎再让缓存里的key失效(write-through invalidation)
+
+    读引擎和放进缓存之间如果有写让缓存失效过, 这次读到的值不放进缓存, 避免旧值被缓存下来
+    其他属性(lock_for, flush等)透传给引擎
+    '''
+
+    def __init__(self, engine, capacity_bytes: int, policy: str = "lru"):
+        if policy not in POLICIES:
+            raise Exception("unknown cache policy: {}".format(policy))
+        self.engine = engine
+        self.cache = POLICIES[policy](capacity_bytes)
+        self._lock = threading.Lock()
+        # 每次失效加一
+        self._generation = 0
+
+    def __getattr__(self, name):
+        # 只在本对象上找不到时调用, 透传给引擎
+        return getattr(self.engine, name)
+
+    def _invalidate(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self.cache.discard(key)
+
+    def __setitem__(self, key, value):
+        self.engine[key] = value
+        self._invalidate((key,))
+
+    def get(self, key):
+        with self._lock:
+            value = self.cache.get(key)
+            generation = self._generation
+        if value is not None:
+            return value
+        value = self.engine.get(key)
+        if value is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self.cache.put(key, value, entry_size(key, value))
+        return value
+
+    def mget(self, keys):
+        out = [None] * len(keys)
+        missing = []
+        with self._lock:
+            for j, key in enumerate(keys):
+                value = self.cache.get(key)
+                if value is None:
+                    missing.append(j)
+                else:
+                    out[j] = value
+            generation = self._generation
+        if not missing:
+            return out
+        part = [keys[j] for j in missing]
+        engine = self.engine
+        values = engine.mget(part) if hasattr(engine, "mget") else [engine.get(key) for key in part]
+        with self._lock:
+            fresh = generation == self._generation
+            for j, key, value in zip(missing, part, values):
+                out[j] = value
+                if fresh and value is not None:
+                    self.cache.put(key, value, entry_size(key, value))
+        return out
+
+    def _del(self, key):
+        del self.engine[key]
+        self._invalidate((key,))
+
+    def mset(self, items):
+        items = list(items)
+        engine = self.engine
+        if hasattr(engine, "mset"):
+            engine.mset(items)
+        else:
+            for key, value in items:
+                engine[key] = value
+        self._invalidate(key for key, _ in items)
+
+    def bulk_load(self, items):
+        if hasattr(self.engine, "bulk_load"):
+            # 不留着items逐个失效, 装完整个清掉缓存; bulk_load一般是空表启动时, 缓存里本来也没有东西
+            self.engine.bulk_load(items)
+            self.clear_cache()
+        else:
+            self.mset(items)
+
+    def __len__(self):
+        return len(self.engine)
+
+    def items(self):
+        return self.engine.items()
+
+    @property
+    def ordered(self) -> bool:
+        return hasattr(self.engine, "scan") and getattr(self.engine, "ordered", True)
+
+    def _scan(self, start, end, reverse):
+        if not hasattr(self.engine, "scan"):
+            raise Exception("this engine is not ordered, scan is not supported")
+        return self.engine.scan(start, end, None, reverse)
+
+    def stats(self) -> dict:
+        '''
+        缓存的命中/未命中/淘汰计数, 引擎有stats时放在"engine"里
+        '''
+        with self._lock:
+            stats = self.cache.stats()
+        if hasattr(self.engine, "stats"):
+            stats["engine"] = self.engine.stats()
+        return stats
+
+    def clear_cache(self):
+        self._invalidate(())
+        with self._lock:
+            self.cache.clear()
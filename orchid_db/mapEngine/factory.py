@@ -1,9 +1,15 @@
 from enum import Enum
 
+from .bitcask import BitcaskWrapper
+from .bPlusTree import BPlusTreeWrapper
 from .bTree import BTreeWrapper
 from .hashmap import HashMapWrapper
 
-from .inderdb import inder_db
+from .inderdb import CompactInderDB, inder_db
+from .lsm import LSMWrapper
+from .pagedBTree import PagedBTreeWrapper
+from .sharded import ShardedWrapper
+from .skipList import SkipListWrapper
 
 
 class EngineType(Enum):
@@ -11,10 +17,19 @@ class EngineType(Enum):
     hashMap = "hashMap"
     bTreeMap = "bTreeMap"
     binarySearchMap = "binarySearchMap"
+    bitcask = "bitcask"
+    bPlusTreeMap = "bPlusTreeMap"
+    pagedBTreeMap = "pagedBTreeMap"
+    sharded = "sharded"
+    lsm = "lsm"
+    skipList = "skipList"
 
 class MapEngineFactory:
     @staticmethod
-    def create(engine):
+    def create(engine, **options):
+        '''
+        options 传给需要参数的引擎, 比如bitcask的path
+        '''
         if engine == "dict":
             return dict()
         elif engine == "hashMap":
@@ -22,7 +37,29 @@ class MapEngineFactory:
         elif engine == "bTreeMap":
             return BTreeWrapper()
         elif engine == "binarySearchMap":
-            return inder_db()
+            # compact=True 用省内存的数组存储
+            if options.pop("compact", False):
+                return CompactInderDB(**options)
+            return inder_db(**options)
+        elif engine == "bitcask":
+            return BitcaskWrapper(**options)
+        elif engine == "bPlusTreeMap":
+            return BPlusTreeWrapper(**options)
+        elif engine == "pagedBTreeMap":
+            return PagedBTreeWrapper(**options)
+        elif engine == "skipList":
+            return SkipListWrapper(**options)
+        elif engine == "lsm":
+            # path 目录, 放WAL, 有序文件和MANIFEST; 其余options见LSMTree
+            return LSMWrapper(**options)
+        elif engine == "sharded":
+            # shards 分片数, shard_engine 每个分片用的引擎, 其余options传给它
+            # 单例引擎(hashMap/bTreeMap)和自己管理文件的引擎不能分片
+            shards = options.pop("shards", 16)
+            shard_engine = options.pop("shard_engine", "dict")
+            if shard_engine not in ("dict", "binarySearchMap", "bPlusTreeMap", "skipList"):
+                raise Exception("{} can not be sharded".format(shard_engine))
+            return ShardedWrapper([MapEngineFactory.create(shard_engine, **options) for _ in range(shards)])
 
 
 
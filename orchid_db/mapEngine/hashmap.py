@@ -1,4 +1,5 @@
 import collections
+from array import array
 
 __all__ = ['Hashmap']
 
@@ -8,9 +9,86 @@ from mapEngine.base import BaseMapWrapper
 
 MINSIZE = 8
 PERTURB_SHIFT = 5
+# entries moved from the old table by every operation during a resize
+REHASH_STEP = 16
+
+# index slot states, any value >= 0 is a position in the entries
+FREE = -1
+DUMMY = -2
 
 KeyValue = collections.namedtuple('KeyValue', ('key', 'value'))
 
+_DELETED = object()
+_HASH_MASK = (1 << 64) - 1
+
+
+def _index_array(size):
+    # The smallest signed typecode that can address every entry, as in dictobject.c
+    if size <= 0x80:
+        typecode = 'b'
+    elif size <= 0x8000:
+        typecode = 'h'
+    elif size <= 0x80000000:
+        typecode = 'i'
+    else:
+        typecode = 'q'
+    return array(typecode, [FREE]) * size
+
+
+class _Table:
+    """One compact table: the sparse index and the dense entries"""
+
+    __slots__ = ('index', 'hashes', 'keys', 'values', 'live', 'usable')
+
+    def __init__(self, size):
+        self.index = _index_array(size)
+        self.usable = size * 2 // 3
+        self.hashes = array('q')
+        self.keys = []
+        self.values = []
+        self.live = 0
+
+    def lookup(self, key, h, shift):
+        # Returns (index slot, entry position). When the key is missing the
+        # position is negative and the slot is where it should be inserted:
+        # the first DUMMY on the probe path, or else the FREE slot ending it.
+        #
+        # The probe sequence is the one of dictobject.c: the perturbation is
+        # taken unsigned, so it reaches 0 and the recurrence then visits every slot.
+        index = self.index
+        hashes = self.hashes
+        keys = self.keys
+        mask = len(index) - 1
+        perturb = h & _HASH_MASK
+        i = perturb & mask
+        dummy = -1
+        while True:
+            ix = index[i]
+            if ix == FREE:
+                return (i if dummy < 0 else dummy), FREE
+            if ix == DUMMY:
+                if dummy < 0:
+                    dummy = i
+            elif hashes[ix] == h:
+                k = keys[ix]
+                if k is key or k == key:
+                    return i, ix
+            perturb >>= shift
+            i = (5 * i + perturb + 1) & mask
+
+    def append(self, slot, h, key, value):
+        self.index[slot] = len(self.keys)
+        self.hashes.append(h)
+        self.keys.append(key)
+        self.values.append(value)
+        self.live += 1
+
+    def remove(self, slot, ix):
+        self.index[slot] = DUMMY
+        self.keys[ix] = _DELETED
+        self.values[ix] = None
+        self.live -= 1
+
 
 class Hashmap:
     """An implementation of dictobj in pure Python
@@ -29,9 +107,18 @@ class Hashmap:
         len(x) => Integer
         del x[key] 
 
-    Open address probing is most effective when its load < 2/3. This 
-    implementation resizes the backing structure when the load exceeds
-    this value. 
+    Like the compact dict of CPython 3.6+, a table is split in two: a
+    sparse index array of small integers (array('b'/'h'/'i'/'q'), sized
+    to a power of two) and dense entries kept in insertion order in three
+    parallel arrays of hashes, keys and values. Only the index is probed;
+    its slots hold FREE, DUMMY (a deleted entry) or an entry position.
+
+    Resizing is progressive, as in the dict of Redis. When the entries
+    reach 2/3 of the index, or the load falls under ~ 1/6, a second table
+    of the new size is created and every later operation moves up to
+    `rehash_step` entries of the old table into it, using the cached
+    hashes. Meanwhile lookups consult both tables and inserts go to the
+    new one, so no single write pays for rebuilding the whole map.
 
     Hashmap uses the hash() primitive to generate hash keys. The open
     address indexing as that of dictobj. For additional references,
@@ -40,15 +127,20 @@ class Hashmap:
     http://svn.python.org/view/python/trunk/Objects/dictobject.c?view=markup
     http://svn.python.org/view/python/trunk/Objects/dictnotes.txt?view=markup
     http://www.laurentluce.com/posts/python-dictionary-implementation/
+    http://redis.io/docs/reference/internals/rehashing/
     
     """
 
     absent = object()
 
-    def __init__(self, minsize=MINSIZE, perturb_shift=PERTURB_SHIFT):
-        self._minsize = minsize
+    def __init__(self, minsize=MINSIZE, perturb_shift=PERTURB_SHIFT, rehash_step=REHASH_STEP):
+        self._minsize = 1 << max(minsize - 1, 1).bit_length()
         self._perturb_shift = perturb_shift
-        self._build(self._minsize)
+        self._rehash_step = rehash_step
+        self._table = _Table(self._minsize)
+        # the table being migrated into self._table, and the next entry to move
+        self._old = None
+        self._rehash_pos = 0
 
     def __getitem__(self, key):
         """x[key] => value or Hashmap.absent
@@ -56,28 +148,42 @@ class Hashmap:
         Returns the value of the Hashmap at the key, or Hashmap.absent 
 
         """
-        _, kv_pair = self._lookup(key, self._backing)
-        if kv_pair:
-            return kv_pair.value
-        else:
+        if self._old is not None:
+            self._rehash()
+        h = hash(key)
+        table = self._table
+        ix = table.lookup(key, h, self._perturb_shift)[1]
+        if ix < 0 and self._old is not None:
+            table = self._old
+            ix = table.lookup(key, h, self._perturb_shift)[1]
+        if ix < 0:
             return Hashmap.absent
+        return table.values[ix]
 
     def __setitem__(self, key, value):
         """x[key] = value
 
-        Sets the value of the Hashmap at the key. It resizes the backing
-        structure if the utilization of the Hashmap is > ~ 2/3
+        Sets the value of the Hashmap at the key. It starts a resize when
+        the entries reach 2/3 of the index
 
         """
-        i, kv_pair = self._lookup(key, self._backing)
-        self._backing[i] = KeyValue(key, value)
-        if kv_pair is None:
-            self._used += 1
-
-        size = len(self._backing)
-        utilization = self._used / size
-        if utilization > 0.67:
-            self._resize(self._incr_size(size))
+        if self._old is not None:
+            self._rehash()
+        h = hash(key)
+        shift = self._perturb_shift
+        slot, ix = self._table.lookup(key, h, shift)
+        if ix >= 0:
+            self._table.values[ix] = value
+            return
+        if self._old is not None:
+            ix = self._old.lookup(key, h, shift)[1]
+            if ix >= 0:
+                self._old.values[ix] = value
+                return
+        if len(self._table.keys) >= self._table.usable:
+            self._start_resize(len(self) + 1)
+            slot = self._table.lookup(key, h, shift)[0]
+        self._table.append(slot, h, key, value)
 
     def __contains__(self, key):
         """key in x => boolean
@@ -85,8 +191,7 @@ class Hashmap:
         Returns true if key is contained in the Hashmap.
 
         """
-        _, kv_pair = self._lookup(key, self._backing)
-        return kv_pair and not kv_pair.value is Hashmap.absent
+        return self[key] is not Hashmap.absent
 
     def __iter__(self):
         """iter(x) => Generator
@@ -95,9 +200,16 @@ class Hashmap:
         the Hashmap.
 
         """
-        for kv_pair in self._backing:
-            if kv_pair and not kv_pair.value is Hashmap.absent:
-                yield kv_pair
+        for key, value in self.items():
+            yield KeyValue(key, value)
+
+    def items(self):
+        """Generates the (key, value) tuples, the entries still in the old table last"""
+        tables = [self._table] if self._old is None else [self._table, self._old]
+        for table in tables:
+            for key, value in zip(table.keys, table.values):
+                if key is not _DELETED:
+                    yield key, value
 
     def __len__(self):
         """len(x) => Integer
@@ -105,73 +217,88 @@ class Hashmap:
         Returns the number of key value tuples stored in the Hashmap.
 
         """
-        return self._used - self._deleted
+        if self._old is None:
+            return self._table.live
+        return self._table.live + self._old.live
 
     def __delitem__(self, key):
         """del(x[key])
 
-        Sets the key in the Hashmap to absent, releasing the original
-        item. It resizes the backing structure if the utilization of 
-        the Hashmap is < ~ 1/6
+        Marks the index slot DUMMY and releases the entry. It starts a
+        resize if the utilization of the Hashmap is < ~ 1/6
 
         """
-        i, kv_pair = self._lookup(key, self._backing)
-        if kv_pair and not kv_pair.value is Hashmap.absent:
-            self._backing[i] = KeyValue(key, Hashmap.absent)
-            self._deleted += 1
-
-            size = len(self._backing)
-            utilization = (self._used - self._deleted) / size
-            if utilization < 0.16:
-                self._resize(self._decr_size(size))
-        else:
+        if self._old is not None:
+            self._rehash()
+        h = hash(key)
+        table = self._table
+        slot, ix = table.lookup(key, h, self._perturb_shift)
+        if ix < 0 and self._old is not None:
+            table = self._old
+            slot, ix = table.lookup(key, h, self._perturb_shift)
+        if ix < 0:
             raise KeyError('no such item!')
-
-    def _lookup(self, key, backing):
-        # Performs a lookup to find the index and value of the key 
-        # in the backing structure
-        for i in self._indices(key, len(backing)):
-            value = backing[i]
-            if value is None or value.key == key:
-                return i, value
-        assert False, 'should not reach this!'
-
-    def _indices(self, key, size):
-        # Produces the list of indices that the Hashmap uses in 
-        # open addressing
-        #
-        # Based on:
-        # http://svn.python.org/view/python/trunk/Objects/dictobject.c?view=markup
-        j = perturb = hash(key)
-        for _ in range(size):
-            j %= size
-            yield j
-            j = 5 * j + 1 + perturb
-            perturb >>= self._perturb_shift
-
-    def _resize(self, new_size):
-        # Resizes the backing structure if new size is different
-        if new_size != len(self._backing):
-            old_backing = self._backing[:]
-            self._build(new_size, old_backing)
-
-    def _build(self, size, init=None):
-        # Build a new backing structure given a old list of (possibly None)
-        # key value tuples
-        if not init:
-            init = []
-        self._backing = [None] * size
-        self._used = 0
-        self._deleted = 0
-        for kv_pair in init:
-            if kv_pair and not kv_pair.value is Hashmap.absent:
-                self[kv_pair.key] = kv_pair.value
-
-    def _incr_size(self, size):
-        return size * 2
-
-    def _decr_size(self, size):
-        return max(self._minsize, size // 2)
+        table.remove(slot, ix)
+
+        size = len(self._table.index)
+        if self._old is None and size > self._minsize and self._table.live / size < 0.16:
+            self._start_resize(self._table.live)
+
+    def _size_for(self, live):
+        # Smallest power of two whose 2/3 holds 'live' entries with room to grow
+        size = self._minsize
+        while size * 2 // 3 < live * 2 or size * 2 // 3 == 0:
+            size <<= 1
+        return size
+
+    def _start_resize(self, live):
+        # The new table has room for twice the live entries, and each operation
+        # moves rehash_step of them, so it cannot fill up before the old one is empty
+        if self._old is not None:
+            self._rehash(len(self._old.keys))
+        self._old = self._table
+        self._table = _Table(self._size_for(live))
+        self._rehash_pos = 0
+
+    def _rehash(self, steps=None):
+        # Moves up to 'steps' entries of the old table into the new one, using the cached hashes
+        old, table = self._old, self._table
+        pos = self._rehash_pos
+        stop = min(pos + (self._rehash_step if steps is None else steps), len(old.keys))
+        index = table.index
+        mask = len(index) - 1
+        shift = self._perturb_shift
+        while pos < stop:
+            key = old.keys[pos]
+            if key is not _DELETED:
+                h = old.hashes[pos]
+                # a key is never in both tables, so the first FREE or DUMMY slot will do
+                perturb = h & _HASH_MASK
+                i = perturb & mask
+                while index[i] >= 0:
+                    perturb >>= shift
+                    i = (5 * i + perturb + 1) & mask
+                table.append(i, h, key, old.values[pos])
+                old.keys[pos] = _DELETED
+                old.values[pos] = None
+                old.live -= 1
+            pos += 1
+        self._rehash_pos = pos
+        if pos == len(old.keys):
+            self._old = None
+
+    def stats(self):
+        # Tombstones are deleted entries still taking a dense slot and a DUMMY index slot
+        # until the next resize; the load factor counts them, since probes do
+        table = self._table
+        slots = len(table.index)
+        return {
+            "keys": len(self),
+            "slots": slots,
+            "load_factor": len(table.keys) / slots,
+            "tombstones": len(table.keys) - table.live,
+            "rehashing": self._old is not None,
+        }
 
 
 class HashMapWrapper(BaseMapWrapper):
@@ -185,7 +312,7 @@ class HashMapWrapper(BaseMapWrapper):
                 if not hasattr(cls, '_instance'):
                     HashMapWrapper._instance = super().__new__(cls)
 
-            return HashMapWrapper._instance
+        return HashMapWrapper._instance
 
     ############################################################################
     def __init__(self):
@@ -193,7 +320,7 @@ class HashMapWrapper(BaseMapWrapper):
 
     def __setitem__(self, key, value):
         assert type(key) == str
-        self.hash_map_core["key"] = value
+        self.hash_map_core[key] = value
 
     def __getitem__(self, key):
         value = self.get(key)
@@ -222,3 +349,12 @@ class HashMapWrapper(BaseMapWrapper):
     def pop(self, key):
         assert type(key) == str
         return self._del(key)
+
+    def __len__(self):
+        return len(self.hash_map_core)
+
+    def items(self):
+        return self.hash_map_core.items()
+
+    def stats(self):
+        return self.hash_map_core.stats()
@@ -1,4 +1,6 @@
 from .base import BaseMapWrapper
+from array import array
+from bisect import bisect_left, bisect_right, insort
 import binascii,base64
 
 class inder_db(BaseMapWrapper):
@@ -11,7 +13,12 @@ class inder_db(BaseMapWrapper):
 	[value]  您要操作的值
 	Available Commands: SET set a key to db GET get a key from db UPDATE update key DELETE delete key
 	'''
-	def __init__(self):
+	def __init__(self, encoded=False):
+		'''
+		encoded 为True时按老格式把key和value先base64再转十六进制存储(兼容用),
+		默认直接存原始字符串, 查找不用编解码
+		'''
+		self.encoded = encoded
 		self.lst_key = []
 		self.lst_value = []
 
@@ -38,100 +45,362 @@ class inder_db(BaseMapWrapper):
 		# print(output)
 		return output
 
+	def _encode(self, data):
+		return self.char2hex(data) if self.encoded else data
 
-	# 这里添加二分查找
-	def _binary_search(self,li, val):
-		left = 0
-		right = len(li) - 1
-		while left <= right:
-			mid = (left + right) // 2
-			if li[mid] == val:
-				return mid
-			elif li[mid] > val:
-				right = mid - 1
-			else:
-				left = mid + 1
-		else:
-			return None
+	def _decode(self, data):
+		return self.hex2char(data) if self.encoded else data
 
-	# 二分法
-	def _binary_search_two(self, li, val):
-		left = 0
-		right = len(li) - 1
-		while left <= right:
-			mid = (left + right) // 2
-			if li[mid] > val:
-				right = mid - 1
-			else:
-				left = mid + 1
-		else:
-			return right
+	# 二分查找, 返回key的位置, 没有返回None
+	def _index(self, key):
+		i = bisect_left(self.lst_key, key)
+		if i < len(self.lst_key) and self.lst_key[i] == key:
+			return i
+		return None
 
 	def __getitem__(self,item):
-		try:
-			item = self.char2hex(item)
-			mid = self._binary_search(self.lst_key,item)
-			return self.hex2char(self.lst_value[mid])
-		except:
+		mid = self._index(self._encode(item))
+		if mid is None:
 			raise Exception("This key is not find")
+		return self._decode(self.lst_value[mid])
 
 	def __setitem__(self, key, value):
-		key = self.char2hex(key)
-		value = self.char2hex(value)
-		# 调用二分法,检测key 值有没有在列表
-		mid = self._binary_search(self.lst_key,key)
-		#print(mid)
+		key = self._encode(key)
+		value = self._encode(value)
+		# 二分法找到key应该在的位置
+		num = bisect_left(self.lst_key, key)
+		# 在的情况
+		if num < len(self.lst_key) and self.lst_key[num] == key:
+			self.lst_value[num] = value
 		# 没有在的情况
-		if mid == None:
-			# 调用半截二分法
-			num = self._binary_search_two(self.lst_key,key)
+		else:
 			self.lst_key.insert(num,key)
 			self.lst_value.insert(num,value)
-		# 在的情况
-		else:
-			#print(1)
-			self.lst_key[mid] = key
-			self.lst_value[mid] = value
 
 	def __delitem__(self, key):
-		key = self.char2hex(key)
-		try:
-			mid = self._binary_search(self.lst_key, key)
-			# print(mid,11111)
-			# 如果 有 key 值,直接删除 , 对应的键值也删除
-			if mid != None:
-				self.lst_key.pop(mid)
-				self.lst_value.pop(mid)
-		except:
-			raise Exception("This key is not find")
+		return self._del(key)
+
+	def get(self, key):
+		lst_key = self.lst_key
+		if self.encoded:
+			key = self.char2hex(key)
+		# 热路径, 直接内联二分查找
+		i = bisect_left(lst_key, key)
+		if i < len(lst_key) and lst_key[i] == key:
+			return self.hex2char(self.lst_value[i]) if self.encoded else self.lst_value[i]
+		return None
+
+	def _del(self, key):
+		mid = self._index(self._encode(key))
+		# 如果 有 key 值,直接删除 , 对应的键值也删除
+		if mid is not None:
+			self.lst_key.pop(mid)
+			self.lst_value.pop(mid)
+
+	def pop(self, key):
+		assert type(key) == str
+		return self._del(key)
+
+	def __len__(self):
+		return len(self.lst_key)
+
+	def items(self):
+		for key, value in zip(self.lst_key, self.lst_value):
+			yield self._decode(key), self._decode(value)
+
+	def stats(self):
+		return {"keys": len(self.lst_key), "encoded": self.encoded}
+
+	def bulk_load(self, items):
+		'''
+		items 按key排好序的(key, value), 和现有数据一趟归并, 相同的key以items为准
+		'''
+		if self.encoded:
+			# 编码后的顺序和key的顺序不一样, 只能逐个插入
+			for key, value in items:
+				self[key] = value
+			return
+		old_key, old_value = self.lst_key, self.lst_value
+		lst_key, lst_value = [], []
+		i = 0
+		for key, value in items:
+			while i < len(old_key) and old_key[i] < key:
+				lst_key.append(old_key[i])
+				lst_value.append(old_value[i])
+				i += 1
+			if i < len(old_key) and old_key[i] == key:
+				i += 1
+			lst_key.append(key)
+			lst_value.append(value)
+		lst_key += old_key[i:]
+		lst_value += old_value[i:]
+		self.lst_key, self.lst_value = lst_key, lst_value
+
+	def mget(self, keys):
+		'''
+		按key排好序依次二分查找, 每次从上一个key的位置开始, 批量查时查找区间越来越小
+		'''
+		if self.encoded:
+			return [self.get(key) for key in keys]
+		lst_key, lst_value = self.lst_key, self.lst_value
+		n = len(lst_key)
+		out = [None] * len(keys)
+		lo = 0
+		for j in sorted(range(len(keys)), key=keys.__getitem__):
+			key = keys[j]
+			lo = bisect_left(lst_key, key, lo)
+			if lo < n and lst_key[lo] == key:
+				out[j] = lst_value[lo]
+		return out
+
+	def mset(self, items):
+		'''
+		批量比较大时排好序和现有数据一趟归并, 代价O(n + m log m); 很小的批量逐个插入
+		'''
+		items = dict(items)
+		if self.encoded or len(items) * 32 < len(self.lst_key):
+			for key, value in items.items():
+				self[key] = value
+		else:
+			self.bulk_load(sorted(items.items()))
+
+	@property
+	def ordered(self) -> bool:
+		return not self.encoded
+
+	def _scan(self, start, end, reverse):
+		if self.encoded:
+			raise Exception("encoded inder_db is not ordered by key, scan is not supported")
+		lst_key, lst_value = self.lst_key, self.lst_value
+		lo = 0 if start is None else bisect_left(lst_key, start)
+		hi = len(lst_key) if end is None else bisect_left(lst_key, end)
+		indexes = range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+		for i in indexes:
+			yield lst_key[i], lst_value[i]
+
+
+class CompactInderDB(BaseMapWrapper):
+
+	'''
+	省内存版的有序数组引擎
+	所有key按utf-8字节首尾相接放在一个bytearray里, 第i个key是keys[key_offs[i]:key_offs[i+1]],
+	value同理, 偏移表用array('Q'), 每条只多8个字节, 没有每个str对象五十多字节的开销
+	写操作先进delta字典(None表示删除), 同时维护一个排好序的delta_keys, 扫描和归并时不用再排序;
+	delta超过delta_limit后和主数组一次归并. 上限是固定的, 不随数据量变: 每个新key插进delta_keys最多挪动delta_limit个引用,
+	代价是每delta_limit次写要整个重写一遍主数组, 数据量大、写多时可以调大delta_limit
+	'''
+	def __init__(self, delta_limit=4096):
+		self.delta_limit = delta_limit
+		self.keys = bytearray()
+		self.key_offs = array('Q', [0])
+		self.values = bytearray()
+		self.value_offs = array('Q', [0])
+		self.delta = {}
+		self.delta_keys = []
+		# delta_keys原地插入的次数, 扫描据此发现自己走到一半的delta_keys变了
+		self._delta_inserts = 0
+		self._size = 0
+
+	def _count(self):
+		return len(self.key_offs) - 1
+
+	def _key_at(self, i):
+		return self.keys[self.key_offs[i]:self.key_offs[i + 1]]
+
+	def _value_at(self, i):
+		return self.values[self.value_offs[i]:self.value_offs[i + 1]].decode("utf-8")
+
+	# 在主数组里二分查找, 返回第一个不小于kb的位置
+	def _bisect(self, kb):
+		keys, offs = self.keys, self.key_offs
+		left, right = 0, len(offs) - 1
+		while left < right:
+			mid = (left + right) // 2
+			if keys[offs[mid]:offs[mid + 1]] < kb:
+				left = mid + 1
+			else:
+				right = mid
+		return left
+
+	def _base_index(self, kb):
+		i = self._bisect(kb)
+		if i < self._count() and self._key_at(i) == kb:
+			return i
+		return None
+
+	def _live(self, key):
+		if key in self.delta:
+			return self.delta[key] is not None
+		return self._base_index(key.encode("utf-8")) is not None
 
 	def get(self, key):
-		key = self.char2hex(key)
-		mid = self._binary_search(self.lst_key, key)
-		try:
-			data=self.lst_value[mid]
-		except:
+		if key in self.delta:
+			return self.delta[key]
+		i = self._base_index(key.encode("utf-8"))
+		if i is None:
 			return None
-		return self.hex2char(data)
+		return self._value_at(i)
+
+	def __getitem__(self, item):
+		value = self.get(item)
+		if value is None:
+			raise Exception("This key is not find")
+		return value
 
+	def _put(self, key, value):
+		if key not in self.delta:
+			insort(self.delta_keys, key)
+			self._delta_inserts += 1
+		self.delta[key] = value
+
+	def __setitem__(self, key, value):
+		if not self._live(key):
+			self._size += 1
+		self._put(key, value)
+		self._maybe_merge()
 
 	def _del(self, key):
-		key = self.char2hex(key)
-		try:
-			mid = self._binary_search(self.lst_key, key)
-			# 如果 有 key 值,直接删除 , 对应的键值也删除
-			if mid != None:
-				self.lst_key.pop(mid)
-				self.lst_value.pop(mid)
+		if self._live(key):
+			self._size -= 1
+			self._put(key, None)
+			self._maybe_merge()
 
-		except:
-			raise Exception("please implementation")
+	def __delitem__(self, key):
+		return self._del(key)
 
 	def pop(self, key):
 		assert type(key) == str
-		key = self.char2hex(key)
 		return self._del(key)
 
+	def __len__(self):
+		return self._size
+
+	def _maybe_merge(self):
+		if len(self.delta) > self.delta_limit:
+			self.merge()
+
+	def merge(self):
+		'''
+		把delta归并进主数组, 一次顺序扫描生成新的bytearray和偏移表
+		'''
+		keys, values = bytearray(), bytearray()
+		key_offs, value_offs = array('Q', [0]), array('Q', [0])
+		for kb, vb in self._merged():
+			if vb is None:
+				continue
+			keys += kb
+			values += vb
+			key_offs.append(len(keys))
+			value_offs.append(len(values))
+		self.keys, self.key_offs = keys, key_offs
+		self.values, self.value_offs = values, value_offs
+		self.delta = {}
+		self.delta_keys = []
+
+	def _merged(self):
+		# 按key顺序归并主数组和delta, 生成(key字节, value字节或None)
+		delta = [(k.encode("utf-8"), None if self.delta[k] is None else self.delta[k].encode("utf-8"))
+				 for k in self.delta_keys]
+		n = self._count()
+		i = j = 0
+		while i < n or j < len(delta):
+			if j == len(delta) or (i < n and self._key_at(i) < delta[j][0]):
+				yield bytes(self._key_at(i)), bytes(self.values[self.value_offs[i]:self.value_offs[i + 1]])
+				i += 1
+			else:
+				if i < n and self._key_at(i) == delta[j][0]:
+					i += 1
+				yield delta[j]
+				j += 1
+
+	def items(self):
+		for kb, vb in self._merged():
+			if vb is not None:
+				yield kb.decode("utf-8"), vb.decode("utf-8")
+
+	def stats(self):
+		# 主数组占的字节数, delta里还没归并的写
+		return {
+			"keys": self._size,
+			"array_keys": self._count(),
+			"key_bytes": len(self.keys) + self.key_offs.itemsize * len(self.key_offs),
+			"value_bytes": len(self.values) + self.value_offs.itemsize * len(self.value_offs),
+			"delta": len(self.delta),
+		}
+
+	def bulk_load(self, items):
+		'''
+		items 按key排好序的(key, value), 空的时候直接顺序写进主数组, 否则放进delta一起归并
+		'''
+		if self._size or self.delta:
+			for key, value in items:
+				if not self._live(key):
+					self._size += 1
+				self.delta[key] = value
+			self.delta_keys = sorted(self.delta)
+			self.merge()
+			return
+		for key, value in items:
+			self.keys += key.encode("utf-8")
+			self.values += value.encode("utf-8")
+			self.key_offs.append(len(self.keys))
+			self.value_offs.append(len(self.values))
+		self._size = self._count()
+
+	def _scan(self, start, end, reverse):
+		# 主数组和delta都二分定位, 然后惰性归并; 开始时取当前的数组和delta, 之后的归并换掉它们也不影响这次扫描
+		keys, key_offs, values, value_offs = self.keys, self.key_offs, self.values, self.value_offs
+		delta, delta_keys = self.delta, self.delta_keys
+		lo = 0 if start is None else self._bisect(start.encode("utf-8"))
+		hi = self._count() if end is None else self._bisect(end.encode("utf-8"))
+		step = -1 if reverse else 1
+
+		def locate(last):
+			# delta_keys里下一个要走的位置: 还没走过任何key时从范围的一端开始, 否则接在last后面
+			if reverse:
+				bound = end if last is None else last
+				return (len(delta_keys) if bound is None else bisect_left(delta_keys, bound)) - 1
+			if last is None:
+				return 0 if start is None else bisect_left(delta_keys, start)
+			return bisect_right(delta_keys, last)
+
+		# 按下标走delta_keys, 不复制; 扫描停在yield的时候有新key插进来, 就用走过的最后一个key重新定位
+		inserts = self._delta_inserts
+		j, last = locate(None), None
+		base = range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+		for i in base:
+			key = keys[key_offs[i]:key_offs[i + 1]].decode("utf-8")
+			while True:
+				if delta_keys is self.delta_keys and self._delta_inserts != inserts:
+					inserts = self._delta_inserts
+					j = locate(last)
+				if not 0 <= j < len(delta_keys) or (delta_keys[j] <= key if reverse else delta_keys[j] >= key):
+					break
+				last = delta_keys[j]
+				j += step
+				if delta[last] is not None:
+					yield last, delta[last]
+			last = key
+			if 0 <= j < len(delta_keys) and delta_keys[j] == key:
+				# delta里的新值或删除标记覆盖主数组
+				j += step
+				if delta[key] is not None:
+					yield key, delta[key]
+			else:
+				yield key, values[value_offs[i]:value_offs[i + 1]].decode("utf-8")
+		while True:
+			if delta_keys is self.delta_keys and self._delta_inserts != inserts:
+				inserts = self._delta_inserts
+				j = locate(last)
+			if not 0 <= j < len(delta_keys):
+				break
+			last = delta_keys[j]
+			if (start is not None and last < start) if reverse else (end is not None and last >= end):
+				break
+			j += step
+			if delta[last] is not None:
+				yield last, delta[last]
+
 # obj = inder_db()
 #
 # obj["key1"] = "value2"
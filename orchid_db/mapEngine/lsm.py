@@ -0,0 +1,775 @@
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+from internal.record import OP_DELETE, OP_SET, decode_record, decode_varint, encode_record, encode_varint
+from .base import BaseMapWrapper
+from .bloom import BloomFilter
+
+RUN_MAGIC = b"ORCHRUN1"
+RUN_SUFFIX = ".run"
+WAL_SUFFIX = ".wal"
+MANIFEST = "MANIFEST"
+# 有序文件的结尾: 索引的偏移, 布隆过滤器的偏移, 记录数, 其中删除标记数, magic
+_FOOTER = struct.Struct("<QQQQ8s")
+# 在这一层没找到, 和找到了删除标记(None)区分开
+_MISSING = object()
+# 估算内存表占用时每条记录的固定开销(列表槽位, dict槽位, str对象头)
+_ENTRY_OVERHEAD = 120
+
+
+def _file_number(name):
+    return int(name.split(".")[0])
+
+
+class Run:
+    '''
+    不可变的有序文件(SSTable), 内容是按key排好序的record.py二进制记录, 删除是OP_DELETE的删除标记
+
+    MAGIC | 数据块... | 稀疏索引 | 布隆过滤器 | footer
+    数据块大约block_bytes一个, 稀疏索引每块一条记录(块的第一个key, 块偏移的varint),
+    打开时整个索引和过滤器读进内存, 查找时过滤器说不存在就直接返回, 否则二分索引找到块, 只解码这一块
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.number = _file_number(os.path.basename(path))
+        with open(path, "rb") as e:
+            self._buf = mmap.mmap(e.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = self._buf
+        self.size = len(buf)
+        if self.size < len(RUN_MAGIC) + _FOOTER.size or buf[:len(RUN_MAGIC)] != RUN_MAGIC:
+            raise Exception("{} is not a run file".format(path))
+        index_offset, bloom_offset, self.count, self.tombstones, magic = _FOOTER.unpack_from(
+            buf, self.size - _FOOTER.size)
+        if magic != RUN_MAGIC:
+            raise Exception("{} is not a run file".format(path))
+        # 每块的第一个key和块的起点, offsets最后多一个数据区的结尾
+        self.first_keys = []
+        self.offsets = []
+        pos = index_offset
+        while pos < bloom_offset:
+            record = decode_record(buf, pos)
+            if record is None:
+                raise Exception("{}: broken index".format(path))
+            _, key, value, pos = record
+            self.first_keys.append(bytes(key))
+            self.offsets.append(decode_varint(value, 0)[0])
+        self.offsets.append(index_offset)
+        self.bloom = BloomFilter.from_bytes(buf[bloom_offset:self.size - _FOOTER.size])
+        # 压缩时被遮住丢掉的旧记录原来的贡献, 记在manifest里, 见LSMTree._compact
+        self.adjust = 0
+        self.first = self.first_keys[0]
+        self.last = self._block(len(self.first_keys) - 1)[-1][0]
+
+    @property
+    def keys(self):
+        # 对引擎key数的贡献: 删除标记大多遮住下层的一个旧值, 所以按-1算; 再加上压缩时的修正
+        return self.count - 2 * self.tombstones + self.adjust
+
+    def _block(self, i):
+        # 解码第i块, return [(key, value或None)]
+        buf = self._buf
+        pos, end = self.offsets[i], self.offsets[i + 1]
+        out = []
+        while pos < end:
+            op, key, value, pos = decode_record(buf, pos)
+            out.append((key, None if op == OP_DELETE else value))
+        return out
+
+    def get(self, kb: bytes):
+        '''
+        return value的bytes, 删除标记返回None, 不在这个文件里返回_MISSING
+        '''
+        if kb not in self.bloom:
+            return _MISSING
+        i = bisect_right(self.first_keys, kb) - 1
+        if i < 0:
+            return _MISSING
+        buf = self._buf
+        pos, end = self.offsets[i], self.offsets[i + 1]
+        while pos < end:
+            op, key, value, pos = decode_record(buf, pos)
+            if key == kb:
+                return None if op == OP_DELETE else value
+            if key > kb:
+                break
+        return _MISSING
+
+    def scan(self, start=None, end=None, reverse=False):
+        '''
+        按key顺序遍历[start, end)里的(key, value或None), key是bytes
+        '''
+        n = len(self.first_keys)
+        if not reverse:
+            i = max(0, bisect_right(self.first_keys, start) - 1) if start is not None else 0
+            for i in range(i, n):
+                for key, value in self._block(i):
+                    if start is not None and key < start:
+                        continue
+                    if end is not None and key >= end:
+                        return
+                    yield key, value
+        else:
+            i = bisect_left(self.first_keys, end) - 1 if end is not None else n - 1
+            for i in range(i, -1, -1):
+                for key, value in reversed(self._block(i)):
+                    if end is not None and key >= end:
+                        continue
+                    if start is not None and key < start:
+                        return
+                    yield key, value
+
+
+class _RunWriter:
+    def __init__(self, path, block_bytes, capacity, error_rate):
+        self.path = path
+        self.block_bytes = block_bytes
+        self._file = open(path, "wb")
+        self._file.write(RUN_MAGIC)
+        self.pos = len(RUN_MAGIC)
+        self._block_start = None
+        self._index = []
+        # 不知道条数时(bulk_load的输入是迭代器)先记下这个文件的key, 写完再按实际条数建过滤器
+        self._error_rate = error_rate
+        self._bloom = BloomFilter(max(1, capacity), error_rate) if capacity is not None else None
+        self._keys = []
+        self.count = 0
+        self.tombstones = 0
+
+    def add(self, kb, vb):
+        if self._block_start is None or self.pos - self._block_start >= self.block_bytes:
+            self._index.append(encode_record(OP_SET, kb, encode_varint(self.pos)))
+            self._block_start = self.pos
+        record = encode_record(OP_DELETE, kb, b"") if vb is None else encode_record(OP_SET, kb, vb)
+        self._file.write(record)
+        self.pos += len(record)
+        if self._bloom is not None:
+            self._bloom.add(kb)
+        else:
+            self._keys.append(kb)
+        self.count += 1
+        self.tombstones += vb is None
+
+    def finish(self) -> Run:
+        index_offset = self.pos
+        index = b"".join(self._index)
+        if self._bloom is None:
+            self._bloom = BloomFilter(max(1, self.count), self._error_rate)
+            for kb in self._keys:
+                self._bloom.add(kb)
+        bloom = self._bloom.to_bytes()
+        self._file.write(index)
+        self._file.write(bloom)
+        self._file.write(_FOOTER.pack(index_offset, index_offset + len(index), self.count, self.tombstones,
+                                      RUN_MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        return Run(self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path)
+
+
+class _Memtable:
+    '''
+    内存表: 有序的key列表加上dict, value为None是删除标记; 每个内存表有自己的WAL文件
+    '''
+
+    __slots__ = ("keys", "data", "bytes", "number", "wal", "live")
+
+    def __init__(self, number, wal):
+        self.keys = []
+        self.data = {}
+        self.bytes = 0
+        self.number = number
+        self.wal = wal
+        # 对引擎key数的贡献, 和Run.keys一样估算: 每个value算+1, 每个删除标记算-1
+        self.live = 0
+
+    def put(self, key, value):
+        '''
+        return 这次写让估算的key数变了多少
+        '''
+        delta = 1 if value is not None else -1
+        if key not in self.data:
+            insort(self.keys, key)
+            self.bytes += len(key) + _ENTRY_OVERHEAD
+        else:
+            old = self.data[key]
+            self.bytes -= len(old) if old is not None else 0
+            delta -= 1 if old is not None else -1
+        self.data[key] = value
+        self.bytes += len(value) if value is not None else 0
+        self.live += delta
+        return delta
+
+    def scan(self, start, end, reverse):
+        # 复制[start, end)的key列表(只复制引用), 惰性地转成bytes和有序文件一起归并, 带limit的扫描不用转换整个范围
+        # key不会从内存表里删掉(删除是None), 遍历时读到的value可能比复制时新
+        lo = bisect_left(self.keys, start) if start is not None else 0
+        hi = bisect_left(self.keys, end) if end is not None else len(self.keys)
+        keys = self.keys[lo:hi]
+        if reverse:
+            keys.reverse()
+        data = self.data
+        for key in keys:
+            value = data[key]
+            yield key.encode("utf-8"), None if value is None else value.encode("utf-8")
+
+
+def _tagged(source, tag):
+    # key相同时按tag排序, 新的来源排在前面
+    for key, value in source:
+        yield key, tag, value
+
+
+def _merge(sources, reverse=False, shadowed=None):
+    '''
+    归并多个有序的(key, value或None)流, sources按新旧排列, 下标小的新; 同一个key只留最新的一条
+    shadowed 不为None时是一个list, 被遮住丢掉的旧记录按Run.keys的算法(value +1, 删除标记 -1)累加到shadowed[0]
+    '''
+    streams = [_tagged(source, -i if reverse else i) for i, source in enumerate(sources)]
+    last = None
+    for key, _, value in heapq.merge(*streams, reverse=reverse):
+        if key != last:
+            last = key
+            yield key, value
+        elif shadowed is not None:
+            shadowed[0] += 1 if value is not None else -1
+
+
+class LSMTree:
+    '''
+    Log-structured merge tree
+
+    写先追加到当前内存表的WAL, 再写进内存表; 内存表超过memtable_bytes就冻结, 换一个新的内存表和WAL,
+    落盘线程把冻结的内存表写成L0的有序文件, 写完之后删掉它的WAL.
+    L0的文件之间key范围会重叠, 按新旧排列; L1及以下每层是一个不重叠的有序序列, 由多个文件组成.
+    分层(leveled)压缩在另一个后台线程: L0的文件数到l0_trigger, 或第i层超过level_bytes * fanout**(i-1),
+    就把这一层和下一层整体归并成新的下一层, 合到最底层时丢掉删除标记.
+    落盘和压缩互不等待, 一次大的压缩期间内存表照常落盘; 只有L0堆到l0_stop个文件时落盘才等压缩
+
+    写是盲写, 不查旧值: 删除不存在的key也只是写一个删除标记. 所以len是估算值,
+    每个value算+1, 每个删除标记算-1(假设它遮住了一个旧值). 压缩时新旧记录相遇, 被遮住的旧记录的贡献
+    记进新文件的修正值, 合并前后的总数不变; 合到最底层时新文件的贡献就是它的value数, 是准确的.
+    所以写入时猜错的部分(删除不存在的key, 覆盖下层已有的key)合到最底层之后就消掉了
+
+    读依次查 内存表 -> 冻结的内存表(新到旧) -> L0(新到旧) -> L1 -> L2 ..., 第一个找到的为准,
+    每个文件先查布隆过滤器; 范围扫描把所有来源按key归并
+    manifest(JSON)记录每层有哪些文件, 先写好新文件再原子替换manifest, 最后删旧文件.
+    manifest里还可以记一个检查点(set_checkpoint), 打开之后第一次写就把它清掉,
+    上层据此判断引擎的内容是不是还和它记下检查点时一样
+    '''
+
+    def __init__(self, path, memtable_bytes=4 * 1024 * 1024, block_bytes=4096, run_bytes=8 * 1024 * 1024,
+                 l0_trigger=4, l0_stop=20, level_bytes=32 * 1024 * 1024, fanout=10, max_immutables=2,
+                 bloom_error_rate=0.01):
+        self.path = path
+        self.memtable_bytes = memtable_bytes
+        self.block_bytes = block_bytes
+        self.run_bytes = run_bytes
+        self.l0_trigger = l0_trigger
+        self.l0_stop = max(l0_stop, l0_trigger)
+        self.level_bytes = level_bytes
+        self.fanout = fanout
+        self.max_immutables = max_immutables
+        self.bloom_error_rate = bloom_error_rate
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        # levels[i] 是 (文件元组, 各文件第一个key的列表), L0按新到旧, 其他层按key
+        self.levels = [((), [])]
+        self._immutables = []
+        # 估算的key数: 所有文件的Run.keys之和, 所有内存表的live之和
+        self._run_keys = 0
+        self._mem_keys = 0
+        self._next_file = 1
+        self._flushed_wal = 0
+        self._checkpoint = None
+        self._compacting = False
+        self._closing = False
+        self._error = None
+        self.flushes = 0
+        self.compactions = 0
+        self.wal_bytes = 0
+        self.run_bytes_written = 0
+        self._load()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+        self._compactor = threading.Thread(target=self._compact_loop, daemon=True)
+        self._compactor.start()
+
+    # ---------------------------------------------------------------- 启动和manifest
+
+    def _file(self, number, suffix):
+        return os.path.join(self.path, "{:06d}{}".format(number, suffix))
+
+    def _load(self):
+        manifest_path = os.path.join(self.path, MANIFEST)
+        live = set()
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as e:
+                manifest = json.load(e)
+            self._next_file = manifest["next_file"]
+            self._flushed_wal = manifest["flushed_wal"]
+            self._checkpoint = manifest.get("checkpoint")
+            levels = []
+            for numbers in manifest["levels"]:
+                runs = tuple(Run(self._file(number, RUN_SUFFIX)) for number in numbers)
+                for run in runs:
+                    run.adjust = manifest.get("adjust", {}).get(str(run.number), 0)
+                levels.append((runs, [run.first for run in runs]))
+                live.update(numbers)
+            self._set_levels(levels)
+        wals = []
+        for name in os.listdir(self.path):
+            if name.endswith(RUN_SUFFIX) and _file_number(name) not in live:
+                # 压缩或落盘写到一半崩溃留下的文件, manifest里没有
+                os.remove(os.path.join(self.path, name))
+            elif name.endswith(WAL_SUFFIX):
+                if _file_number(name) <= self._flushed_wal:
+                    os.remove(os.path.join(self.path, name))
+                else:
+                    wals.append(_file_number(name))
+            if name[:6].isdigit():
+                self._next_file = max(self._next_file, _file_number(name) + 1)
+        # 还没落盘的WAL按顺序重放, 每个WAL成为一个冻结的内存表, 由落盘线程写成文件
+        for number in sorted(wals):
+            self._memtable = _Memtable(number, None)
+            self._replay_wal(number)
+            if not self._memtable.data:
+                os.remove(self._file(number, WAL_SUFFIX))
+                continue
+            self._immutables.append(self._memtable)
+        self._memtable = self._new_memtable()
+
+    def _replay_wal(self, number):
+        path = self._file(number, WAL_SUFFIX)
+        size = os.path.getsize(path)
+        if size == 0:
+            return
+        with open(path, "rb") as e, mmap.mmap(e.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            pos = 0
+            while pos < size:
+                record = decode_record(buf, pos)
+                if record is None:
+                    logging.warning("%s: drop %d bytes of torn record", path, size - pos)
+                    break
+                op, key, value, pos = record
+                value = None if op == OP_DELETE else str(value, "utf-8")
+                self._mem_keys += self._memtable.put(str(key, "utf-8"), value)
+
+    def _new_memtable(self):
+        number = self._next_file
+        self._next_file += 1
+        return _Memtable(number, open(self._file(number, WAL_SUFFIX), "ab"))
+
+    def _set_levels(self, levels):
+        # 调用方持有self._lock(或者还在__init__里)
+        self.levels = levels
+        self._run_keys = sum(run.keys for runs, _ in levels for run in runs)
+
+    def _write_manifest(self):
+        # 调用方持有self._lock
+        manifest = {
+            "next_file": self._next_file,
+            "flushed_wal": self._flushed_wal,
+            "checkpoint": self._checkpoint,
+            "levels": [[run.number for run in runs] for runs, _ in self.levels],
+            "adjust": {str(run.number): run.adjust for runs, _ in self.levels for run in runs if run.adjust},
+        }
+        path = os.path.join(self.path, MANIFEST)
+        with open(path + ".tmp", "w") as e:
+            json.dump(manifest, e)
+            e.flush()
+            os.fsync(e.fileno())
+        os.replace(path + ".tmp", path)
+
+    def checkpoint(self):
+        '''
+        return 上次set_checkpoint记下的值, 之后有过写(或从没记过)返回None
+        '''
+        with self._lock:
+            return self._checkpoint
+
+    def set_checkpoint(self, stamp):
+        '''
+        把内存表落盘, 然后在manifest里记下stamp(能写成JSON的值)
+        '''
+        self.flush()
+        with self._lock:
+            self._checkpoint = stamp
+            self._write_manifest()
+
+    def clear(self):
+        '''
+        删掉所有内容, 等正在进行的落盘和压缩结束之后丢掉所有文件
+        '''
+        with self._lock:
+            while (self._immutables or self._compacting) and self._error is None:
+                self._changed.wait()
+            if self._error is not None:
+                raise Exception("lsm background work failed") from self._error
+            runs = [run for runs, _ in self.levels for run in runs]
+            old = self._memtable
+            old.wal.close()
+            self._memtable = self._new_memtable()
+            self._flushed_wal = old.number
+            self._mem_keys = 0
+            self._checkpoint = None
+            self._set_levels([((), [])])
+            self._write_manifest()
+        os.remove(self._file(old.number, WAL_SUFFIX))
+        for run in runs:
+            os.remove(run.path)
+
+    # ---------------------------------------------------------------- 读写
+
+    def _lookup(self, key):
+        '''
+        return str value, 不存在(或已删除)返回None
+        '''
+        value = self._memtable.data.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            immutables = self._immutables
+            levels = self.levels
+        for memtable in reversed(immutables):
+            value = memtable.data.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        kb = key.encode("utf-8")
+        runs, _ = levels[0]
+        for run in runs:
+            if run.first <= kb <= run.last:
+                value = run.get(kb)
+                if value is not _MISSING:
+                    return None if value is None else str(value, "utf-8")
+        for runs, firsts in levels[1:]:
+            i = bisect_right(firsts, kb) - 1
+            if i >= 0 and kb <= runs[i].last:
+                value = runs[i].get(kb)
+                if value is not _MISSING:
+                    return None if value is None else str(value, "utf-8")
+        return None
+
+    def search(self, key):
+        return self._lookup(key)
+
+    def _write(self, key, value):
+        with self._lock:
+            if self._error is not None:
+                raise Exception("lsm background work failed") from self._error
+            if self._checkpoint is not None:
+                # 内容要变了, 先让检查点失效
+                self._checkpoint = None
+                self._write_manifest()
+            if value is None:
+                record = encode_record(OP_DELETE, key.encode("utf-8"), b"")
+            else:
+                record = encode_record(OP_SET, key.encode("utf-8"), value.encode("utf-8"))
+            wal = self._memtable.wal
+            wal.write(record)
+            wal.flush()
+            self.wal_bytes += len(record)
+            self._mem_keys += self._memtable.put(key, value)
+            if self._memtable.bytes >= self.memtable_bytes:
+                self._freeze()
+                # 落盘跟不上时写入等一等, 冻结的内存表不会无限堆积
+                while len(self._immutables) > self.max_immutables and self._error is None:
+                    self._changed.wait()
+
+    def insert(self, key, value):
+        self._write(key, value)
+
+    def delete(self, key):
+        self._write(key, None)
+
+    def _freeze(self):
+        # 调用方持有self._lock
+        memtable = self._memtable
+        memtable.wal.close()
+        self._immutables = self._immutables + [memtable]
+        self._memtable = self._new_memtable()
+        self._changed.notify_all()
+
+    def __len__(self):
+        return max(0, self._run_keys + self._mem_keys)
+
+    def scan(self, start=None, end=None, reverse=False):
+        '''
+        按key顺序惰性遍历[start, end)里的(key, value), 迭代开始时取各层的快照
+        '''
+        sb = start.encode("utf-8") if start is not None else None
+        eb = end.encode("utf-8") if end is not None else None
+        with self._lock:
+            sources = [self._memtable.scan(start, end, reverse)]
+            sources += [memtable.scan(start, end, reverse) for memtable in reversed(self._immutables)]
+            levels = self.levels
+        for level, (runs, _) in enumerate(levels):
+            if level == 0:
+                sources += [run.scan(sb, eb, reverse) for run in runs]
+            else:
+                # 不重叠的一层按顺序接起来就是一个有序流
+                ordered = reversed(runs) if reverse else runs
+                sources.append(self._chain(ordered, sb, eb, reverse))
+        for kb, vb in _merge(sources, reverse):
+            if vb is not None:
+                yield str(kb, "utf-8"), str(vb, "utf-8")
+
+    @staticmethod
+    def _chain(runs, start, end, reverse):
+        for run in runs:
+            if (end is not None and run.first >= end) or (start is not None and run.last < start):
+                continue
+            yield from run.scan(start, end, reverse)
+
+    def bulk_load(self, items):
+        '''
+        items 按key排好序的(key, value); 引擎为空时直接写成最底层的文件, 不经过WAL和内存表
+        '''
+        with self._lock:
+            empty = not self._memtable.data and not self._immutables and not any(
+                runs for runs, _ in self.levels)
+        if not empty:
+            for key, value in items:
+                self._write(key, value)
+            return
+        runs = self._write_runs(((key.encode("utf-8"), value.encode("utf-8")) for key, value in items),
+                                None, True)
+        with self._lock:
+            self._set_levels([((), []), (tuple(runs), [run.first for run in runs])])
+            self._checkpoint = None
+            self._write_manifest()
+
+    # ---------------------------------------------------------------- 落盘和压缩
+
+    def _write_runs(self, entries, capacity, drop_tombstones):
+        '''
+        把有序的(key, value或None)写成若干个大约run_bytes的文件
+        capacity 条数的上限, 用来给每个文件的布隆过滤器定大小; None表示不知道, 每个文件按实际条数建过滤器
+        '''
+        runs = []
+        writer = None
+        try:
+            for kb, vb in entries:
+                if vb is None and drop_tombstones:
+                    continue
+                if writer is None:
+                    with self._lock:
+                        number = self._next_file
+                        self._next_file += 1
+                    writer = _RunWriter(self._file(number, RUN_SUFFIX), self.block_bytes, capacity,
+                                        self.bloom_error_rate)
+                writer.add(kb, vb)
+                if writer.pos >= self.run_bytes:
+                    self.run_bytes_written += writer.pos
+                    runs.append(writer.finish())
+                    writer = None
+            if writer is not None:
+                self.run_bytes_written += writer.pos
+                runs.append(writer.finish())
+                writer = None
+        finally:
+            if writer is not None:
+                writer.abort()
+        return runs
+
+    def _flush_oldest(self):
+        memtable = self._immutables[0]
+        runs = self._write_runs(memtable.scan(None, None, False), len(memtable.keys), False)
+        with self._lock:
+            l0, _ = self.levels[0]
+            l0 = tuple(runs) + l0
+            self._set_levels([(l0, [run.first for run in l0])] + self.levels[1:])
+            self._immutables = self._immutables[1:]
+            self._mem_keys -= memtable.live
+            self._flushed_wal = memtable.number
+            self._write_manifest()
+            self.flushes += 1
+            self._changed.notify_all()
+        os.remove(self._file(memtable.number, WAL_SUFFIX))
+
+    def _level_limit(self, level):
+        return self.level_bytes * self.fanout ** (level - 1)
+
+    def _pick_compaction(self):
+        # 调用方持有self._lock, return 需要往下合并的层, 没有返回None
+        if len(self.levels[0][0]) >= self.l0_trigger:
+            return 0
+        for level in range(1, len(self.levels)):
+            if sum(run.size for run in self.levels[level][0]) > self._level_limit(level):
+                return level
+        return None
+
+    def _compact(self, level):
+        with self._lock:
+            upper = self.levels[level][0]
+            lower = self.levels[level + 1][0] if level + 1 < len(self.levels) else ()
+            # 下面没有更深的层时, 删除标记已经没有要遮住的旧值了
+            bottom = all(not runs for runs, _ in self.levels[level + 2:])
+        if level == 0:
+            sources = [run.scan() for run in upper]
+        else:
+            sources = [self._chain(upper, None, None, False)]
+        sources.append(self._chain(lower, None, None, False))
+        capacity = sum(run.count for run in upper) + sum(run.count for run in lower)
+        shadowed = [0]
+        runs = self._write_runs(_merge(sources, shadowed=shadowed), capacity, bottom)
+        if runs and not bottom:
+            # 合并前后引擎的key数不变: 丢掉的旧记录和参与合并的文件原有的修正都记到新文件上
+            runs[0].adjust = shadowed[0] + sum(run.adjust for run in upper + lower)
+        with self._lock:
+            levels = list(self.levels)
+            # 合并期间L0可能又落盘了新文件, 只去掉参与合并的
+            kept = tuple(run for run in levels[level][0] if run not in upper)
+            levels[level] = (kept, [run.first for run in kept])
+            if level + 1 == len(levels):
+                levels.append(((), []))
+            levels[level + 1] = (tuple(runs), [run.first for run in runs])
+            self._set_levels(levels)
+            self._write_manifest()
+            self.compactions += 1
+        for run in upper + lower:
+            # 正在读这些文件的扫描还持有mmap, 删掉目录项不影响它们
+            os.remove(run.path)
+
+    def _failed(self, e):
+        logging.exception("lsm background work failed")
+        with self._lock:
+            self._error = e
+            self._changed.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                # L0堆到l0_stop个文件时等压缩跟上, 否则每次读都要查越来越多的L0文件; 关闭时照常落盘
+                while self._error is None and not (
+                        self._immutables and (self._closing or len(self.levels[0][0]) < self.l0_stop)):
+                    if self._closing and not self._immutables:
+                        return
+                    self._changed.wait()
+                if self._error is not None:
+                    return
+            try:
+                self._flush_oldest()
+            except Exception as e:
+                self._failed(e)
+                return
+
+    def _compact_loop(self):
+        while True:
+            with self._lock:
+                while not self._closing and self._error is None and self._pick_compaction() is None:
+                    self._changed.wait()
+                if self._closing or self._error is not None:
+                    return
+                level = self._pick_compaction()
+                self._compacting = True
+            try:
+                self._compact(level)
+            except Exception as e:
+                self._failed(e)
+                return
+            finally:
+                with self._lock:
+                    self._compacting = False
+                    self._changed.notify_all()
+
+    def flush(self):
+        '''
+        把内存表写成文件并等落盘完成
+        '''
+        with self._lock:
+            if self._memtable.data:
+                self._freeze()
+            while self._immutables and self._error is None:
+                self._changed.wait()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._closing = True
+            self._changed.notify_all()
+        self._flusher.join()
+        self._compactor.join()
+        self._memtable.wal.close()
+
+    def stats(self):
+        with self._lock:
+            levels = [{"files": len(runs), "bytes": sum(run.size for run in runs),
+                       "entries": sum(run.count for run in runs),
+                       "tombstones": sum(run.tombstones for run in runs)} for runs, _ in self.levels]
+            return {
+                "keys": len(self),
+                "memtable_bytes": self._memtable.bytes,
+                "immutables": len(self._immutables),
+                "compacting": self._compacting,
+                "levels": {str(i): level for i, level in enumerate(levels)},
+                "flushes": self.flushes,
+                "compactions": self.compactions,
+                "wal_bytes": self.wal_bytes,
+                "run_bytes_written": self.run_bytes_written,
+                "write_amplification": self.run_bytes_written / self.wal_bytes if self.wal_bytes else 0.0,
+            }
+
+
+class LSMWrapper(BaseMapWrapper):
+    def __init__(self, path: str = "./data/lsm", **options):
+        '''
+        options 见LSMTree: memtable_bytes, block_bytes, run_bytes, l0_trigger, l0_stop, level_bytes, fanout ...
+        len是估算值, 见LSMTree
+        '''
+        self.lsm_core = LSMTree(path, **options)
+
+    def __setitem__(self, key, value):
+        assert type(key) == str
+        self.lsm_core.insert(key, value)
+
+    def get(self, key):
+        assert type(key) == str
+        return self.lsm_core.search(key)
+
+    def _del(self, key):
+        assert type(key) == str
+        self.lsm_core.delete(key)
+
+    def __len__(self):
+        return len(self.lsm_core)
+
+    def items(self):
+        return self.lsm_core.scan()
+
+    def _scan(self, start, end, reverse):
+        return self.lsm_core.scan(start, end, reverse)
+
+    def bulk_load(self, items):
+        self.lsm_core.bulk_load(items)
+
+    def stats(self):
+        return self.lsm_core.stats()
+
+    def checkpoint(self):
+        return self.lsm_core.checkpoint()
+
+    def set_checkpoint(self, stamp):
+        self.lsm_core.set_checkpoint(stamp)
+
+    def clear(self):
+        self.lsm_core.clear()
+
+    def flush(self):
+        self.lsm_core.flush()
+
+    def close(self):
+        self.lsm_core.close()
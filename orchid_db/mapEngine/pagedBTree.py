@@ -0,0 +1,444 @@
+import logging
+import os
+import struct
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from .base import BaseMapWrapper
+
+PAGE_SIZE = 4096
+META_MAGIC = b"ORCHIDPB"
+
+LEAF = 1
+INTERNAL = 2
+
+# page 0: magic, root page, page count, key count, dirty flag
+_META = struct.Struct("<8sIIQB")
+# node header: type, key count, next leaf (leaf) / first child (internal)
+_HEADER = struct.Struct("<BHI")
+_LEAF_ENTRY = struct.Struct("<HH")
+_KLEN = struct.Struct("<H")
+_CHILD = struct.Struct("<I")
+
+
+class Page:
+    """
+    A decoded node page. Keys and values are kept as utf-8 bytes, whose order
+    is the same as the order of the strings, and 'used' tracks the encoded size.
+    """
+    __slots__ = ("page_id", "kind", "keys", "values", "children", "next", "used", "dirty")
+
+    def __init__(self, page_id, kind):
+        self.page_id = page_id
+        self.kind = kind
+        self.keys = []
+        self.values = []
+        self.children = []
+        self.next = 0
+        self.used = _HEADER.size
+        self.dirty = True
+
+    def encode(self, page_size):
+        out = bytearray(page_size)
+        if self.kind == LEAF:
+            _HEADER.pack_into(out, 0, LEAF, len(self.keys), self.next)
+            pos = _HEADER.size
+            for k, v in zip(self.keys, self.values):
+                _LEAF_ENTRY.pack_into(out, pos, len(k), len(v))
+                pos += _LEAF_ENTRY.size
+                out[pos:pos + len(k)] = k
+                pos += len(k)
+                out[pos:pos + len(v)] = v
+                pos += len(v)
+        else:
+            _HEADER.pack_into(out, 0, INTERNAL, len(self.keys), self.children[0])
+            pos = _HEADER.size
+            for k, child in zip(self.keys, self.children[1:]):
+                _KLEN.pack_into(out, pos, len(k))
+                pos += _KLEN.size
+                out[pos:pos + len(k)] = k
+                pos += len(k)
+                _CHILD.pack_into(out, pos, child)
+                pos += _CHILD.size
+        return bytes(out)
+
+    @classmethod
+    def decode(cls, page_id, data):
+        kind, n, link = _HEADER.unpack_from(data, 0)
+        page = cls(page_id, kind)
+        pos = _HEADER.size
+        if kind == LEAF:
+            page.next = link
+            for _ in range(n):
+                klen, vlen = _LEAF_ENTRY.unpack_from(data, pos)
+                pos += _LEAF_ENTRY.size
+                page.keys.append(data[pos:pos + klen])
+                pos += klen
+                page.values.append(data[pos:pos + vlen])
+                pos += vlen
+        else:
+            page.children.append(link)
+            for _ in range(n):
+                klen, = _KLEN.unpack_from(data, pos)
+                pos += _KLEN.size
+                page.keys.append(data[pos:pos + klen])
+                pos += klen
+                page.children.append(_CHILD.unpack_from(data, pos)[0])
+                pos += _CHILD.size
+        page.used = pos
+        page.dirty = False
+        return page
+
+
+class BufferPool:
+    """
+    Caches decoded pages with LRU eviction and writes dirty pages back when they are evicted.
+
+    Pages fetched during one tree operation stay pinned until release(), so a node
+    that is still being modified is never evicted. The pool may therefore exceed its
+    capacity by the height of the tree for the duration of an operation.
+    """
+
+    def __init__(self, fd, page_size, capacity):
+        self.fd = fd
+        self.page_size = page_size
+        self.capacity = max(capacity, 8)
+        self.pages = OrderedDict()
+        self._pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def fetch(self, page_id):
+        page = self.pages.get(page_id)
+        if page is not None:
+            self.hits += 1
+            self.pages.move_to_end(page_id)
+        else:
+            self.misses += 1
+            data = os.pread(self.fd, self.page_size, page_id * self.page_size)
+            page = Page.decode(page_id, data)
+            self.pages[page_id] = page
+        self._pinned.add(page_id)
+        return page
+
+    def add(self, page):
+        self.pages[page.page_id] = page
+        self._pinned.add(page.page_id)
+
+    def release(self):
+        # Ends an operation: unpins everything and evicts down to capacity
+        self._pinned.clear()
+        while len(self.pages) > self.capacity:
+            page_id, page = self.pages.popitem(last=False)
+            if page.dirty:
+                self._write(page)
+            self.evictions += 1
+
+    def _write(self, page):
+        os.pwrite(self.fd, page.encode(self.page_size), page.page_id * self.page_size)
+        page.dirty = False
+        self.writebacks += 1
+
+    def flush(self):
+        for page in self.pages.values():
+            if page.dirty:
+                self._write(page)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "pages": len(self.pages),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "writebacks": self.writebacks,
+        }
+
+
+class PagedBTree:
+    """
+    On-disk B+tree made of fixed-size pages in a single file, accessed through a BufferPool.
+
+    Leaves hold the values and are chained through 'next' for scans. Nodes split when their
+    encoded size exceeds a page. Deletes only remove the entry from its leaf; pages are not
+    merged, as in many on-disk B-trees, and are reused by later inserts into the same range.
+    Only flush() makes the file consistent. The first write after a flush sets a dirty flag in
+    the meta page, before any page can be written back; a file opened with the flag still set
+    was not shut down cleanly and is discarded, so the table log rebuilds it from scratch.
+    """
+
+    def __init__(self, path, page_size=PAGE_SIZE, pool_bytes=8 * 1024 * 1024):
+        self.path = path
+        self.page_size = page_size
+        # An entry may take at most a quarter of a page, so a split always leaves both halves valid
+        self.max_entry = (page_size - _HEADER.size) // 4
+        exists = os.path.exists(path) and os.path.getsize(path) >= page_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # The pool is not thread-safe: every operation, including each step of a scan, holds this lock
+        self.lock = threading.RLock()
+        self.pool = BufferPool(self.fd, page_size, pool_bytes // page_size)
+        self.dirty = False
+        if exists:
+            magic, self.root, self.page_count, self.size, dirty = _META.unpack_from(
+                os.pread(self.fd, _META.size, 0))
+            if magic != META_MAGIC:
+                raise Exception("{} is not a paged b-tree file".format(path))
+            if dirty:
+                # Evicted pages may have been written under page ids the stale meta still
+                # considers free, so nothing in the file can be trusted
+                logging.warning("%s was not closed cleanly, discarding it to rebuild from the log", path)
+                os.ftruncate(self.fd, 0)
+                exists = False
+        if not exists:
+            self.page_count = 1
+            self.size = 0
+            self.root = self._new_page(LEAF).page_id
+            self.flush()
+
+    def _new_page(self, kind):
+        page = Page(self.page_count, kind)
+        self.page_count += 1
+        self.pool.add(page)
+        return page
+
+    def _find_leaf(self, key, path=None):
+        page = self.pool.fetch(self.root)
+        while page.kind == INTERNAL:
+            i = bisect_right(page.keys, key)
+            if path is not None:
+                path.append((page, i))
+            page = self.pool.fetch(page.children[i])
+        return page
+
+    def search(self, key):
+        with self.lock:
+            return self._search(key)
+
+    def _search(self, key):
+        try:
+            leaf = self._find_leaf(key)
+            i = bisect_left(leaf.keys, key)
+            if i < len(leaf.keys) and leaf.keys[i] == key:
+                return leaf.values[i]
+            return None
+        finally:
+            self.pool.release()
+
+    def insert(self, key, value):
+        if _LEAF_ENTRY.size + len(key) + len(value) > self.max_entry:
+            raise Exception("entry too large for a {} byte page".format(self.page_size))
+        with self.lock:
+            self._mark_dirty()
+            self._insert(key, value)
+
+    def _insert(self, key, value):
+        try:
+            path = []
+            leaf = self._find_leaf(key, path)
+            i = bisect_left(leaf.keys, key)
+            if i < len(leaf.keys) and leaf.keys[i] == key:
+                leaf.used += len(value) - len(leaf.values[i])
+                leaf.values[i] = value
+            else:
+                leaf.keys.insert(i, key)
+                leaf.values.insert(i, value)
+                leaf.used += _LEAF_ENTRY.size + len(key) + len(value)
+                self.size += 1
+            leaf.dirty = True
+            if leaf.used > self.page_size:
+                self._split(leaf, path)
+        finally:
+            self.pool.release()
+
+    def _split(self, node, path):
+        while True:
+            # Split at the first entry that takes the left half past half of the bytes
+            half = (node.used - _HEADER.size) // 2
+            acc = 0
+            mid = 0
+            for mid, k in enumerate(node.keys):
+                if node.kind == LEAF:
+                    acc += _LEAF_ENTRY.size + len(k) + len(node.values[mid])
+                else:
+                    acc += _KLEN.size + len(k) + _CHILD.size
+                if acc >= half:
+                    break
+            mid = max(mid, 1)
+            right = self._new_page(node.kind)
+            if node.kind == LEAF:
+                right.keys, node.keys = node.keys[mid:], node.keys[:mid]
+                right.values, node.values = node.values[mid:], node.values[:mid]
+                right.next, node.next = node.next, right.page_id
+                separator = right.keys[0]
+            else:
+                separator = node.keys[mid]
+                right.keys, node.keys = node.keys[mid + 1:], node.keys[:mid]
+                right.children, node.children = node.children[mid + 1:], node.children[:mid + 1]
+            for page in (node, right):
+                page.used = self._measure(page)
+            node.dirty = True
+
+            if not path:
+                root = self._new_page(INTERNAL)
+                root.keys = [separator]
+                root.children = [node.page_id, right.page_id]
+                root.used = self._measure(root)
+                self.root = root.page_id
+                return
+            parent, i = path.pop()
+            parent.keys.insert(i, separator)
+            parent.children.insert(i + 1, right.page_id)
+            parent.used += _KLEN.size + len(separator) + _CHILD.size
+            parent.dirty = True
+            if parent.used <= self.page_size:
+                return
+            node = parent
+
+    @staticmethod
+    def _measure(page):
+        if page.kind == LEAF:
+            return _HEADER.size + sum(_LEAF_ENTRY.size + len(k) + len(v) for k, v in zip(page.keys, page.values))
+        return _HEADER.size + sum(_KLEN.size + len(k) + _CHILD.size for k in page.keys)
+
+    def delete(self, key):
+        with self.lock:
+            self._mark_dirty()
+            return self._delete(key)
+
+    def _delete(self, key):
+        try:
+            leaf = self._find_leaf(key)
+            i = bisect_left(leaf.keys, key)
+            if i == len(leaf.keys) or leaf.keys[i] != key:
+                return False
+            leaf.used -= _LEAF_ENTRY.size + len(key) + len(leaf.values[i])
+            del leaf.keys[i]
+            del leaf.values[i]
+            leaf.dirty = True
+            self.size -= 1
+            return True
+        finally:
+            self.pool.release()
+
+    def scan(self, start=None):
+        """
+        Generates (key, value) bytes tuples with key >= start by following the leaf chain.
+        Each leaf is copied out before yielding, so the pool is free to evict it meanwhile.
+        """
+        with self.lock:
+            entries, next_id = self._first_leaf(start)
+        while True:
+            yield from entries
+            if not next_id:
+                return
+            with self.lock:
+                try:
+                    page = self.pool.fetch(next_id)
+                    entries = list(zip(page.keys, page.values))
+                    next_id = page.next
+                finally:
+                    self.pool.release()
+
+    def _first_leaf(self, start):
+        try:
+            if start is None:
+                page = self.pool.fetch(self.root)
+                while page.kind == INTERNAL:
+                    page = self.pool.fetch(page.children[0])
+                i = 0
+            else:
+                page = self._find_leaf(start)
+                i = bisect_left(page.keys, start)
+            return list(zip(page.keys[i:], page.values[i:])), page.next
+        finally:
+            self.pool.release()
+
+    def height(self):
+        with self.lock:
+            return self._height()
+
+    def _height(self):
+        try:
+            h, page = 1, self.pool.fetch(self.root)
+            while page.kind == INTERNAL:
+                h, page = h + 1, self.pool.fetch(page.children[0])
+            return h
+        finally:
+            self.pool.release()
+
+    def _write_meta(self, dirty):
+        meta = bytearray(self.page_size)
+        _META.pack_into(meta, 0, META_MAGIC, self.root, self.page_count, self.size, dirty)
+        os.pwrite(self.fd, bytes(meta), 0)
+        os.fsync(self.fd)
+        self.dirty = bool(dirty)
+
+    def _mark_dirty(self):
+        # Must reach the disk before the first write-back of a page modified after the last flush
+        if not self.dirty:
+            self._write_meta(1)
+
+    def flush(self):
+        with self.lock:
+            self.pool.flush()
+            os.fsync(self.fd)
+            self._write_meta(0)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            os.close(self.fd)
+
+
+class PagedBTreeWrapper(BaseMapWrapper):
+    '''
+    磁盘上的分页B+树引擎, 内存占用由pool_bytes决定, 可以放下比内存大的表
+    '''
+
+    def __init__(self, path="./data/paged.btree", page_size=PAGE_SIZE, pool_bytes=8 * 1024 * 1024):
+        self.paged_core = PagedBTree(path, page_size, pool_bytes)
+
+    def __setitem__(self, key, value):
+        assert type(key) == str
+        self.paged_core.insert(key.encode("utf-8"), value.encode("utf-8"))
+
+    def get(self, key):
+        assert type(key) == str
+        value = self.paged_core.search(key.encode("utf-8"))
+        return None if value is None else value.decode("utf-8")
+
+    def _del(self, key):
+        assert type(key) == str
+        self.paged_core.delete(key.encode("utf-8"))
+
+    def __len__(self):
+        return self.paged_core.size
+
+    def items(self):
+        return self._scan(None, None, False)
+
+    def _scan(self, start, end, reverse):
+        if reverse:
+            raise Exception("paged b-tree leaves are linked forward only, reverse scan is not supported")
+        end = None if end is None else end.encode("utf-8")
+        for k, v in self.paged_core.scan(None if start is None else start.encode("utf-8")):
+            if end is not None and k >= end:
+                return
+            yield k.decode("utf-8"), v.decode("utf-8")
+
+    def stats(self):
+        '''
+        缓冲池的命中/未命中/淘汰计数
+        '''
+        return self.paged_core.pool.stats()
+
+    def flush(self):
+        self.paged_core.flush()
+
+    def close(self):
+        self.paged_core.close()
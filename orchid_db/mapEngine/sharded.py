@@ -0,0 +1,159 @@
+import heapq
+import threading
+from contextlib import ExitStack, contextmanager
+
+from .base import BaseMapWrapper
+
+# 扫描时每个分片一次在锁下复制多少条
+SCAN_PAGE = 256
+
+
+class ShardedWrapper(BaseMapWrapper):
+    '''
+    按hash(key)把key分到多个子引擎(分片), 每个分片一把锁, 不同分片上的读写可以同时进行
+
+    KVTableOperator发现引擎有lock_for时, 写引擎只持有这个key所在分片的锁,
+    日志追加再单独串行化, 所以写吞吐随分片数增长
+    '''
+
+    def __init__(self, shards):
+        '''
+        shards 子引擎列表, 每个都必须是独立的实例(不能是单例引擎)
+        '''
+        if not shards:
+            raise Exception("need at least one shard")
+        if len({id(shard) for shard in shards}) != len(shards):
+            raise Exception("shards must be distinct engine instances")
+        self.shards = list(shards)
+        self.locks = [threading.RLock() for _ in self.shards]
+
+    def _index(self, key):
+        return hash(key) % len(self.shards)
+
+    def lock_for(self, key):
+        '''
+        key所在分片的锁, 可重入
+        '''
+        return self.locks[self._index(key)]
+
+    @contextmanager
+    def lock_all(self):
+        '''
+        按分片顺序拿到所有分片的锁, 用于需要整体一致的操作(批量导入)
+        '''
+        with ExitStack() as stack:
+            for lock in self.locks:
+                stack.enter_context(lock)
+            yield
+
+    def __setitem__(self, key, value):
+        assert type(key) == str
+        i = self._index(key)
+        with self.locks[i]:
+            self.shards[i][key] = value
+
+    def get(self, key):
+        assert type(key) == str
+        i = self._index(key)
+        with self.locks[i]:
+            return self.shards[i].get(key)
+
+    def _del(self, key):
+        assert type(key) == str
+        i = self._index(key)
+        with self.locks[i]:
+            del self.shards[i][key]
+
+    def _group(self, keys):
+        # 分片号 -> keys里属于这个分片的下标
+        groups = {}
+        for j, key in enumerate(keys):
+            groups.setdefault(self._index(key), []).append(j)
+        return groups
+
+    def mget(self, keys):
+        out = [None] * len(keys)
+        for i, indexes in self._group(keys).items():
+            part = [keys[j] for j in indexes]
+            with self.locks[i]:
+                shard = self.shards[i]
+                values = shard.mget(part) if hasattr(shard, "mget") else [shard.get(key) for key in part]
+            for j, value in zip(indexes, values):
+                out[j] = value
+        return out
+
+    def mset(self, items):
+        items = list(items)
+        for i, indexes in self._group([key for key, _ in items]).items():
+            with self.locks[i]:
+                shard = self.shards[i]
+                part = [items[j] for j in indexes]
+                if hasattr(shard, "mset"):
+                    shard.mset(part)
+                else:
+                    for key, value in part:
+                        shard[key] = value
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def items(self):
+        # 每个分片在自己的锁下取快照, 分片之间不是同一时刻的快照
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                items = list(shard.items())
+            yield from items
+
+    def stats(self):
+        '''
+        分片的key数分布, 分片有stats时按分片给出
+        '''
+        sizes = [len(shard) for shard in self.shards]
+        stats = {"shards": len(self.shards), "keys": sum(sizes), "max_shard_keys": max(sizes),
+                 "min_shard_keys": min(sizes)}
+        if hasattr(self.shards[0], "stats"):
+            stats["shard"] = {str(i): shard.stats() for i, shard in enumerate(self.shards)}
+        return stats
+
+    @property
+    def ordered(self) -> bool:
+        return all(hasattr(shard, "scan") and getattr(shard, "ordered", True) for shard in self.shards)
+
+    def _scan(self, start, end, reverse):
+        '''
+        各分片的有序结果惰性归并, 带limit的扫描每个分片只复制一两页
+        '''
+        if not all(hasattr(shard, "scan") for shard in self.shards):
+            raise Exception("shards are not ordered, scan is not supported")
+        runs = [self._scan_shard(shard, lock, start, end, reverse) for shard, lock in zip(self.shards, self.locks)]
+        return heapq.merge(*runs, key=lambda kv: kv[0], reverse=reverse)
+
+    @staticmethod
+    def _scan_shard(shard, lock, start, end, reverse):
+        # 一页一页地在锁下复制, 不在yield期间持有锁; 页与页之间的写可能看得到也可能看不到
+        while True:
+            with lock:
+                page = list(shard.scan(start, end, SCAN_PAGE, reverse))
+            yield from page
+            if len(page) < SCAN_PAGE:
+                return
+            # 下一页从上一页最后一个key之后接着取, key + "\0"是比它大的最小的字符串
+            if reverse:
+                end = page[-1][0]
+            else:
+                start = page[-1][0] + "\0"
+
+    def bulk_load(self, items):
+        '''
+        items 按key排好序的(key, value), 分到各分片后仍然有序
+        '''
+        parts = [[] for _ in self.shards]
+        for key, value in items:
+            parts[self._index(key)].append((key, value))
+        for shard, lock, part in zip(self.shards, self.locks, parts):
+            with lock:
+                if hasattr(shard, "bulk_load"):
+                    shard.bulk_load(part)
+                else:
+                    for key, value in part:
+                        shard[key] = value
@@ -0,0 +1,225 @@
+import random
+
+from .base import BaseMapWrapper
+
+
+class Node:
+    __slots__ = ("key", "value", "forward", "prev")
+
+    def __init__(self, key, value, level):
+        self.key = key
+        self.value = value
+        # forward[i] is the next node on level i
+        self.forward = [None] * level
+        # previous node on level 0, for reverse scans
+        self.prev = None
+
+
+class SkipList:
+    """
+    Skip list (Pugh, Skip Lists: A Probabilistic Alternative to Balanced Trees).
+
+    Every node is on level 0 and on each higher level with probability p, so a search
+    skips ahead on the sparse upper levels and drops down, expected O(log n) steps.
+    Inserts and deletes only relink the neighbours found on the way down: there is no
+    rebalancing. Level 0 is linked both ways for reverse scans.
+    """
+
+    def __init__(self, max_level=32, p=0.25, seed=None):
+        if not 0 < p < 1:
+            raise Exception("p must be in (0, 1)")
+        self.max_level = max_level
+        self.p = p
+        self.head = Node(None, None, max_level)
+        self.level = 1
+        self.size = 0
+        self.rnd = random.Random(seed)
+
+    def _random_level(self):
+        level = 1
+        rnd, p = self.rnd.random, self.p
+        while level < self.max_level and rnd() < p:
+            level += 1
+        return level
+
+    def _find(self, key, update=None):
+        """
+        :param update: If a list is given, update[i] is set to the last node before 'key' on level i.
+        :return: The last node on level 0 whose key is < 'key' (the head if there is none).
+        """
+        x = self.head
+        for i in range(self.level - 1, -1, -1):
+            nxt = x.forward[i]
+            while nxt is not None and nxt.key < key:
+                x = nxt
+                nxt = x.forward[i]
+            if update is not None:
+                update[i] = x
+        return x
+
+    def search(self, key):
+        """
+        :return: The value of 'key', or None if it is not present.
+        """
+        x = self._find(key).forward[0]
+        if x is not None and x.key == key:
+            return x.value
+        return None
+
+    def search_many(self, keys):
+        """
+        Looks up 'keys' in sorted order, continuing on level 0 from the previous hit
+        while the next key is close instead of descending from the head again.
+        :return: The values in the order of 'keys', None for the missing ones.
+        """
+        out = [None] * len(keys)
+        x = self.head
+        for j in sorted(range(len(keys)), key=keys.__getitem__):
+            key = keys[j]
+            # a few steps along level 0 are cheaper than a new descent
+            for _ in range(4):
+                nxt = x.forward[0]
+                if nxt is None or nxt.key >= key:
+                    break
+                x = nxt
+            else:
+                x = self._find(key)
+            nxt = x.forward[0]
+            if nxt is not None and nxt.key == key:
+                out[j] = nxt.value
+        return out
+
+    def insert(self, key, value):
+        update = [None] * self.max_level
+        x = self._find(key, update).forward[0]
+        if x is not None and x.key == key:
+            x.value = value
+            return
+        level = self._random_level()
+        if level > self.level:
+            for i in range(self.level, level):
+                update[i] = self.head
+            self.level = level
+        node = Node(key, value, level)
+        # link the new node's pointers before publishing it, so a concurrent reader
+        # walking the list never follows a half-linked node
+        for i in range(level):
+            node.forward[i] = update[i].forward[i]
+        node.prev = update[0] if update[0] is not self.head else None
+        if node.forward[0] is not None:
+            node.forward[0].prev = node
+        for i in range(level):
+            update[i].forward[i] = node
+        self.size += 1
+
+    def delete(self, key):
+        """
+        :return: True if the key was present.
+        """
+        update = [None] * self.max_level
+        x = self._find(key, update).forward[0]
+        if x is None or x.key != key:
+            return False
+        for i in range(len(x.forward)):
+            update[i].forward[i] = x.forward[i]
+        if x.forward[0] is not None:
+            x.forward[0].prev = x.prev
+        while self.level > 1 and self.head.forward[self.level - 1] is None:
+            self.level -= 1
+        self.size -= 1
+        return True
+
+    def scan(self, start=None, end=None, reverse=False):
+        """
+        Generates the (key, value) tuples with start <= key < end along level 0.
+        """
+        if not reverse:
+            x = self.head.forward[0] if start is None else self._find(start).forward[0]
+            while x is not None:
+                if end is not None and x.key >= end:
+                    return
+                yield x.key, x.value
+                x = x.forward[0]
+        else:
+            if end is None:
+                x = self.head
+                for i in range(self.level - 1, -1, -1):
+                    while x.forward[i] is not None:
+                        x = x.forward[i]
+                x = x if x is not self.head else None
+            else:
+                x = self._find(end)
+                x = x if x is not self.head else None
+            while x is not None:
+                if start is not None and x.key < start:
+                    return
+                yield x.key, x.value
+                x = x.prev
+
+    def bulk_load(self, items):
+        """
+        Builds the list in one pass from (key, value) tuples sorted by key with unique keys,
+        appending every node behind the current tail of each of its levels.
+        Only an empty list can be bulk loaded.
+        """
+        if self.size:
+            raise Exception("bulk_load needs an empty skip list")
+        tails = [self.head] * self.max_level
+        prev = None
+        for key, value in items:
+            level = self._random_level()
+            node = Node(key, value, level)
+            node.prev = prev
+            for i in range(level):
+                tails[i].forward[i] = node
+                tails[i] = node
+            if level > self.level:
+                self.level = level
+            prev = node
+            self.size += 1
+
+
+class SkipListWrapper(BaseMapWrapper):
+    '''
+    跳表引擎, 增删查期望O(log n), 不需要重新平衡; 正向和反向遍历都是沿最底层链表走
+    '''
+
+    def __init__(self, max_level=32, p=0.25, seed=None):
+        self.skip_core = SkipList(max_level, p, seed)
+
+    def __setitem__(self, key, value):
+        assert type(key) == str
+        self.skip_core.insert(key, value)
+
+    def get(self, key):
+        assert type(key) == str
+        return self.skip_core.search(key)
+
+    def _del(self, key):
+        assert type(key) == str
+        self.skip_core.delete(key)
+
+    def mget(self, keys):
+        return self.skip_core.search_many(keys)
+
+    def __len__(self):
+        return self.skip_core.size
+
+    def items(self):
+        return self.skip_core.scan()
+
+    def stats(self):
+        return {"keys": self.skip_core.size, "height": self.skip_core.level, "p": self.skip_core.p}
+
+    def _scan(self, start, end, reverse):
+        return self.skip_core.scan(start, end, reverse)
+
+    def bulk_load(self, items):
+        '''
+        items 按key排好序的(key, value), 空表时一趟接到每层的末尾, 否则逐个插入
+        '''
+        if len(self):
+            for key, value in items:
+                self[key] = value
+        else:
+            self.skip_core.bulk_load(items)
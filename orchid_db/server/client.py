@@ -0,0 +1,90 @@
+import socket
+
+from server.resp import RespError, RespReader, encode_command
+
+
+class OrchidClient:
+    '''
+    自带的同步客户端, 本地测试和压测用; 也可以连真正的Redis
+
+    with OrchidClient(port=6380) as client:
+        client.set("k", "v")
+        client.pipeline([("SET", "a", "1"), ("GET", "a")])
+    '''
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6380, timeout: float = None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = RespReader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def _read_reply(self):
+        while True:
+            reply = self._reader.get()
+            if reply is not RespReader.NOT_READY:
+                return reply
+            data = self.sock.recv(64 * 1024)
+            if not data:
+                raise ConnectionError("connection closed by server")
+            self._reader.feed(data)
+
+    def execute(self, *args):
+        '''
+        发送一条命令并返回回复, 错误回复抛出RespError; bulk string原样返回bytes
+        '''
+        self.sock.sendall(encode_command(*args))
+        reply = self._read_reply()
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def pipeline(self, commands):
+        '''
+        一次发出所有命令再依次读回复, 错误回复以RespError实例放在结果里, 不抛出
+        '''
+        self.sock.sendall(b"".join(encode_command(*command) for command in commands))
+        return [self._read_reply() for _ in commands]
+
+    @staticmethod
+    def _text(value):
+        return None if value is None else value.decode("utf-8")
+
+    def get(self, key: str):
+        return self._text(self.execute("GET", key))
+
+    def set(self, key: str, value: str) -> bool:
+        return self.execute("SET", key, value) == "OK"
+
+    def delete(self, *keys) -> int:
+        return self.execute("DEL", *keys)
+
+    def mget(self, *keys) -> list:
+        return [self._text(value) for value in self.execute("MGET", *keys)]
+
+    def mset(self, mapping: dict) -> bool:
+        args = [item for pair in mapping.items() for item in pair]
+        return self.execute("MSET", *args) == "OK"
+
+    def scan(self, match: str = None, count: int = 10):
+        '''
+        用SCAN游标遍历所有key, 生成key
+        '''
+        cursor = 0
+        while True:
+            args = ["SCAN", cursor]
+            if match is not None:
+                args += ["MATCH", match]
+            args += ["COUNT", count]
+            cursor, keys = self.execute(*args)
+            yield from (key.decode("utf-8") for key in keys)
+            cursor = int(cursor)
+            if cursor == 0:
+                return
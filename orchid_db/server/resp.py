@@ -0,0 +1,132 @@
+'''
+RESP(REdis Serialization Protocol)编解码, 服务端和自带的客户端共用
+
+请求是bulk string组成的数组, 也接受redis-cli/telnet发来的inline命令(一行, 空格分隔)
+'''
+
+CRLF = b"\r\n"
+
+
+class RespError(Exception):
+    '''
+    对端回复的错误(-ERR ...), 或者收到了不合法的协议数据
+    '''
+
+
+class _Incomplete(Exception):
+    pass
+
+
+def encode_command(*args) -> bytes:
+    '''
+    把一条命令编码成bulk string数组, 参数可以是str/bytes/int
+    '''
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif isinstance(arg, int):
+            arg = b"%d" % arg
+        out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(out)
+
+
+def encode_reply(value) -> bytes:
+    '''
+    None -> nil, int -> integer, str/bytes -> bulk string, list -> array, RespError -> error
+    简单字符串(+OK)用encode_simple
+    '''
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RespError):
+        return b"-%s\r\n" % str(value).encode("utf-8")
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if isinstance(value, (bytes, bytearray)):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(encode_reply(item) for item in value)
+    raise TypeError("can not encode {!r}".format(value))
+
+
+def encode_simple(text: str) -> bytes:
+    return b"+%s\r\n" % text.encode("utf-8")
+
+
+class RespReader:
+    '''
+    增量解析器: feed()喂进收到的字节, get()取出下一个完整的值, 数据不够时返回NOT_READY
+    一次feed里可能有多条管道(pipeline)请求, 反复get直到NOT_READY
+    错误回复解析成RespError实例返回, 不抛出
+    '''
+
+    NOT_READY = object()
+
+    def __init__(self, max_bulk_bytes: int = 512 * 1024 * 1024):
+        self.max_bulk_bytes = max_bulk_bytes
+        self._buf = bytearray()
+        self._pos = 0
+
+    def feed(self, data: bytes):
+        if self._pos:
+            # 丢掉已经解析过的部分, 缓冲区不会无限增长
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf += data
+
+    def buffered(self) -> int:
+        return len(self._buf) - self._pos
+
+    def get(self):
+        try:
+            value, self._pos = self._parse(self._pos)
+        except _Incomplete:
+            return RespReader.NOT_READY
+        return value
+
+    def _line(self, pos):
+        end = self._buf.find(CRLF, pos)
+        if end < 0:
+            if len(self._buf) - pos > 64 * 1024:
+                raise RespError("Protocol error: too big inline request")
+            raise _Incomplete()
+        return bytes(self._buf[pos:end]), end + 2
+
+    def _parse(self, pos):
+        if pos >= len(self._buf):
+            raise _Incomplete()
+        kind = self._buf[pos:pos + 1]
+        if kind not in (b"+", b"-", b":", b"$", b"*"):
+            # inline命令
+            line, pos = self._line(pos)
+            return line.split(), pos
+        line, end = self._line(pos + 1)
+        if kind == b"+":
+            return line.decode("utf-8"), end
+        if kind == b"-":
+            return RespError(line.decode("utf-8")), end
+        try:
+            n = int(line)
+        except ValueError:
+            raise RespError("Protocol error: invalid length {!r}".format(line))
+        if kind == b":":
+            return n, end
+        if kind == b"$":
+            if n < 0:
+                return None, end
+            if n > self.max_bulk_bytes:
+                raise RespError("Protocol error: invalid bulk length")
+            if len(self._buf) < end + n + 2:
+                raise _Incomplete()
+            return bytes(self._buf[end:end + n]), end + n + 2
+        if n < 0:
+            return None, end
+        items = []
+        for _ in range(n):
+            item, end = self._parse(end)
+            items.append(item)
+        return items, end
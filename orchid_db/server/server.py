@@ -0,0 +1,284 @@
+'''
+基于asyncio streams的网络服务, 协议兼容RESP, redis-cli/redis-benchmark等现成的客户端可以直接连
+
+支持的命令: GET SET DEL MGET MSET SCAN, 以及客户端握手常用的PING ECHO QUIT COMMAND CONFIG DBSIZE
+一次读到的多条管道(pipeline)请求按顺序执行, 连续的写合成一批交给KVTableOperator.apply_writes,
+整批作为一组日志记录追加, 只等一次落盘; 读之前先把前面的写执行完, 保证同一个连接读到自己的写
+
+python -m server.server --source ./data/server.db --engine bPlusTreeMap --port 6380
+'''
+
+import argparse
+import asyncio
+import logging
+from fnmatch import fnmatchcase
+
+from server.resp import RespError, RespReader, encode_reply, encode_simple
+
+OK = encode_simple("OK")
+PONG = encode_simple("PONG")
+
+WRITE_COMMANDS = {"SET", "DEL", "MSET"}
+
+
+class _Session:
+    '''
+    一个连接的状态: SCAN的游标, 游标号 -> 下一次从哪个key开始
+    '''
+
+    def __init__(self):
+        self.cursors = {}
+        self.next_cursor = 1
+        self.closing = False
+
+
+class OrchidServer:
+    '''
+    max_pipeline 一次最多执行这么多条管道请求, 然后等回复写出去再继续读, 限制每个连接占用的内存
+    write_buffer_bytes 连接的发送缓冲区超过这个值时drain()阻塞, 慢客户端不会让服务端无限缓存回复
+    max_request_bytes 一条请求的上限, 超过时回复错误并断开
+    '''
+
+    def __init__(self, table, host: str = "127.0.0.1", port: int = 6380, max_pipeline: int = 1024,
+                 write_buffer_bytes: int = 1024 * 1024, max_request_bytes: int = 64 * 1024 * 1024):
+        self.table = table
+        self.host = host
+        self.port = port
+        self.max_pipeline = max_pipeline
+        self.write_buffer_bytes = write_buffer_bytes
+        self.max_request_bytes = max_request_bytes
+        self._server = None
+
+    async def start(self):
+        '''
+        开始监听, port为0时由系统分配, 之后self.port是实际端口
+        '''
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=self.write_buffer_bytes)
+        parser = RespReader(self.max_request_bytes)
+        session = _Session()
+        try:
+            while not session.closing:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                parser.feed(data)
+                while not session.closing:
+                    commands = []
+                    try:
+                        while len(commands) < self.max_pipeline:
+                            command = parser.get()
+                            if command is RespReader.NOT_READY:
+                                break
+                            if command:
+                                commands.append(command)
+                    except RespError as e:
+                        # 协议错误之后数据流已经对不齐了, 回复错误并断开
+                        error = encode_reply(RespError("ERR {}".format(e)))
+                        writer.write(await self._execute(commands, session) + error)
+                        session.closing = True
+                        break
+                    if not commands:
+                        break
+                    writer.write(await self._execute(commands, session))
+                    await writer.drain()
+                if parser.buffered() > self.max_request_bytes:
+                    writer.write(encode_reply(RespError("ERR Protocol error: request too large")))
+                    break
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _execute(self, commands, session) -> bytes:
+        '''
+        按顺序执行一组管道请求, 返回拼好的回复
+        '''
+        out = []
+        # 攒着的写: (op列表, 回复在out里的位置, 命令名)
+        batch = []
+        for command in commands:
+            if not isinstance(command, list) or not all(isinstance(arg, bytes) for arg in command):
+                out.append(encode_reply(RespError("ERR Protocol error: expected an array of bulk strings")))
+                continue
+            name = command[0].decode("utf-8", "replace").upper()
+            try:
+                args = [arg.decode("utf-8") for arg in command[1:]]
+            except UnicodeDecodeError:
+                out.append(encode_reply(RespError("ERR keys and values must be utf-8")))
+                continue
+            if name in WRITE_COMMANDS:
+                ops = self._write_ops(name, args)
+                if isinstance(ops, RespError):
+                    out.append(encode_reply(ops))
+                else:
+                    batch.append((ops, len(out), name))
+                    out.append(None)
+                continue
+            if batch:
+                await self._flush_writes(batch, out)
+                batch = []
+            out.append(self._read(name, args, session))
+        if batch:
+            await self._flush_writes(batch, out)
+        return b"".join(out)
+
+    @staticmethod
+    def _write_ops(name, args):
+        if name == "SET":
+            if len(args) != 2:
+                return RespError("ERR wrong number of arguments for 'set' command")
+            return [("set", args[0], args[1])]
+        if name == "MSET":
+            if not args or len(args) % 2:
+                return RespError("ERR wrong number of arguments for 'mset' command")
+            return [("set", args[i], args[i + 1]) for i in range(0, len(args), 2)]
+        if not args:
+            return RespError("ERR wrong number of arguments for 'del' command")
+        return [("delete", key, None) for key in args]
+
+    async def _flush_writes(self, batch, out):
+        # apply_writes可能阻塞在fsync上, 放到线程池里执行, 不卡住事件循环
+        ops = [op for command_ops, _, _ in batch for op in command_ops]
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(None, self.table.apply_writes, ops)
+        except Exception as e:
+            logging.exception("write batch failed")
+            error = encode_reply(RespError("ERR {}".format(e)))
+            for _, slot, _ in batch:
+                out[slot] = error
+            return
+        i = 0
+        for command_ops, slot, name in batch:
+            applied = results[i:i + len(command_ops)]
+            i += len(command_ops)
+            out[slot] = encode_reply(sum(applied)) if name == "DEL" else OK
+
+    def _get(self, key):
+        # 按None判断不存在: 引擎的__getitem__会把空字符串当成不存在, 有的引擎缺key时抛的也不是KeyError
+        return self.table.mget([key])[0]
+
+    def _read(self, name, args, session) -> bytes:
+        try:
+            if name == "GET":
+                if len(args) != 1:
+                    raise RespError("ERR wrong number of arguments for 'get' command")
+                return encode_reply(self._get(args[0]))
+            if name == "MGET":
+                if not args:
+                    raise RespError("ERR wrong number of arguments for 'mget' command")
+                return encode_reply(self.table.mget(args))
+            if name == "SCAN":
+                return encode_reply(self._scan(args, session))
+            if name == "PING":
+                return encode_reply(args[0]) if args else PONG
+            if name == "ECHO":
+                if len(args) != 1:
+                    raise RespError("ERR wrong number of arguments for 'echo' command")
+                return encode_reply(args[0])
+            if name == "DBSIZE":
+                return encode_reply(len(self.table.internal_db))
+            if name == "QUIT":
+                session.closing = True
+                return OK
+            if name in ("COMMAND", "CONFIG"):
+                # 客户端握手时会问, 给空结果即可
+                return encode_reply([])
+            raise RespError("ERR unknown command '{}'".format(name.lower()))
+        except RespError as e:
+            return encode_reply(e)
+        except Exception as e:
+            return encode_reply(RespError("ERR {}".format(e)))
+
+    def _scan(self, args, session):
+        '''
+        SCAN cursor [MATCH pattern] [COUNT count], 游标0表示从头开始, 返回的游标0表示结束
+        按key顺序遍历, 需要有序引擎; 游标只在本连接内有效
+        '''
+        if not args:
+            raise RespError("ERR wrong number of arguments for 'scan' command")
+        try:
+            cursor = int(args[0])
+        except ValueError:
+            raise RespError("ERR invalid cursor")
+        pattern, count = None, 10
+        options = args[1:]
+        if len(options) % 2:
+            raise RespError("ERR syntax error")
+        for option, value in zip(options[::2], options[1::2]):
+            if option.upper() == "MATCH":
+                pattern = value
+            elif option.upper() == "COUNT":
+                try:
+                    count = int(value)
+                except ValueError:
+                    raise RespError("ERR value is not an integer or out of range")
+                if count < 1:
+                    raise RespError("ERR syntax error")
+            else:
+                raise RespError("ERR syntax error")
+        if cursor == 0:
+            start = None
+        elif cursor in session.cursors:
+            start = session.cursors.pop(cursor)
+        else:
+            raise RespError("ERR invalid cursor")
+
+        # 和Redis一样COUNT是检查的key数, MATCH在此之后过滤, 所以一页可能是空的
+        keys = [key for key, _ in self.table.scan(start, None, count + 1)]
+        if len(keys) > count:
+            next_cursor = session.next_cursor
+            session.next_cursor += 1
+            session.cursors[next_cursor] = keys[count]
+            keys = keys[:count]
+        else:
+            next_cursor = 0
+        if pattern is not None:
+            keys = [key for key in keys if fnmatchcase(key, pattern)]
+        return [str(next_cursor), keys]
+
+
+def main():
+    from internal.KVTable import KVTableOperator
+    from mapEngine.factory import MapEngineFactory
+
+    parser = argparse.ArgumentParser(description="orchid_db RESP server")
+    parser.add_argument("--source", default="./data/server.db")
+    parser.add_argument("--engine", default="bPlusTreeMap")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    parser.add_argument("--durability", default="flush-every-10-ms")
+    args = parser.parse_args()
+
+    table = KVTableOperator(args.source, engine=MapEngineFactory.create(args.engine), durability=args.durability)
+    server = OrchidServer(table, args.host, args.port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        table.close()
+
+
+if __name__ == "__main__":
+    main()
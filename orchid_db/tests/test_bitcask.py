@@ -0,0 +1,80 @@
+'''
+python -m unittest discover -s tests -t .   (在orchid_db目录下运行)
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from internal.KVTable import KVTableOperator
+from mapEngine.bitcask import SEGMENT_SUFFIX, BitcaskWrapper
+from mapEngine.factory import MapEngineFactory
+
+
+class BitcaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="orchid-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.path = os.path.join(self.workdir, "bitcask")
+
+    def _bytes(self):
+        return sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path)
+                   if name.endswith(SEGMENT_SUFFIX))
+
+    def _open(self):
+        return KVTableOperator(os.path.join(self.workdir, "log"),
+                               engine=MapEngineFactory.create("bitcask", path=self.path))
+
+    def test_reopen_does_not_replay_into_engine(self):
+        # 检查点对得上时不回放, 重新打开几次段文件都不变大
+        table = self._open()
+        for i in range(200):
+            table.set("key{}".format(i), "value{}".format(i))
+        table.close()
+        size = self._bytes()
+        for _ in range(3):
+            table = self._open()
+            self.assertEqual(table.get("key7"), "value7")
+            table.close()
+        self.assertEqual(self._bytes(), size)
+
+        # 日志在引擎不知道的情况下变了: 清空引擎重新回放
+        table = self._open()
+        table.set("key7", "changed")
+        table.close()
+        os.remove(os.path.join(self.path, "CHECKPOINT"))
+        table = self._open()
+        try:
+            self.assertEqual(table.get("key7"), "changed")
+            self.assertEqual(len(table.internal_db), 200)
+        finally:
+            table.close()
+
+    def test_merge_drops_stale_records(self):
+        engine = BitcaskWrapper(self.path, max_segment_bytes=4096)
+        expected = {}
+        for i in range(5000):
+            key = "key{}".format(i % 100)
+            if i % 9 == 0 and key in expected:
+                engine._del(key)
+                del expected[key]
+            else:
+                engine[key] = "value{}".format(i)
+                expected[key] = "value{}".format(i)
+        self.assertGreater(engine.merges, 0)
+        engine.merge()
+        self.assertEqual(dict(engine.items()), expected)
+        self.assertLess(self._bytes(), 3 * 4096)
+        engine.close()
+
+        engine = BitcaskWrapper(self.path, max_segment_bytes=4096)
+        try:
+            self.assertEqual(dict(engine.items()), expected)
+        finally:
+            engine.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+'''
+python -m unittest discover -s tests -t .   (在orchid_db目录下运行)
+'''
+
+import shutil
+import tempfile
+import time
+import unittest
+
+from mapEngine.lsm import LSMTree
+
+
+class LSMCountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="orchid-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+
+    def _open(self):
+        return LSMTree(self.workdir, memtable_bytes=2048, level_bytes=16384, fanout=100, l0_trigger=2)
+
+    def _settle(self, lsm):
+        lsm.flush()
+        while lsm.stats()["compacting"]:
+            time.sleep(0.01)
+
+    def test_len_after_compaction_above_bottom(self):
+        # 删除标记在中间层遇到它遮住的值, 合并之后len不能再把它当-1算
+        lsm = self._open()
+        try:
+            lsm.bulk_load(("base{:05d}".format(i), "x" * 20) for i in range(3000))
+            for i in range(200):
+                lsm.insert("new{:05d}".format(i), "v" * 30)
+            self._settle(lsm)
+            for i in range(200):
+                lsm.delete("new{:05d}".format(i))
+            self._settle(lsm)
+            self.assertGreater(lsm.stats()["levels"]["1"]["tombstones"], 0)
+            self.assertEqual(len(lsm), 3000)
+        finally:
+            lsm.close()
+
+        lsm = self._open()
+        try:
+            self.assertEqual(len(lsm), 3000)
+        finally:
+            lsm.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
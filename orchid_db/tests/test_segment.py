@@ -0,0 +1,85 @@
+'''
+python -m unittest discover -s tests -t .   (在orchid_db目录下运行)
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from internal.KVTable import KVTableOperator
+from internal.segment import HINT_SUFFIX, SegmentStore
+from mapEngine.factory import MapEngineFactory
+
+
+class SegmentBatchTest(unittest.TestCase):
+    '''
+    写批次里的每条记录按自己的偏移记进hint, 封存之后重新打开还能按hint取到值
+    '''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="orchid-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.source = os.path.join(self.workdir, "segments")
+
+    def _open(self):
+        return KVTableOperator(self.source, engine=MapEngineFactory.create("binarySearchMap"),
+                               segment_bytes=4096, compact_min_bytes=None)
+
+    def test_reopen_after_batch_and_seal(self):
+        expected = {}
+        table = self._open()
+        with table.write_batch() as batch:
+            for i in range(5):
+                batch.set("batch{}".format(i), "value{}".format(i))
+                expected["batch{}".format(i)] = "value{}".format(i)
+        table.close()
+
+        # 重新打开后活跃段的偏移来自回放, 写到封存, hint由这些偏移生成
+        table = self._open()
+        i = 0
+        while len(table._segments.segments()) < 2:
+            table.set("fill{}".format(i), "x" * 64)
+            expected["fill{}".format(i)] = "x" * 64
+            i += 1
+        table.close()
+        self.assertTrue(os.path.exists(table._segments._path(1, HINT_SUFFIX)))
+
+        with self.assertNoLogs(level="WARNING"):
+            table = self._open()
+        try:
+            keys = sorted(expected)
+            self.assertEqual(table.mget(keys), [expected[key] for key in keys])
+        finally:
+            table.close()
+
+    def test_hint_that_never_matches(self):
+        # 重新生成的hint还对不上时退回顺序回放, 不会一直删了重建
+        table = self._open()
+        expected = {}
+        for i in range(200):
+            value = "value{}".format(i) * 8
+            table.set("key{}".format(i % 50), value)
+            expected["key{}".format(i % 50)] = value
+        for i in range(0, 50, 7):
+            table.delete("key{}".format(i))
+            del expected["key{}".format(i)]
+        table.close()
+        self.assertGreater(len(table._segments.segments()), 2)
+
+        read_hints = SegmentStore._read_hints
+
+        def shifted(store, segment):
+            return [(key, op, number + 1) for key, op, number in read_hints(store, segment)]
+
+        with mock.patch.object(SegmentStore, "_read_hints", shifted):
+            table = self._open()
+        try:
+            self.assertEqual(dict(table.scan()), expected)
+        finally:
+            table.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
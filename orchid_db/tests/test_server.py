@@ -0,0 +1,82 @@
+'''
+python -m unittest discover -s tests -t .   (在orchid_db目录下运行)
+'''
+
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from internal.KVTable import KVTableOperator
+from mapEngine.factory import EngineType, MapEngineFactory
+from server.client import OrchidClient
+from server.server import OrchidServer
+
+# 需要文件路径的引擎
+_PATH_ENGINES = {"bitcask": "bitcask", "pagedBTreeMap": "paged.db", "lsm": "lsm"}
+
+
+class ServerGetTest(unittest.TestCase):
+    '''
+    GET 不存在的key回复nil, value是空字符串时回复空字符串, 每个引擎都一样
+    '''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="orchid-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+
+    def _serve(self, engine_name):
+        if engine_name in _PATH_ENGINES:
+            engine = MapEngineFactory.create(engine_name, path=os.path.join(self.workdir, _PATH_ENGINES[engine_name]))
+        else:
+            engine = MapEngineFactory.create(engine_name)
+        table = KVTableOperator(os.path.join(self.workdir, engine_name + ".db"), engine=engine,
+                                compact_min_bytes=None)
+        server = OrchidServer(table, port=0)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(server.start())
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        async def shutdown():
+            await server.close()
+            # 客户端已经断开, 等连接的处理协程读到EOF退出
+            handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            await asyncio.gather(*handlers)
+
+        def stop():
+            asyncio.run_coroutine_threadsafe(shutdown(), loop).result(10)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+            table.close()
+
+        self.addCleanup(stop)
+        return server.port
+
+    def test_missing_and_empty_values(self):
+        for engine_name in EngineType.__members__:
+            with self.subTest(engine=engine_name):
+                port = self._serve(engine_name)
+                # hashMap/bTreeMap是单例, 每个引擎用自己的key
+                missing, empty, full = ("{}:{}".format(engine_name, name) for name in ("missing", "empty", "full"))
+                with OrchidClient(port=port, timeout=10) as client:
+                    self.assertIsNone(client.get(missing))
+                    self.assertTrue(client.set(empty, ""))
+                    self.assertTrue(client.set(full, "v"))
+                    self.assertEqual(client.get(empty), "")
+                    self.assertEqual(client.get(full), "v")
+                    self.assertEqual(client.mget(missing, empty, full), [None, "", "v"])
+
+    def test_pipeline_writes(self):
+        port = self._serve("bPlusTreeMap")
+        with OrchidClient(port=port, timeout=10) as client:
+            replies = client.pipeline([("SET", "a", "1"), ("SET", "b", "2"), ("DEL", "a", "missing"),
+                                       ("GET", "a"), ("GET", "b")])
+        self.assertEqual(replies, ["OK", "OK", 1, None, b"2"])
+
+
+if __name__ == "__main__":
+    unittest.main()